@@ -1,29 +1,54 @@
 # Deployed by:
 # uvicorn api:app --reload --host 0.0.0.0 --port 8002
+# With more workers, publish the hash store into shared memory first:
+# python shared_hash_store.py && uvicorn api:app --workers 4 --host 0.0.0.0 --port 8002
+# Publishing a new hash store later is picked up by the running workers,
+# or immediately by: curl -X POST http://localhost:8002/admin/reload
 from __future__ import annotations
 
-import json
+import asyncio
+import multiprocessing
 import random
 import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Union
+from typing import Any, Callable, Iterator, Optional, TypeVar, Union
 
+import anyio
+import anyio.to_thread
+import orjson
 from fastapi import FastAPI, HTTPException, Query, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 
 from common import Match, bytes_to_hash, content_md5_hash, get_logger
 from config import Config
 from db_ord_data import InscriptionModel
-from db_similarity_index import SimilarityIndex
-from get_matches import get_matches_from_int_data
-from mempool import get_link_and_content_from_mempool
-from rust_server import get_matches_from_rust_server
-from update_data import (
-    create_inscription_model_from_api_data,
-    get_content_from_hiro_by_ord_id,
-    get_from_hiro_by_ord_id,
-    get_from_hiro_by_tx_id,
+from get_matches_numpy import (
+    HASH_LENGTH,
+    collapse_duplicates,
+    get_matches_from_store,
+    get_matches_from_unique,
+    iter_matches_within,
 )
+from hash_store import HashStore, words_to_str_hash
+from hash_store_reloader import HashStoreReloader
+from metrics import (
+    EVENTS,
+    REQUEST_DURATION,
+    record_stage,
+    record_startup_phase,
+    render_metrics,
+    server_timing_header,
+    start_request_timings,
+    timed,
+)
+from neighbor_table import NeighborTable, load_neighbor_table
+from result_cache import ResultCache
+from rust_server import RustServerUnavailable, get_matches_from_rust_server
 
 HERE = Path(__file__).parent
 
@@ -41,26 +66,244 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+# Per-stage durations of every request go into the /metrics histograms
+# and into the Server-Timing header of its response
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    global first_request_served
+    if not first_request_served:
+        first_request_served = True
+        logger.info(
+            f"First request {record_startup_phase('first_request')} s after start"
+        )
+    timings = start_request_timings()
+    started = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - started
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unknown"
+    REQUEST_DURATION.observe(total, endpoint=endpoint, status=str(response.status_code))
+    response.headers["Server-Timing"] = server_timing_header(timings, total)
+    response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
+
 USE_ORD_ID_INDEX = False
+USE_RUST_SERVER = True
+USE_DISK_RESULT_CACHE = False
 RANDOM_ORD_ID = "random"
+# How many ordinals with exactly the same hash may be in the local search
+# results, so that copies of one picture do not take all the top_n slots
+MAX_MATCHES_PER_HASH = 3
+# When collapsing the copies leaves too few results, the backend is asked
+# once more - for enough matches to skip all the copies, but at most this many
+MAX_REFILL = 2000
+# At most this many matches are streamed by one radius search request,
+# the rest is continued by the cursor
+WITHIN_LIMIT = 1000
+WITHIN_MAX_LIMIT = 10_000
+# How many streamed matches are enriched from DB at once
+STREAM_BATCH_SIZE = 100
+# How often to check whether the hash store file was replaced
+RELOAD_CHECK_SECONDS = 10
+
+# Blocking work (DB queries, HTTP calls, searching) is run in a bounded
+# thread pool and image decoding in a process pool, so that one slow
+# request does not stall the event loop for all the others
+THREAD_POOL_SIZE = 32
+HASH_PROCESS_POOL_SIZE = 2
+thread_limiter = anyio.CapacityLimiter(THREAD_POOL_SIZE)
+# Created on startup (see start_hash_process_pool)
+hash_process_pool: ProcessPoolExecutor | None = None
+
+T = TypeVar("T")
+
+
+async def run_blocking(func: Callable[..., T], *args: Any) -> T:
+    return await anyio.to_thread.run_sync(func, *args, limiter=thread_limiter)
+
+
+def get_neighbor_table() -> NeighborTable | None:
+    # Precomputed matches, memory-mapped - see neighbor_table.py
+    if USE_ORD_ID_INDEX and Config.NEIGHBOR_TABLE.exists():
+        return load_neighbor_table()
+    return None
+
+
+def on_hash_store_swap(store: HashStore) -> None:
+    global neighbor_table
+    neighbor_table = get_neighbor_table()
+    result_cache.set_version(store.version)
+    logger.info(f"Reloaded {len(store):_} entries - max is {store.max_id():_}.")
+
+
+first_request_served = False
 
 
 # Storing the data globally, so it is immediately available for all requests
-with open(Config.AVERAGE_HASH_DB) as f:
-    # converting the keys to integers for quicker comparison (and smaller storage)
-    average_hash_int_data: dict[str, int] = {
-        k: int(v, 2) for k, v in json.load(f)["data"].items()
-    }
-highest_id_we_have = max(int(k) for k in average_hash_int_data.keys())
-logger.info(
-    f"We have {len(average_hash_int_data):_} entries - max is {highest_id_we_have:_}."
+# (the binary store is memory-mapped, so all the workers share one copy).
+# It is swapped for a new one whenever the file is replaced - each request
+# takes the current store once and finishes on it
+def build_unique_hashes(store: HashStore) -> None:
+    store.unique
+
+
+hash_store_reloader = HashStoreReloader(
+    on_swap=on_hash_store_swap, warm_up=build_unique_hashes
+)
+stats = hash_store_reloader.stats()
+logger.info(f"We have {stats['entries']:_} entries - max is {stats['max_id']:_}.")
+
+neighbor_table = get_neighbor_table()
+
+# Finished results of popular queries, valid until the hash data changes
+result_cache = ResultCache(
+    stats["version"],
+    db_path=Config.RESULT_CACHE_DB if USE_DISK_RESULT_CACHE else None,
 )
+# Average hashes of uploaded files by their MD5, so that the same
+# file uploaded again does not need to be decoded
+file_hash_cache = ResultCache(f"hash_size_{Config.HASH_SIZE}", ttl_seconds=24 * 60 * 60)
+
+
+async def watch_hash_store() -> None:
+    while True:
+        await asyncio.sleep(RELOAD_CHECK_SECONDS)
+        try:
+            await run_blocking(hash_store_reloader.reload_if_changed)
+        except Exception as e:
+            logger.exception(f"Error reloading hash store: {e}")
+
+
+@app.on_event("startup")
+async def start_hash_process_pool() -> None:
+    global hash_process_pool
+    # Not forking the running server with its threads and open connections,
+    # workers come from a clean process that has only imported the hashing
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["common"])
+    hash_process_pool = ProcessPoolExecutor(HASH_PROCESS_POOL_SIZE, context)
 
 
-def get_full_inscription_result(match: Match) -> dict:
-    inscription = InscriptionModel.by_id(int(match["ord_id"]))
-    assert inscription is not None
-    return get_result_with_having_inscription(match, inscription)
+@app.on_event("shutdown")
+async def stop_hash_process_pool() -> None:
+    if hash_process_pool is not None:
+        hash_process_pool.shutdown()
+
+
+@app.on_event("startup")
+async def start_watching_hash_store() -> None:
+    logger.info(f"Ready {record_startup_phase('ready')} s after start")
+    # Keeping the references, so the tasks are not garbage collected
+    app.state.hash_store_watcher = asyncio.create_task(watch_hash_store())
+    # Building the distinct hashes only after the start, no request waits
+    # for them - they are memory-mapped from the files written with them
+    # (see HashStore.write), before that the searches do without them
+    app.state.hash_store_warm_up = asyncio.create_task(warm_up_hash_store())
+
+
+async def warm_up_hash_store() -> None:
+    try:
+        with timed("warm_up"):
+            await run_blocking(hash_store_reloader.warm_up_current)
+        logger.info(f"Warmed up {record_startup_phase('warmed_up')} s after start")
+    except Exception as e:
+        logger.exception(f"Error warming up hash store: {e}")
+
+
+def get_matches(
+    store: HashStore, ord_id: int | None, file_hash: str | None, top_n: int
+) -> list[Match]:
+    # Rust server is the quickest, the local numpy search is a good fallback
+    if USE_RUST_SERVER:
+        started = time.perf_counter()
+        try:
+            matches = get_matches_from_rust_server(ord_id, file_hash, top_n)
+        except RustServerUnavailable:
+            # It failed recently, not waiting for it again
+            EVENTS.inc(event="rust_skipped")
+        except Exception as e:
+            record_stage("search", time.perf_counter() - started, "rust_failed")
+            EVENTS.inc(event="rust_fallback")
+            logger.error(f"Error from Rust server: {e}")
+        else:
+            record_stage("search", time.perf_counter() - started, "rust")
+            return collapse_backend_matches(
+                store,
+                matches,
+                ord_id,
+                top_n,
+                lambda count: get_matches_from_rust_server(ord_id, file_hash, count),
+            )
+    return get_local_matches(store, ord_id, file_hash, top_n)
+
+
+def get_local_matches(
+    store: HashStore, ord_id: int | None, file_hash: str | None, top_n: int
+) -> list[Match]:
+    str_ord_id = str(ord_id) if ord_id is not None else None
+    if not store.unique_ready:
+        # Not waiting for the distinct hashes to be built (only stores
+        # written without them), copies of one picture are not limited
+        with timed("search", "numpy_all"):
+            return get_matches_from_store(store, str_ord_id, file_hash, top_n)
+    with timed("search", "numpy"):
+        return list(
+            get_matches_from_unique(
+                store.unique, str_ord_id, file_hash, top_n, MAX_MATCHES_PER_HASH
+            )
+        )
+
+
+def collapse_backend_matches(
+    store: HashStore,
+    matches: list[Match],
+    ord_id: int | None,
+    top_n: int,
+    get_more: Callable[[int], list[Match]],
+) -> list[Match]:
+    """Limits the copies of one picture the same way as the local search does,
+    so the results look the same whichever backend answered.
+
+    Uses the distinct hashes memory-mapped from the store file - until they
+    are available, the matches are returned as they are. When the copies
+    took some of the top_n slots, get_more asks the same backend once more,
+    for top_n more than the sizes of the collapsed groups (up to MAX_REFILL).
+    """
+    if not store.unique_ready:
+        EVENTS.inc(event="duplicates_not_collapsed")
+        return matches
+    str_ord_id = str(ord_id) if ord_id is not None else None
+    collapsed = collapse_duplicates(
+        store.unique, matches, MAX_MATCHES_PER_HASH, str_ord_id
+    )
+    if len(collapsed) < len(matches) and len(collapsed) < top_n:
+        EVENTS.inc(event="duplicates_refill")
+        rows = [store.index_of(match["ord_id"]) for match in collapsed]
+        groups = {int(store.unique.groups[row]) for row in rows if row is not None}
+        copies = int(store.unique.counts[sorted(groups)].sum())
+        try:
+            more = get_more(min(top_n + copies, MAX_REFILL))
+        except Exception as e:
+            logger.error(f"Error getting more matches: {e}")
+        else:
+            collapsed = collapse_duplicates(
+                store.unique, more, MAX_MATCHES_PER_HASH, str_ord_id
+            )
+    return list(collapsed[:top_n])
+
+
+def get_full_inscription_results(matches: list[Match]) -> list[dict]:
+    # Getting all the inscriptions from DB in one query
+    with timed("enrichment"):
+        inscriptions = InscriptionModel.by_ids(
+            [int(match["ord_id"]) for match in matches]
+        )
+    return [
+        get_result_with_having_inscription(match, inscriptions[int(match["ord_id"])])
+        for match in matches
+    ]
 
 
 def get_result_with_having_inscription(
@@ -68,12 +311,14 @@ def get_result_with_having_inscription(
 ) -> dict:
     inscr_dict = inscription.dict()
     inscr_dict["similarity"] = match["match_sum"]
+    if "duplicates" in match:
+        inscr_dict["duplicates"] = match["duplicates"]  # type: ignore
     inscr_dict["ordinals_com_link"] = inscription.ordinals_com_link()
     inscr_dict["ordinals_com_content_link"] = inscription.ordinals_com_content_link()
     inscr_dict["hiro_content_link"] = inscription.hiro_content_link()
-    inscr_dict[
-        "ordinalswallet_content_link"
-    ] = inscription.ordinalswallet_content_link()
+    inscr_dict["ordinalswallet_content_link"] = (
+        inscription.ordinalswallet_content_link()
+    )
     inscr_dict["mempool_space_link"] = inscription.mempool_space_link()
     return inscr_dict
 
@@ -88,6 +333,12 @@ def generate_random_id():
     return secrets.token_hex(5)
 
 
+def json_response(result: dict) -> Response:
+    with timed("serialize"):
+        content = orjson.dumps(result)
+    return Response(content, media_type="application/json")
+
+
 # curl http://localhost:8001/ord_id/123?top_n=10
 @app.get("/ord_id/{ord_id}")
 async def by_ord_id(request: Request, ord_id: Union[int, str], top_n: int = Query(20)):
@@ -98,23 +349,30 @@ async def by_ord_id(request: Request, ord_id: Union[int, str], top_n: int = Quer
         )
         # Possibility to select a random one
         if ord_id == RANDOM_ORD_ID:
-            ord_id = random.choice(list(average_hash_int_data.keys()))
+            ord_id = int(random.choice(hash_store_reloader.store.ids))
         # Check we have a valid int ord_id
         try:
             ord_id = int(ord_id)
         except ValueError:
             logger.error(f"ord_id must be an integer: {ord_id}")
             raise HTTPException(status_code=400, detail="ord_id must be an integer")
-        result = result_by_ord_id(ord_id, top_n)
+        result = await run_blocking(result_by_ord_id, ord_id, top_n)
         logger.info(f"req_id: {request_id}: request finished")
-        return result
+        return json_response(result)
     except Exception as e:
         logger.exception(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
 def result_by_ord_id(ord_id: int, top_n: int = 20, tx_id: str = "") -> dict:
-    result = do_by_ord_id(ord_id, top_n)
+    # The whole request uses one store, even when it is swapped in the meantime
+    store = hash_store_reloader.store
+    cache_key = ResultCache.make_key("ord_id", ord_id, top_n)
+    result = result_cache.get(cache_key, store.version)
+    if result is None:
+        result = do_by_ord_id(store, ord_id, top_n)
+        if result:
+            result_cache.set(cache_key, result, store.version)
     # get the content hash of chosen ordinal
     chosen_ord_content_hash = ""
     for match in result:
@@ -128,38 +386,53 @@ def result_by_ord_id(ord_id: int, top_n: int = 20, tx_id: str = "") -> dict:
     }
 
 
-def do_by_ord_id(ord_id: int, top_n: int = 20) -> list[dict]:
+def do_by_ord_id(store: HashStore, ord_id: int, top_n: int = 20) -> list[dict]:
     # Index is the fastest way to get the results - just then try Rust
-    if USE_ORD_ID_INDEX and SimilarityIndex.is_defined(ord_id):
-        matches: list[Match] = [
-            {"ord_id": str(match_ord_id), "match_sum": match_sum}
-            for match_ord_id, match_sum in SimilarityIndex.list_by_id(ord_id)[:top_n]
-        ]
+    table = neighbor_table
+    indexed_matches = None
+    if table is not None and top_n <= table.k:
+        with timed("search", "index"):
+            indexed_matches = table.get(ord_id, top_n)
+    if table is not None and indexed_matches is not None:
+        matches = collapse_backend_matches(
+            store,
+            indexed_matches,
+            ord_id,
+            top_n,
+            partial(get_indexed_matches, table, ord_id),
+        )
+    elif ord_id not in store:
+        return do_by_ord_id_we_do_not_have(ord_id, store.max_id(), top_n)
     else:
-        if str(ord_id) not in average_hash_int_data:
-            return do_by_ord_id_we_do_not_have(ord_id, top_n)
-        else:
-            try:
-                matches = get_matches_from_rust_server(ord_id, None)
-            except Exception as e:
-                logger.error(f"Error from Rust server: {e}")
-                matches = get_matches_from_int_data(
-                    average_hash_int_data, str(ord_id), None, top_n
-                )
+        matches = get_matches(store, ord_id, None, top_n)
     # We must make sure that the requested ord_id is in the results
     # (it may not be, when there is a lot of duplicates)
     if matches and ord_id not in [int(match["ord_id"]) for match in matches]:
         matches.pop()
         matches.append({"ord_id": str(ord_id), "match_sum": 256})
-    return [get_full_inscription_result(match) for match in matches[:top_n]]
+    return get_full_inscription_results(matches[:top_n])
+
+
+def get_indexed_matches(table: NeighborTable, ord_id: int, top_n: int) -> list[Match]:
+    # The table has only its k neighbors of every ordinal
+    return table.get(ord_id, min(top_n, table.k)) or []
 
 
-def do_by_ord_id_we_do_not_have(ord_id: int, top_n: int = 20) -> list[dict]:
+def do_by_ord_id_we_do_not_have(
+    ord_id: int, highest_id_we_have: int, top_n: int = 20
+) -> list[dict]:
     if ord_id < highest_id_we_have:
         logger.error(f"Not a valid picture - {ord_id}")
         return []
     else:
         # Downloading it in real time
+        # (ingestion modules are imported on the first use, to start quicker)
+        from update_data import (
+            create_inscription_model_from_api_data,
+            get_content_from_hiro_by_ord_id,
+            get_from_hiro_by_ord_id,
+        )
+
         try:
             ord_data_bytes = get_content_from_hiro_by_ord_id(ord_id)
             if not ord_data_bytes:
@@ -199,23 +472,23 @@ async def by_tx_id(request: Request, tx_id: str, top_n: int = Query(20)):
             raise HTTPException(status_code=400, detail="tx_id must be 64 characters")
 
         # Try translating tx_id to ord_id
-        ord_id = try_getting_ord_id_from_tx_id(tx_id)
+        ord_id = await run_blocking(try_getting_ord_id_from_tx_id, tx_id)
         if ord_id is not None:
-            result = result_by_ord_id(ord_id, top_n, tx_id)
+            result = await run_blocking(result_by_ord_id, ord_id, top_n, tx_id)
             logger.info(f"req_id: {request_id}: request finished")
-            return result
+            return json_response(result)
 
         # If we still do not have it, search in mempool
-        mempool_link, content = get_link_and_content_from_mempool(tx_id)
+        mempool_link, content = await run_blocking(get_from_mempool, tx_id)
         if not content:
             logger.error(f"Could not find tx_id in mempool: {tx_id}")
             raise HTTPException(status_code=404, detail="tx_id not found")
 
-        result = results_by_custom_file(content, top_n, tx_id)
+        result = await run_blocking(results_by_custom_file, content, top_n, tx_id)
         result["chosen_content_link"] = mempool_link
         result["mempool"] = True
         result["tx_id"] = tx_id
-        return result
+        return json_response(result)
     except Exception as e:
         logger.exception(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -226,6 +499,8 @@ def try_getting_ord_id_from_tx_id(tx_id: str) -> int | None:
     if db_inscription:
         return db_inscription.id
 
+    from update_data import get_from_hiro_by_tx_id
+
     hiro_inscription = get_from_hiro_by_tx_id(tx_id)
     if hiro_inscription:
         return hiro_inscription["number"]
@@ -233,6 +508,12 @@ def try_getting_ord_id_from_tx_id(tx_id: str) -> int | None:
     return None
 
 
+def get_from_mempool(tx_id: str) -> tuple[str | None, bytes | None]:
+    from mempool import get_link_and_content_from_mempool
+
+    return get_link_and_content_from_mempool(tx_id)
+
+
 # curl -X POST -H "Content-Type: multipart/form-data" -F "file=@images/1.jpg" http://localhost:8001/file?top_n=10
 @app.post("/file")
 async def by_custom_file(request: Request, file: UploadFile, top_n: int = Query(20)):
@@ -241,10 +522,11 @@ async def by_custom_file(request: Request, file: UploadFile, top_n: int = Query(
         logger.info(
             f"req_id: {request_id}, HOST: {get_client_ip(request)}, filename: {file.filename}, size: {file.size}, top_n: {top_n}"
         )
-        file_bytes = await file.read()
-        result = results_by_custom_file(file_bytes, top_n)
+        with timed("upload_read"):
+            file_bytes = await file.read()
+        result = await run_blocking(results_by_custom_file, file_bytes, top_n)
         logger.info(f"req_id: {request_id}: request finished")
-        return result
+        return json_response(result)
     except Exception as e:
         logger.exception(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -257,15 +539,136 @@ def results_by_custom_file(file_bytes: bytes, top_n: int = 20, tx_id: str = "")
 
 
 def do_by_custom_file(file_bytes: bytes, top_n: int = 20) -> list[dict]:
-    file_hash = bytes_to_hash(file_bytes)
+    store = hash_store_reloader.store
+    file_hash = get_file_hash(store, file_bytes)
+    cache_key = ResultCache.make_key("file_hash", file_hash, top_n)
+    result = result_cache.get(cache_key, store.version)
+    if result is None:
+        matches = get_matches(store, None, file_hash, top_n)
+        result = get_full_inscription_results(matches[:top_n])
+        result_cache.set(cache_key, result, store.version)
+    # Copy, so that the callers can add to it
+    return list(result)
+
+
+def get_file_hash(store: HashStore, file_bytes: bytes) -> str:
+    # Decoding the image only when we have not seen the same content before
+    content_hash = content_md5_hash(file_bytes)
+    file_hash = file_hash_cache.get(content_hash)
+    if file_hash is None:
+        with timed("hash", "known_inscription"):
+            file_hash = get_known_inscription_hash(store, content_hash)
+    if file_hash is None:
+        assert hash_process_pool is not None
+        with timed("hash", "decode"):
+            file_hash = hash_process_pool.submit(bytes_to_hash, file_bytes).result()
+    file_hash_cache.set(content_hash, file_hash)
+    return file_hash
+
+
+def get_known_inscription_hash(store: HashStore, content_hash: str) -> str | None:
+    # File may be the same as some inscription we already have the hash of
+    for ord_id in InscriptionModel.ids_by_content_hash(content_hash):
+        words = store.get_words(ord_id)
+        if words is not None:
+            return words_to_str_hash(words)
+    return None
+
+
+# curl "http://localhost:8001/within?ord_id=123&min_similarity=240&limit=100"
+@app.get("/within")
+async def within(
+    request: Request,
+    min_similarity: int = Query(..., ge=0, le=HASH_LENGTH),
+    ord_id: Optional[int] = Query(None),
+    file_hash: Optional[str] = Query(None),
+    cursor: Optional[int] = Query(None),
+    limit: int = Query(WITHIN_LIMIT, ge=1, le=WITHIN_MAX_LIMIT),
+):
+    request_id = generate_random_id()
+    logger.info(
+        f"req_id: {request_id}, HOST: {get_client_ip(request)}, WITHIN ord_id: {ord_id}, file_hash: {file_hash}, min_similarity: {min_similarity}, cursor: {cursor}"
+    )
+    if (ord_id is None) == (file_hash is None):
+        raise HTTPException(
+            status_code=400, detail="Exactly one of ord_id and file_hash is required"
+        )
+    if file_hash is not None and (
+        len(file_hash) != HASH_LENGTH or set(file_hash) - {"0", "1"}
+    ):
+        raise HTTPException(
+            status_code=400, detail=f"file_hash must be {HASH_LENGTH} of 0s and 1s"
+        )
+    return StreamingResponse(
+        stream_matches_within(
+            hash_store_reloader.store, ord_id, file_hash, min_similarity, cursor, limit
+        ),
+        media_type="application/x-ndjson",
+    )
+
+
+# curl -X POST -F "file=@images/1.jpg" "http://localhost:8001/file/within?min_similarity=240"
+@app.post("/file/within")
+async def file_within(
+    request: Request,
+    file: UploadFile,
+    min_similarity: int = Query(..., ge=0, le=HASH_LENGTH),
+    limit: int = Query(WITHIN_LIMIT, ge=1, le=WITHIN_MAX_LIMIT),
+):
     try:
-        matches = get_matches_from_rust_server(None, file_hash)
-    except Exception as e:
-        logger.error(f"Error from Rust server: {e}")
-        matches = get_matches_from_int_data(
-            average_hash_int_data, None, file_hash, top_n
+        request_id = generate_random_id()
+        logger.info(
+            f"req_id: {request_id}, HOST: {get_client_ip(request)}, WITHIN filename: {file.filename}, size: {file.size}, min_similarity: {min_similarity}"
         )
-    return [get_full_inscription_result(match) for match in matches[:top_n]]
+        store = hash_store_reloader.store
+        with timed("upload_read"):
+            file_bytes = await file.read()
+        file_hash = await run_blocking(get_file_hash, store, file_bytes)
+    except Exception as e:
+        logger.exception(f"Error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return StreamingResponse(
+        stream_matches_within(store, None, file_hash, min_similarity, None, limit),
+        media_type="application/x-ndjson",
+    )
+
+
+def stream_matches_within(
+    store: HashStore,
+    ord_id: int | None,
+    file_hash: str | None,
+    min_match_sum: int,
+    cursor: int | None,
+    limit: int,
+) -> Iterator[bytes]:
+    """NDJSON lines - all the enriched matches at least min_match_sum similar,
+    in ord_id order, and then the cursor to continue from.
+
+    The last line is {"next_cursor": ..., "file_hash": ...}, next_cursor
+    being null when there are no more matches. Only STREAM_BATCH_SIZE
+    matches are held in memory at once.
+    """
+    str_ord_id = str(ord_id) if ord_id is not None else None
+    matches = iter_matches_within(store, str_ord_id, file_hash, min_match_sum, cursor)
+    sent = 0
+    last_id = None
+    try:
+        while sent < limit:
+            batch = list(islice(matches, min(STREAM_BATCH_SIZE, limit - sent)))
+            if not batch:
+                break
+            for result in get_full_inscription_results(batch):
+                yield orjson.dumps(result) + b"\n"
+            sent += len(batch)
+            last_id = int(batch[-1]["ord_id"])
+        has_more = next(matches, None) is not None
+    except Exception as e:
+        # The response has already started, so just ending it with an error line
+        logger.exception(f"Error: {e}")
+        yield orjson.dumps({"error": "Internal server error"}) + b"\n"
+        return
+    last_line = {"next_cursor": last_id if has_more else None, "file_hash": file_hash}
+    yield orjson.dumps(last_line) + b"\n"
 
 
 # curl http://localhost:8001/
@@ -281,3 +684,45 @@ async def get_docs(request: Request):
     except Exception as e:
         logger.exception(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# curl http://localhost:8001/cache_stats
+@app.get("/cache_stats")
+async def get_cache_stats(request: Request):
+    try:
+        return result_cache.stats()
+    except Exception as e:
+        logger.exception(f"Error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# curl -X POST http://localhost:8001/admin/reload
+@app.post("/admin/reload")
+async def reload_hash_store(request: Request):
+    if get_client_ip(request) not in ("127.0.0.1", "::1"):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    try:
+        reloaded = await run_blocking(hash_store_reloader.reload)
+        return {"reloaded": reloaded, **hash_store_reloader.stats()}
+    except Exception as e:
+        logger.exception(f"Error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# curl http://localhost:8001/hash_store_stats
+@app.get("/hash_store_stats")
+async def get_hash_store_stats(request: Request):
+    try:
+        return hash_store_reloader.stats()
+    except Exception as e:
+        logger.exception(f"Error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# curl http://localhost:8001/metrics
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    # Every worker process has its own metrics
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,698 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor, Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np  # type: ignore
+import orjson
+import typer
+from PIL import Image  # type: ignore
+
+from common import Match, bytes_to_hash
+from config import Config
+from hash_store import HASH_WORDS, ID_DTYPE, WORD_DTYPE, HashStore, words_to_str_hashes
+from hiro_client import HiroClient
+from result_cache import ResultCache
+
+HERE = Path(__file__).parent
+
+DATA_DIR = HERE / "benchmark_data"
+RESULTS_FILE = HERE / "benchmark_results.json"
+
+# Backends searching a JSON file need it written next to the binary store
+JSON_BACKENDS = {"python_str", "python_int", "rust_ctypes"}
+DEFAULT_BACKENDS = ["python_int", "numpy", "numpy_unique", "multi_index"]
+ALL_BACKENDS = DEFAULT_BACKENDS + [
+    "python_str",
+    "coarse_to_fine",
+    "rust_ctypes",
+    "rust_handle",
+    "rust_server",
+]
+
+# Mixed load of one API worker - shares of the uploads needing an image
+# decoded and of the ordinals we do not have yet, downloaded from a slow
+# upstream (a local stand-in of Hiro), the rest being searches of the
+# ordinals we have, in a store of MIXED_LOAD_SIZE hashes
+UPLOAD_SHARE = 0.1
+SLOW_UPSTREAM_SHARE = 0.2
+SLOW_UPSTREAM_SECONDS = 0.2
+MIXED_LOAD_SIZE = 100_000
+
+# How many entries are converted to strings at once when writing JSON
+JSON_CHUNK_SIZE = 100_000
+
+# Loads the dataset, returns the function answering ord_id queries
+Loader = Callable[[Path, Path], Callable[[str], List[Match]]]
+
+
+def generate_dataset(size: int, duplicate_rate: float, seed: int = 0) -> HashStore:
+    """Random hashes, duplicate_rate of them being exact copies of others.
+
+    Ord_ids are increasing with small random gaps, like the real ones.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.cumsum(rng.integers(1, 3, size)).astype(ID_DTYPE)
+    distinct = max(1, int(size * (1 - duplicate_rate)))
+    hashes = rng.integers(
+        0, np.iinfo(np.uint64).max, (size, HASH_WORDS), dtype=np.uint64, endpoint=True
+    ).astype(WORD_DTYPE)
+    copies = rng.integers(0, distinct, size - distinct)
+    hashes[distinct:] = hashes[copies]
+    return HashStore(ids, hashes[rng.permutation(size)])
+
+
+def dataset_files(
+    size: int, duplicate_rate: float, with_json: bool, data_dir: Path = DATA_DIR
+) -> tuple[Path, Path]:
+    """Binary store and JSON DB files of the dataset, generated when missing."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    name = f"synthetic_{size}_{duplicate_rate}"
+    store_file = data_dir / f"{name}.bin"
+    json_file = data_dir / f"{name}.json"
+    if not store_file.exists():
+        generate_dataset(size, duplicate_rate).write(store_file)
+    if with_json and not json_file.exists():
+        _write_json(HashStore.load(store_file), json_file)
+    return store_file, json_file
+
+
+def _write_json(store: HashStore, path: Path) -> None:
+    # Chunk by chunk, as millions of hash strings do not fit in memory at once
+    with open(path, "wb") as f:
+        f.write(b'{"data":{')
+        for start in range(0, len(store), JSON_CHUNK_SIZE):
+            end = start + JSON_CHUNK_SIZE
+            chunk = dict(
+                zip(
+                    map(str, store.ids[start:end].tolist()),
+                    words_to_str_hashes(store.hashes[start:end]),
+                )
+            )
+            if start:
+                f.write(b",")
+            f.write(orjson.dumps(chunk)[1:-1])
+        f.write(b"}}")
+
+
+def _load_python_str(store_file: Path, json_file: Path):
+    from get_matches import get_matches_from_data
+
+    with open(json_file, "rb") as f:
+        data = orjson.loads(f.read())["data"]
+    return lambda ord_id: get_matches_from_data(data, ord_id, None)
+
+
+def _load_python_int(store_file: Path, json_file: Path):
+    from get_matches import get_matches_from_int_data
+
+    with open(json_file, "rb") as f:
+        data = {k: int(v, 2) for k, v in orjson.loads(f.read())["data"].items()}
+    return lambda ord_id: get_matches_from_int_data(data, ord_id, None)
+
+
+def _load_numpy(store_file: Path, json_file: Path):
+    from get_matches_numpy import get_matches_from_store
+
+    store = HashStore.load(store_file)
+    store.version  # reading all the pages, as the API does
+    return lambda ord_id: get_matches_from_store(store, ord_id, None)
+
+
+def _load_numpy_unique(store_file: Path, json_file: Path):
+    from get_matches_numpy import get_matches_from_unique
+
+    unique = HashStore.load(store_file).unique
+    return lambda ord_id: get_matches_from_unique(unique, ord_id, None, 20, 3)
+
+
+def _load_multi_index(store_file: Path, json_file: Path):
+    from multi_index_hash import MultiIndexHash
+
+    index = MultiIndexHash(HashStore.load(store_file))
+    return lambda ord_id: index.get_matches(ord_id, None)
+
+
+def _load_coarse_to_fine(store_file: Path, json_file: Path):
+    # Approximate - see coarse_to_fine.py --recall for its results
+    from coarse_to_fine import CoarseToFineSearch
+
+    search = CoarseToFineSearch(HashStore.load(store_file))
+    return lambda ord_id: search.get_matches(ord_id, None)
+
+
+def _load_rust_ctypes(store_file: Path, json_file: Path):
+    # The library parses the JSON file on every call
+    from get_matches_rust import get_matches
+
+    return lambda ord_id: get_matches(json_file, ord_id, None, 20)
+
+
+def _load_rust_handle(store_file: Path, json_file: Path):
+    # The library loads the binary store once
+    from get_matches_rust import RustHashDb
+
+    db = RustHashDb(store_file)
+    return lambda ord_id: db.get_matches(ord_id, None, 20)
+
+
+def _load_rust_server(store_file: Path, json_file: Path):
+    # Searches whatever data the running server has loaded
+    from rust_server import get_matches_from_rust_server
+
+    return lambda ord_id: get_matches_from_rust_server(int(ord_id), None, 20)
+
+
+LOADERS: dict[str, Loader] = {
+    "python_str": _load_python_str,
+    "python_int": _load_python_int,
+    "numpy": _load_numpy,
+    "numpy_unique": _load_numpy_unique,
+    "multi_index": _load_multi_index,
+    "coarse_to_fine": _load_coarse_to_fine,
+    "rust_ctypes": _load_rust_ctypes,
+    "rust_handle": _load_rust_handle,
+    "rust_server": _load_rust_server,
+}
+
+
+def run_backend(
+    backend: str,
+    store_file: Path,
+    json_file: Path,
+    queries: list[str],
+    max_seconds: float,
+) -> dict:
+    """Loads the backend and runs the queries one by one, until max_seconds.
+
+    Meant to run in a fresh process, so that the peak RSS is its own.
+    """
+    try:
+        started = time.perf_counter()
+        search = LOADERS[backend](store_file, json_file)
+        load_seconds = time.perf_counter() - started
+
+        latencies = []
+        started = time.perf_counter()
+        for ord_id in queries:
+            query_started = time.perf_counter()
+            search(ord_id)
+            latencies.append(time.perf_counter() - query_started)
+            if time.perf_counter() - started > max_seconds:
+                break
+        total_seconds = time.perf_counter() - started
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+    return {
+        "load_seconds": round(load_seconds, 4),
+        "queries": len(latencies),
+        "throughput_qps": round(len(latencies) / total_seconds, 2),
+        **latency_stats(latencies),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def latency_stats(latencies: list[float]) -> dict:
+    milliseconds = np.array(latencies) * 1000
+    return {
+        f"latency_{name}_ms": round(float(value), 3)
+        for name, value in (
+            ("p50", np.percentile(milliseconds, 50)),
+            ("p90", np.percentile(milliseconds, 90)),
+            ("p99", np.percentile(milliseconds, 99)),
+            ("mean", milliseconds.mean()),
+            ("max", milliseconds.max()),
+        )
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss of a spawned process includes the parent it was forked from,
+    # the VmHWM of Linux does not
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_search(
+    size: int,
+    duplicate_rate: float,
+    backends: list[str],
+    query_count: int,
+    max_seconds: float,
+) -> dict:
+    with_json = bool(JSON_BACKENDS & set(backends))
+    store_file, json_file = dataset_files(size, duplicate_rate, with_json)
+    ids = HashStore.load(store_file).ids
+    queries = [
+        str(ord_id) for ord_id in random.Random(0).sample(ids.tolist(), query_count)
+    ]
+
+    results = {}
+    spawn = multiprocessing.get_context("spawn")
+    for backend in backends:
+        with spawn.Pool(1) as pool:
+            results[backend] = pool.apply(
+                run_backend, (backend, store_file, json_file, queries, max_seconds)
+            )
+        print(
+            f"{size:_} hashes, {duplicate_rate} duplicates, {backend}: {results[backend]}"
+        )
+    return {"size": size, "duplicate_rate": duplicate_rate, "backends": results}
+
+
+def benchmark_hashing(images: list[bytes]) -> dict:
+    """Average hash throughput."""
+    started = time.perf_counter()
+    for data in images:
+        bytes_to_hash(data)
+    elapsed = time.perf_counter() - started
+    results = {
+        "images": len(images),
+        "images_per_second": round(len(images) / elapsed, 1),
+    }
+    print(f"Hashing: {results}")
+    return results
+
+
+def benchmark_mixed_load(images: list[bytes], concurrency: int, seconds: float) -> dict:
+    """Requests per second of one API worker under a mixed load - once with
+    the blocking work done on the event loop, once sent to the thread and
+    process pools the way api.py does it.
+
+    The requests go to the real app (api.app) in this process, through ASGI.
+    Its data files are generated into a temporary directory before it is
+    imported - so this must run after the benchmarks using the real ones.
+    """
+    with tempfile.TemporaryDirectory(prefix="benchmark_api_") as data_dir:
+        store = _prepare_api(Path(data_dir))
+        # The missing ordinals are downloaded by update_data (imported
+        # only now, with the generated data files)
+        import update_data
+
+        hiro = _StandInHiro(images[0])
+        threading.Thread(target=hiro.serve_forever, daemon=True).start()
+        update_data.quick_hiro_client = HiroClient(
+            f"http://127.0.0.1:{hiro.server_address[1]}/inscriptions",
+            requests_per_second=0,
+            max_retries=0,
+        )
+        results = {}
+        try:
+            for name, offload in (("inline", False), ("offloaded", True)):
+                results[name] = asyncio.run(
+                    _run_mixed_load(store, images, concurrency, seconds, offload)
+                )
+        finally:
+            hiro.shutdown()
+            hiro.server_close()
+    print(f"Mixed load: {results}")
+    return results
+
+
+def _prepare_api(data_dir: Path) -> HashStore:
+    """Points the app to a generated store and ord DB, and imports it."""
+    for name in (
+        "FILE_DB",
+        "ORD_DB",
+        "RESULT_CACHE_DB",
+        "NEIGHBOR_TABLE",
+        "AVERAGE_HASH_DB",
+        "HASH_STORE",
+        "HASH_LOG_DIR",
+        "SHARED_HASH_STORE",
+    ):
+        setattr(Config, name, data_dir / getattr(Config, name).name)
+    store = generate_dataset(MIXED_LOAD_SIZE, 0.0)
+    store.write(Config.SHARED_HASH_STORE)
+
+    from sqlmodel import SQLModel
+
+    from db_ord_data import InscriptionModel, get_engine, get_session
+
+    SQLModel.metadata.create_all(get_engine())
+    with get_session() as session:
+        session.bulk_insert_mappings(
+            InscriptionModel,  # type: ignore
+            [_inscription_data(ord_id) for ord_id in store.ids.tolist()],
+        )
+        session.commit()
+
+    import api
+
+    api.USE_RUST_SERVER = False
+    # Every upload is decoded, not found by its MD5
+    api.file_hash_cache = ResultCache("benchmark", max_size=0)
+    return api.hash_store_reloader.store
+
+
+def _inscription_data(ord_id: int) -> dict:
+    return {
+        "id": ord_id,
+        "tx_id": f"{ord_id:064x}",
+        "minted_address": "bc1q",
+        "content_type": "image/png",
+        "content_hash": "",
+        "datetime": "2023-05-01 00:00:00",
+        "timestamp": 1682899200,
+        "content_length": 1000,
+        "genesis_fee": 1000,
+        "genesis_height": 780_000,
+        "output_value": 546,
+        "sat_index": 0,
+    }
+
+
+class _StandInHiro(ThreadingHTTPServer):
+    """Answers like the Hiro API, the contents only after SLOW_UPSTREAM_SECONDS."""
+
+    def __init__(self, picture: bytes) -> None:
+        super().__init__(("127.0.0.1", 0), _StandInHiroHandler)
+        self.picture = picture
+
+
+class _StandInHiroHandler(BaseHTTPRequestHandler):
+    server: _StandInHiro
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path.endswith("/content"):
+            time.sleep(SLOW_UPSTREAM_SECONDS)
+            body = self.server.picture
+        else:
+            number = int(parse_qs(url.query)["from_number"][0])
+            entry = {
+                "number": number,
+                "tx_id": f"{number:064x}",
+                "address": "bc1q",
+                "content_type": "image/png",
+                "content_length": len(self.server.picture),
+                "timestamp": 1682899200000,
+                "genesis_fee": "1000",
+                "genesis_block_height": 780_000,
+                "value": "546",
+            }
+            body = orjson.dumps({"total": 1, "results": [entry]})
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class _InlineExecutor(Executor):
+    """Runs the submitted function right away, in the calling thread."""
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:  # type: ignore
+        future: Future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+async def _run_mixed_load(
+    store: HashStore,
+    images: list[bytes],
+    concurrency: int,
+    seconds: float,
+    offload: bool,
+) -> dict:
+    import api
+
+    run_blocking = api.run_blocking
+    if offload:
+        await api.start_hash_process_pool()
+        assert api.hash_process_pool is not None
+        # Starting the workers before measuring
+        api.hash_process_pool.submit(bytes_to_hash, images[0]).result()
+    else:
+        api.run_blocking = _run_inline
+        api.hash_process_pool = _InlineExecutor()  # type: ignore
+
+    rng = random.Random(0)
+    ids = store.ids.tolist()
+    missing_ids = itertools.count(store.max_id() + 1)
+    completed = {"upload": 0, "slow_upstream": 0, "quick": 0}
+    failed = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client() -> None:
+        nonlocal failed
+        while time.perf_counter() < deadline:
+            kind = rng.random()
+            if kind < UPLOAD_SHARE:
+                name = "upload"
+                status = await _post_file(api.app, rng.choice(images))
+            elif kind < UPLOAD_SHARE + SLOW_UPSTREAM_SHARE:
+                name = "slow_upstream"
+                path = f"/ord_id/{next(missing_ids)}"
+                status = await _asgi_request(api.app, "GET", path)
+            else:
+                name = "quick"
+                path = f"/ord_id/{rng.choice(ids)}"
+                status = await _asgi_request(api.app, "GET", path)
+            if status == 200:
+                completed[name] += 1
+            else:
+                failed += 1
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+    finally:
+        elapsed = time.perf_counter() - started
+        api.run_blocking = run_blocking
+        if offload:
+            await api.stop_hash_process_pool()
+        api.hash_process_pool = None
+    return {
+        **completed,
+        "failed": failed,
+        "requests_per_second": round(sum(completed.values()) / elapsed, 1),
+    }
+
+
+async def _run_inline(func: Callable, *args):
+    return func(*args)
+
+
+async def _post_file(app: Callable, data: bytes) -> int:
+    boundary = "benchmark-boundary"
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="picture"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    body += data + f"\r\n--{boundary}--\r\n".encode()
+    content_type = f"multipart/form-data; boundary={boundary}"
+    return await _asgi_request(app, "POST", "/file", body, content_type)
+
+
+async def _asgi_request(
+    app: Callable, method: str, path: str, body: bytes = b"", content_type: str = ""
+) -> int:
+    """Sends one request to the ASGI app, returns the response status."""
+    headers = [(b"host", b"benchmark"), (b"content-length", str(len(body)).encode())]
+    if content_type:
+        headers.append((b"content-type", content_type.encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    finished = asyncio.Event()
+    status = 0
+
+    async def receive() -> dict:
+        if messages:
+            return messages.pop()
+        # The client stays connected until the whole response is sent
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: dict) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif not message.get("more_body"):
+            finished.set()
+
+    await app(scope, receive, send)
+    finished.set()
+    return status
+
+
+def _load_images(images_dir: Path | None, count: int) -> list[bytes]:
+    if images_dir is None:
+        return _generate_images(count)
+    paths = sorted(p for p in images_dir.iterdir() if p.is_file())[:count]
+    return [p.read_bytes() for p in paths]
+
+
+def _generate_images(count: int) -> list[bytes]:
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(count):
+        side = (64, 512, 1024)[i % 3]
+        pixels = rng.integers(0, 256, (side, side, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format=("PNG", "JPEG")[i % 2])
+        images.append(buffer.getvalue())
+    return images
+
+
+def benchmark_enrichment(query_count: int) -> dict:
+    """Latency of getting 20 inscriptions from the ord DB in one query."""
+    from db_ord_data import InscriptionModel, get_session
+
+    with get_session() as session:
+        ids = [row[0] for row in session.query(InscriptionModel.id).limit(100_000).all()]  # type: ignore
+    rng = random.Random(0)
+    latencies = []
+    for _ in range(query_count):
+        batch = rng.sample(ids, min(20, len(ids)))
+        started = time.perf_counter()
+        InscriptionModel.by_ids(batch)
+        latencies.append(time.perf_counter() - started)
+    results = latency_stats(latencies)
+    print(f"Enrichment: {results}")
+    return results
+
+
+def compare_results(old: dict, new: dict) -> None:
+    """Prints the change of the median latency of every backend."""
+    old_runs = {(run["size"], run["duplicate_rate"]): run for run in old["search"]}
+    for run in new["search"]:
+        old_run = old_runs.get((run["size"], run["duplicate_rate"]))
+        if old_run is None:
+            continue
+        for backend, result in run["backends"].items():
+            old_result = old_run["backends"].get(backend, {})
+            if "latency_p50_ms" in result and "latency_p50_ms" in old_result:
+                ratio = result["latency_p50_ms"] / old_result["latency_p50_ms"]
+                print(
+                    f"{run['size']:_} hashes, {run['duplicate_rate']} duplicates, {backend}: "
+                    f"p50 {old_result['latency_p50_ms']} -> {result['latency_p50_ms']} ms ({ratio:.2f}x)"
+                )
+
+
+def main(
+    sizes: List[int] = typer.Option(
+        [100_000], "-s", "--size", help="Number of hashes, may be repeated"
+    ),
+    duplicate_rates: List[float] = typer.Option(
+        [0.0, 0.3],
+        "-d",
+        "--duplicate-rate",
+        help="Share of exact copies, may be repeated",
+    ),
+    backends: List[str] = typer.Option(
+        DEFAULT_BACKENDS,
+        "-b",
+        "--backend",
+        help=f"One of {ALL_BACKENDS}, may be repeated",
+    ),
+    query_count: int = typer.Option(50, "-q", "--queries", help="Queries per backend"),
+    max_seconds: float = typer.Option(
+        30, "--max-seconds", help="Stop querying a backend after this time"
+    ),
+    images_dir: Optional[Path] = typer.Option(
+        None,
+        "-i",
+        "--images-dir",
+        exists=True,
+        help="Pictures to hash, generated if not given",
+    ),
+    image_count: int = typer.Option(60, "--images", help="Number of pictures to hash"),
+    mixed_load: bool = typer.Option(
+        False,
+        "--mixed-load",
+        help="Also measure the requests per second of one API worker",
+    ),
+    concurrency: int = typer.Option(
+        32, "--concurrency", help="Concurrent clients of --mixed-load"
+    ),
+    enrichment: bool = typer.Option(
+        False,
+        "--enrichment",
+        help="Also measure getting the inscriptions from the ord DB",
+    ),
+    output: Path = typer.Option(
+        RESULTS_FILE, "-o", "--output", help="Results JSON file"
+    ),
+    compare: Optional[Path] = typer.Option(
+        None, "-c", "--compare", exists=True, help="Previous results to compare with"
+    ),
+) -> None:
+    unknown = set(backends) - set(LOADERS)
+    if unknown:
+        raise typer.BadParameter(
+            f"Unknown backends {unknown}, use some of {ALL_BACKENDS}"
+        )
+
+    results: dict = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "hash_size": Config.HASH_SIZE,
+        },
+        "search": [
+            benchmark_search(size, rate, backends, query_count, max_seconds)
+            for size in sizes
+            for rate in duplicate_rates
+        ],
+    }
+    images = _load_images(images_dir, image_count)
+    results["hashing"] = benchmark_hashing(images)
+    if enrichment:
+        results["enrichment"] = benchmark_enrichment(query_count)
+    # The last one, it points the data files of the app to the generated ones
+    if mixed_load:
+        results["mixed_load"] = benchmark_mixed_load(images, concurrency, max_seconds)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved into {output}")
+
+    if compare is not None:
+        with open(compare) as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, TextIO, Tuple
+
+import numpy as np  # type: ignore
+import typer
+from sqlalchemy import delete, insert, select
+from sqlmodel import Session, SQLModel
+
+from common import get_logger
+from config import Config
+from db_similarity_index import SimilarityIndex, get_engine, get_session
+from get_matches_numpy import get_top_n_batch
+from hash_log import HashLog
+from hash_store import HashStore, load_hash_store
+from neighbor_table import convert_similarity_db
+from process_pool import (
+    IN_FLIGHT_PER_WORKER,
+    log_speed,
+    map_bounded,
+    read_progress_lines,
+)
+
+HERE = Path(__file__).parent
+
+log_file_path = HERE / "build_similarity_index.log"
+logger = get_logger(__file__, log_file_path)
+
+PROGRESS_FILE = HERE / "build_similarity_index_progress.txt"
+# Hash store (with the pending hashes) the workers map, for the time of the build
+STORE_COPY_FILE = HERE / "build_similarity_index_store.bin"
+
+TOP_N = 20
+# How many ordinals are searched for in one task of the process pool
+BLOCK_SIZE = 1024
+# How many stale rows are deleted in one statement
+DELETE_CHUNK_SIZE = 500
+
+# Block start, (block, TOP_N) indices and match_sums of the best matches
+BlockResult = Tuple[int, np.ndarray, np.ndarray]
+
+# Store mapped by each worker process
+_worker_store: Optional[HashStore] = None
+
+
+def read_progress(progress_file: Path, version: str) -> set[int]:
+    """Starts of the blocks already saved by the previous runs on the same data."""
+    lines = read_progress_lines(progress_file)
+    if not lines or lines[0] != version:
+        logger.info("Hash store changed since the last run, starting over")
+        return set()
+    return {int(line) for line in lines[1:]}
+
+
+def build_similarity_index(
+    store: HashStore | None = None,
+    progress_file: Path = PROGRESS_FILE,
+    workers: int | None = None,
+    block_size: int = BLOCK_SIZE,
+) -> None:
+    """Computes the top matches of every ordinal against all the others.
+
+    Uses the hash log (snapshot with the pending hashes) by default.
+    Blocks of ordinals are searched for in a process pool, all workers
+    sharing the memory-mapped copy of the store. Every finished block
+    is written into the similarity index DB in one transaction and then
+    recorded in progress_file, so an interrupted build continues where
+    it stopped. Rows of ordinals no longer in the store are deleted.
+    """
+    if store is None:
+        store = HashLog().read()
+    # The snapshot may be compacted meanwhile, workers need this exact data
+    store.write(STORE_COPY_FILE)
+    done = read_progress(progress_file, store.version)
+    if not done:
+        with open(progress_file, "w") as f:
+            f.write(f"{store.version}\n")
+    to_do = [start for start in range(0, len(store), block_size) if start not in done]
+    logger.info(
+        f"{len(store):_} ordinals, {len(done):_} blocks done, {len(to_do):_} to do"
+    )
+
+    SQLModel.metadata.create_all(get_engine())
+    session = get_session()
+    started = time.perf_counter()
+    indexed_count = 0
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * IN_FLIGHT_PER_WORKER
+    tasks = ((start, block_size) for start in to_do)
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(STORE_COPY_FILE,)
+    ) as pool, open(progress_file, "a") as f:
+        for result in map_bounded(pool, _search_block, tasks, max_in_flight):
+            indexed_count += _save_block(result, store, session, f)
+            log_speed(logger, "ordinals", indexed_count, started, len(store))
+
+    deleted_count = _delete_stale_rows(store, session)
+    logger.info(f"Deleted {deleted_count:_} rows of ordinals not in the store")
+    progress_file.unlink()
+    STORE_COPY_FILE.unlink()
+
+
+def _init_worker(store_file: Path) -> None:
+    global _worker_store
+    _worker_store = load_hash_store(store_file)
+
+
+def _search_block(start: int, block_size: int) -> BlockResult:
+    assert _worker_store is not None
+    end = start + block_size
+    indices, match_sums = get_top_n_batch(
+        _worker_store.hashes, _worker_store.hashes[start:end], TOP_N
+    )
+    return start, indices, match_sums
+
+
+def _save_block(
+    result: BlockResult, store: HashStore, session: Session, f: TextIO
+) -> int:
+    start, indices, match_sums = result
+    end = start + len(indices)
+    rows = [
+        {
+            "id": ord_id,
+            "list_of_lists": json.dumps(
+                [list(match) for match in zip(match_ids, row_sums)]
+            ),
+        }
+        for ord_id, match_ids, row_sums in zip(
+            store.ids[start:end].tolist(),
+            store.ids[indices].tolist(),
+            match_sums.tolist(),
+        )
+    ]
+    # Replacing, as the block may have been saved before the interruption
+    session.execute(
+        insert(SimilarityIndex.__table__).prefix_with("OR REPLACE"),  # type: ignore
+        rows,
+    )
+    session.commit()
+    f.write(f"{start}\n")
+    f.flush()
+    return len(rows)
+
+
+def _delete_stale_rows(store: HashStore, session: Session) -> int:
+    """Deletes the rows of ordinals not in the store (anymore), returns how many."""
+    index_ids = np.array(
+        session.execute(select(SimilarityIndex.id)).scalars().all(),  # type: ignore
+        dtype=store.ids.dtype,
+    )
+    stale_ids = index_ids[~np.isin(index_ids, store.ids)].tolist()
+    for start in range(0, len(stale_ids), DELETE_CHUNK_SIZE):
+        end = start + DELETE_CHUNK_SIZE
+        chunk = stale_ids[start:end]
+        session.execute(
+            delete(SimilarityIndex).where(SimilarityIndex.id.in_(chunk))  # type: ignore
+        )
+    session.commit()
+    return len(stale_ids)
+
+
+def main(
+    store_file: Optional[Path] = typer.Option(
+        None,
+        "-s",
+        "--store-file",
+        exists=True,
+        help="Hash store file, hash log by default",
+    ),
+    workers: Optional[int] = typer.Option(
+        None, "-w", "--workers", help="Number of processes, all cores by default"
+    ),
+    neighbor_table: bool = typer.Option(
+        True, "--neighbor-table/--no-neighbor-table", help="Convert into table after"
+    ),
+) -> None:
+    store = load_hash_store(store_file) if store_file is not None else None
+    build_similarity_index(store, workers=workers)
+    if neighbor_table:
+        table = convert_similarity_db()
+        logger.info(f"Saved {len(table):_} rows into {Config.NEIGHBOR_TABLE}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
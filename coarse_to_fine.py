@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import random
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np  # type: ignore
+import typer
+
+from common import Match, path_to_hash
+from config import Config
+from get_matches_numpy import (
+    get_match_sums,
+    get_matches_from_store,
+    popcount,
+    top_n_indices,
+)
+from hash_store import (
+    COARSE_SIZE,
+    HashStore,
+    coarse_hashes,
+    load_hash_store,
+    str_hash_to_words,
+)
+
+COARSE_LENGTH = COARSE_SIZE**2
+# How many hashes the coarse search passes to the exact one,
+# see measure_recall for how many of the best matches it keeps
+CANDIDATES = 5000
+
+
+class CoarseToFineSearch:
+    """Two-stage approximate search over the hash store.
+
+    First the 64-bit coarse hashes (see hash_store.coarse_hashes) of all
+    the ordinals are compared with the query, a single popcount each.
+    Only the best candidates are then compared with the full hash,
+    and ranked by the exact match_sum, including inverse matches.
+
+    The best matches may be missed when their coarse hashes are not
+    similar enough - measure_recall tells how often that happens.
+    """
+
+    def __init__(self, store: HashStore, candidates: int = CANDIDATES) -> None:
+        self.store = store
+        self.candidates = candidates
+        self.coarse = store.coarse
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def get_matches(
+        self, ord_id: str | None, file_hash: str | None, top_n: int = 20
+    ) -> list[Match]:
+        if ord_id:
+            query = self.store.get_words(ord_id)
+            if query is None:
+                return []
+        else:
+            assert file_hash is not None
+            query = str_hash_to_words(file_hash)
+
+        indices, match_sums = self.get_top_n(query, top_n)
+        return [
+            {"ord_id": str(ord_id), "match_sum": match_sum}
+            for ord_id, match_sum in zip(
+                self.store.ids[indices].tolist(), match_sums.tolist()
+            )
+        ]
+
+    def get_top_n(self, query: np.ndarray, top_n: int) -> tuple[np.ndarray, np.ndarray]:
+        """Indices and match_sums of the best matches found, best first."""
+        candidates = self._get_candidates(query, max(self.candidates, top_n))
+        match_sums = get_match_sums(self.store.hashes[candidates], query)
+        # Candidates are sorted, so the ties are resolved as in a linear scan
+        best = top_n_indices(match_sums, top_n)
+        return candidates[best], match_sums[best]
+
+    def _get_candidates(self, query: np.ndarray, count: int) -> np.ndarray:
+        """Sorted indices of the count hashes with the best coarse match_sum."""
+        if count >= len(self):
+            return np.arange(len(self))
+        query_coarse = coarse_hashes(query[None, :])[0]
+        different_bit_count = popcount((self.coarse ^ query_coarse)[:, None])
+        coarse_match_sums = np.maximum(
+            different_bit_count, COARSE_LENGTH - different_bit_count
+        )
+        # Lowest coarse match_sum still needed - quicker than a partition,
+        # as there are only a few possible values
+        counts = np.bincount(coarse_match_sums, minlength=COARSE_LENGTH + 1)
+        at_least = np.cumsum(counts[::-1])[::-1]
+        threshold = int(np.flatnonzero(at_least >= count)[-1])
+        better = np.flatnonzero(coarse_match_sums > threshold)
+        tied = np.flatnonzero(coarse_match_sums == threshold)[: count - len(better)]
+        return np.sort(np.concatenate((better, tied)))
+
+
+def measure_recall(
+    store: HashStore,
+    candidates: list[int],
+    query_count: int = 200,
+    top_n: int = 20,
+    seed: int = 0,
+) -> list[dict]:
+    """Compares the coarse-to-fine search with the exact one on random ordinals.
+
+    Recall is the share of the results at least as good as the top_n-th
+    exact match, so it is not lowered by picking other ordinals
+    with the same match_sum. Also timing both of the searches.
+    """
+    rng = random.Random(seed)
+    query_rows = rng.sample(range(len(store)), min(query_count, len(store)))
+    queries = [str(store.ids[row]) for row in query_rows]
+
+    started = time.perf_counter()
+    exact = [get_matches_from_store(store, ord_id, None, top_n) for ord_id in queries]
+    exact_seconds = (time.perf_counter() - started) / len(queries)
+
+    results = []
+    for candidate_count in candidates:
+        search = CoarseToFineSearch(store, candidate_count)
+        started = time.perf_counter()
+        found = [search.get_matches(ord_id, None, top_n) for ord_id in queries]
+        seconds = (time.perf_counter() - started) / len(queries)
+        kept = 0
+        for exact_matches, matches in zip(exact, found):
+            threshold = exact_matches[-1]["match_sum"]
+            kept += sum(match["match_sum"] >= threshold for match in matches)
+        results.append(
+            {
+                "candidates": candidate_count,
+                "recall": kept / sum(len(matches) for matches in exact),
+                "ms_per_query": seconds * 1000,
+                "exact_ms_per_query": exact_seconds * 1000,
+            }
+        )
+    return results
+
+
+def main(
+    store_file: Path = typer.Option(
+        Config.HASH_STORE, "-s", "--store-file", exists=True, help="Hash store file"
+    ),
+    custom_file: Optional[Path] = typer.Option(
+        None, "-c", "--custom-file", exists=True, help="Custom file"
+    ),
+    ord_id: Optional[str] = typer.Option(None, "-o", "--ord-id", help="Ordinal ID"),
+    file_hash: Optional[str] = typer.Option(
+        None, "-f", "--file-hash", help="Hash of the file"
+    ),
+    top_n: int = typer.Option(20, "-n", "--top-n", help="Number of matches to return"),
+    candidates: List[int] = typer.Option(
+        [CANDIDATES], "-k", "--candidates", help="Hashes compared exactly"
+    ),
+    recall: bool = typer.Option(
+        False, "--recall", help="Compare with the exact search, for each candidates"
+    ),
+    query_count: int = typer.Option(
+        200, "-q", "--queries", help="Number of random ordinals for --recall"
+    ),
+) -> None:
+    store = load_hash_store(store_file)
+    if recall:
+        for result in measure_recall(store, candidates, query_count, top_n):
+            print(
+                f"{result['candidates']:>8_} candidates: recall {result['recall']:.4f}, "
+                f"{result['ms_per_query']:.2f} ms per query "
+                f"(exact {result['exact_ms_per_query']:.2f} ms)"
+            )
+        return
+
+    if custom_file is not None:
+        file_hash = path_to_hash(custom_file)
+    search = CoarseToFineSearch(store, candidates[0])
+    for match in search.get_matches(ord_id, file_hash, top_n):
+        print(match)
+
+
+if __name__ == "__main__":
+    typer.run(main)
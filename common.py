@@ -24,6 +24,11 @@ class Match(TypedDict):
     match_sum: int
 
 
+class DuplicateMatch(Match, total=False):
+    # How many ordinals have exactly the same hash
+    duplicates: int
+
+
 def get_logger(name: str, log_file_path: str | Path) -> logging.Logger:
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
@@ -58,6 +63,13 @@ def average_hash(img: Image.Image, hash_size: int) -> str:
     Docs about the approach:
     https://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
     """
+    bool_array = average_hash_bits(img, hash_size)
+    # "0" and "1" characters directly from the bits
+    return (bool_array.astype(np.uint8) + ord("0")).tobytes().decode()
+
+
+def average_hash_bits(img: Image.Image, hash_size: int) -> np.ndarray:
+    """Flat boolean array of the average hash bits."""
     # reduce size and complexity, then covert to grayscale
     img = img.convert("L").resize((hash_size, hash_size), ANTIALIAS)
 
@@ -65,7 +77,4 @@ def average_hash(img: Image.Image, hash_size: int) -> str:
     pixels = np.asarray(img)
     avg = np.mean(pixels)
 
-    bool_array = pixels > avg
-    int_array = bool_array.flatten().astype(int)
-    binary_string = "".join(map(str, int_array))
-    return binary_string
+    return (pixels > avg).flatten()
@@ -7,7 +7,15 @@ class Config:
     FILE_DB = HERE / "ord_files.db"
     ORD_DB = HERE / "ord.db"
     SIMILARITY_INDEX_DB = HERE / "similarity_index.db"
+    # SIMILARITY_INDEX_DB converted into fixed-width rows, see neighbor_table.py
+    NEIGHBOR_TABLE = HERE / "similarity_index_top_20.bin"
+    RESULT_CACHE_DB = HERE / "result_cache.db"
     HASH_SIZE = 16
     AVERAGE_HASH_DB = HERE / f"average_hash_db_{HASH_SIZE}.json"
+    HASH_STORE = HERE / f"average_hash_db_{HASH_SIZE}.bin"
+    # New hashes not yet compacted into HASH_STORE
+    HASH_LOG_DIR = HERE / f"average_hash_log_{HASH_SIZE}"
+    # tmpfs copy of HASH_STORE, mapped by all the API workers
+    SHARED_HASH_STORE = Path("/dev/shm") / f"ord_average_hash_db_{HASH_SIZE}.bin"
     RUST_API_URL = "http://localhost:8081"
     RUST_LIB_PATH = HERE / "similar_pictures/target/release/libsimilar_pictures.so"
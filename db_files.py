@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from sqlmodel import Field, Index, Session, SQLModel, create_engine
+from functools import lru_cache
+
+from sqlmodel import Field, Index, Session, SQLModel, col, create_engine, select
 
 from config import Config
 
@@ -10,8 +12,18 @@ def get_session() -> Session:
     return Session(engine)
 
 
+@lru_cache(maxsize=None)
 def get_engine():
-    return create_engine(f"sqlite:///{Config.FILE_DB}", echo=False)
+    # One pooled engine per process, shared by all the sessions
+    return create_engine(
+        f"sqlite:///{Config.FILE_DB}",
+        echo=False,
+        connect_args={"check_same_thread": False},
+    )
+
+
+# Staying below the SQLite limit of variables in one query
+MAX_IDS_IN_QUERY = 500
 
 
 class ByteData(SQLModel, table=True):
@@ -41,6 +53,18 @@ def get_data(tx_id: str) -> bytes | None:
         session.close()
 
 
+def get_data_batch(tx_ids: list[str]) -> dict[str, bytes]:
+    """Gets the content of all the found tx_ids at once, in one session."""
+    data: dict[str, bytes] = {}
+    with get_session() as session:
+        for start in range(0, len(tx_ids), MAX_IDS_IN_QUERY):
+            end = start + MAX_IDS_IN_QUERY
+            query = select(ByteData).where(col(ByteData.id).in_(tx_ids[start:end]))
+            for byte_data in session.exec(query):
+                data[byte_data.id] = byte_data.data
+    return data
+
+
 if __name__ == "__main__":
     # Create the table in the database
     SQLModel.metadata.create_all(get_engine())
@@ -1,8 +1,20 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from typing import Iterator
 
-from sqlmodel import Field, Index, Session, SQLModel, UniqueConstraint, create_engine
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
+from sqlmodel import (
+    Field,
+    Index,
+    Session,
+    SQLModel,
+    UniqueConstraint,
+    col,
+    create_engine,
+    select,
+)
 
 from config import Config
 
@@ -12,8 +24,33 @@ def get_session() -> Session:
     return Session(engine)
 
 
+@lru_cache(maxsize=None)
 def get_engine():
-    return create_engine(f"sqlite:///{Config.ORD_DB}", echo=False)
+    # One pooled engine per process, shared by all the sessions (and threads)
+    engine = create_engine(
+        f"sqlite:///{Config.ORD_DB}",
+        echo=False,
+        connect_args={"check_same_thread": False},
+    )
+    create_missing_indexes(engine)
+    return engine
+
+
+def create_missing_indexes(engine) -> None:
+    """Creates the indexes added to the model after the table was created.
+
+    IF NOT EXISTS makes it a no-op once they are there, also when more
+    processes start at once. Only the first run on a big table takes a while.
+    """
+    if not inspect(engine).has_table(InscriptionModel.__tablename__):
+        return
+    with engine.begin() as connection:
+        for index in InscriptionModel.__table__.indexes:  # type: ignore
+            connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+# Staying below the SQLite limit of variables in one query
+MAX_IDS_IN_QUERY = 500
 
 
 class InscriptionModel(SQLModel, table=True):
@@ -35,6 +72,7 @@ class InscriptionModel(SQLModel, table=True):
     __table_args__ = (
         UniqueConstraint("tx_id", name="uq_tx_id"),  # secondary key to tx_id
         Index("ix_inscriptions_id", "id", unique=True),  # for bulk inserts to work
+        Index("ix_inscriptions_content_hash", "content_hash"),  # for upload lookups
     )
 
     def __repr__(self) -> str:
@@ -63,23 +101,45 @@ class InscriptionModel(SQLModel, table=True):
 
     @classmethod
     def by_tx_id(cls, tx_id: str) -> "InscriptionModel" | None:
-        session = get_session()
-        model = (
-            session.query(InscriptionModel)
-            .filter(InscriptionModel.tx_id == tx_id)
-            .first()
-        )
-        if not model:
-            return None
-        return model
+        with get_session() as session:
+            model = (
+                session.query(InscriptionModel)
+                .filter(InscriptionModel.tx_id == tx_id)
+                .first()
+            )
+            if not model:
+                return None
+            return model
 
     @classmethod
     def by_id(cls, id: int) -> "InscriptionModel" | None:
-        session = get_session()
-        model = session.query(InscriptionModel).get(id)
-        if not model:
-            return None
-        return model
+        with get_session() as session:
+            model = session.query(InscriptionModel).get(id)
+            if not model:
+                return None
+            return model
+
+    @classmethod
+    def ids_by_content_hash(cls, content_hash: str) -> list[int]:
+        with get_session() as session:
+            query = select(InscriptionModel.id).where(
+                InscriptionModel.content_hash == content_hash
+            )
+            return list(session.exec(query))
+
+    @classmethod
+    def by_ids(cls, ids: list[int]) -> dict[int, "InscriptionModel"]:
+        """Gets all the found inscriptions at once, in one session."""
+        models: dict[int, InscriptionModel] = {}
+        with get_session() as session:
+            for start in range(0, len(ids), MAX_IDS_IN_QUERY):
+                end = start + MAX_IDS_IN_QUERY
+                query = select(InscriptionModel).where(
+                    col(InscriptionModel.id).in_(ids[start:end])
+                )
+                for model in session.exec(query):
+                    models[model.id] = model
+        return models
 
 
 def get_all_inscriptions_iter() -> Iterator[InscriptionModel]:
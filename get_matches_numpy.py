@@ -0,0 +1,349 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np  # type: ignore
+import typer
+
+from common import DuplicateMatch, Match, path_to_hash
+from config import Config
+from hash_store import HashStore, UniqueHashes, load_hash_store, str_hash_to_words
+
+HASH_LENGTH = Config.HASH_SIZE**2
+
+# How many hashes are XOR-ed at once, to keep the temporary arrays small
+CHUNK_SIZE = 1 << 18
+# Block sizes of the batch search - top matches are merged after each
+# (queries x hashes) block, which is itself computed in cache-sized tiles
+QUERY_BLOCK_SIZE = 32
+HASH_BLOCK_SIZE = 1 << 16
+TILE_SIZE = 4096
+
+# numpy >= 2.0 counts the bits natively, otherwise using a lookup table
+_bitwise_count = getattr(np, "bitwise_count", None)
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Counts the set bits of each row of the (..., words) uint64 array."""
+    if _bitwise_count is not None:
+        return _bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    as_bytes = np.ascontiguousarray(words).view(np.uint8)
+    return _BYTE_POPCOUNT[as_bytes].sum(axis=-1, dtype=np.int64)
+
+
+def get_match_sums(hashes: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Computes the match_sum of the query against every hash.
+
+    Also accounting for inverse matches - e.g. 11111111 and 00000000,
+    so the result is max(same_bit_count, different_bit_count).
+    """
+    match_sums = np.empty(len(hashes), dtype=np.int64)
+    for start in range(0, len(hashes), CHUNK_SIZE):
+        end = start + CHUNK_SIZE
+        different_bit_count = popcount(hashes[start:end] ^ query)
+        same_bit_count = HASH_LENGTH - different_bit_count
+        np.maximum(same_bit_count, different_bit_count, out=match_sums[start:end])
+    return match_sums
+
+
+def top_n_indices(match_sums: np.ndarray, top_n: int) -> np.ndarray:
+    """Indices of the top_n best match_sums, best first.
+
+    Ties are resolved in favour of the lower index, the same way
+    as heapq.nlargest does it in get_matches.py.
+    """
+    count = len(match_sums)
+    top_n = min(top_n, count)
+    if top_n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    # Unique sort keys - the higher match_sum, then the lower index wins
+    keys = match_sums * count + np.arange(count - 1, -1, -1, dtype=np.int64)
+    if top_n < count:
+        kth = count - top_n
+        candidates = np.argpartition(keys, kth)[kth:]
+    else:
+        candidates = np.arange(count)
+    return candidates[np.argsort(keys[candidates])[::-1]]
+
+
+def get_matches_batch(
+    store: HashStore,
+    queries: np.ndarray,
+    top_n: int = 20,
+    query_block_size: int = QUERY_BLOCK_SIZE,
+    hash_block_size: int = HASH_BLOCK_SIZE,
+) -> list[list[Match]]:
+    """Gets the top_n matches for each of the (Q, words) query hashes.
+
+    Results for each query are the same as from get_matches_from_store.
+    """
+    indices, match_sums = get_top_n_batch(
+        store.hashes, queries, top_n, query_block_size, hash_block_size
+    )
+    ord_ids = store.ids[indices]
+    return [
+        [
+            {"ord_id": str(ord_id), "match_sum": match_sum}
+            for ord_id, match_sum in zip(row_ids, row_sums)
+        ]
+        for row_ids, row_sums in zip(ord_ids.tolist(), match_sums.tolist())
+    ]
+
+
+def get_top_n_batch(
+    hashes: np.ndarray,
+    queries: np.ndarray,
+    top_n: int = 20,
+    query_block_size: int = QUERY_BLOCK_SIZE,
+    hash_block_size: int = HASH_BLOCK_SIZE,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Indices and match_sums (both (Q, top_n), best first) of the best hashes
+    for each of the (Q, words) query hashes.
+
+    The hashes are compared with a block of queries at once, tile by tile,
+    so the memory usage does not depend on the number of hashes.
+    Ties are resolved as in top_n_indices.
+    """
+    count = len(hashes)
+    top_n = min(top_n, count)
+    indices = np.empty((len(queries), top_n), dtype=np.int64)
+    match_sums = np.empty((len(queries), top_n), dtype=np.int64)
+    for start in range(0, len(queries), query_block_size):
+        end = start + query_block_size
+        keys = _get_best_keys_for_block(
+            hashes, queries[start:end], top_n, hash_block_size
+        )
+        indices[start:end] = count - 1 - keys % count
+        match_sums[start:end] = keys // count
+    return indices, match_sums
+
+
+def _get_best_keys_for_block(
+    hashes: np.ndarray, queries: np.ndarray, top_n: int, hash_block_size: int
+) -> np.ndarray:
+    """Sorted (best first) keys of the top_n matches for each query.
+
+    Keys are the same as in top_n_indices - match_sum * count + reversed index.
+    """
+    count = len(hashes)
+    top_n = min(top_n, count)
+    best_keys = np.zeros((len(queries), 0), dtype=np.int64)
+    for start in range(0, count, hash_block_size):
+        end = min(start + hash_block_size, count)
+        match_sums = get_match_sums_matrix(queries, hashes[start:end])
+        reversed_indices = np.arange(count - 1 - start, count - 1 - end, -1)
+        keys = match_sums.astype(np.int64) * count + reversed_indices
+        best_keys = np.concatenate((best_keys, keys), axis=1)
+        if best_keys.shape[1] > top_n:
+            kth = best_keys.shape[1] - top_n
+            best_keys = np.partition(best_keys, kth, axis=1)[:, kth:]
+    return -np.sort(-best_keys, axis=1)
+
+
+def get_match_sums_matrix(queries: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """Computes the (Q, H) match_sums of all the queries against all the hashes.
+
+    Going through small tiles word by word, so the temporary
+    arrays stay in the CPU cache.
+    """
+    match_sums = np.empty((len(queries), len(hashes)), dtype=np.uint16)
+    for start in range(0, len(hashes), TILE_SIZE):
+        end = start + TILE_SIZE
+        hash_words = np.ascontiguousarray(hashes[start:end].T)
+        tile = np.empty((len(queries), hash_words.shape[1]), dtype=np.uint64)
+        different_bit_count = np.zeros(tile.shape, dtype=np.uint16)
+        for query_word, hash_word in zip(queries.T, hash_words):
+            np.bitwise_xor(query_word[:, None], hash_word[None, :], out=tile)
+            different_bit_count += _popcount_elementwise(tile)
+        np.maximum(
+            HASH_LENGTH - different_bit_count,
+            different_bit_count,
+            out=match_sums[:, start:end],
+        )
+    return match_sums
+
+
+def _popcount_elementwise(words: np.ndarray) -> np.ndarray:
+    """Counts the set bits of each uint64 element, overwriting the array."""
+    if _bitwise_count is not None:
+        return _bitwise_count(words, out=words)
+    as_bytes = words.view(np.uint8).reshape(words.shape + (8,))
+    words[...] = _BYTE_POPCOUNT[as_bytes].sum(axis=-1)
+    return words
+
+
+def get_matches_from_store(
+    store: HashStore, ord_id: str | None, file_hash: str | None, top_n: int = 20
+) -> list[Match]:
+    if ord_id:
+        query = store.get_words(ord_id)
+        if query is None:
+            return []
+    else:
+        assert file_hash is not None
+        query = str_hash_to_words(file_hash)
+
+    match_sums = get_match_sums(store.hashes, query)
+    best_indices = top_n_indices(match_sums, top_n)
+
+    return [
+        {"ord_id": str(ord_id), "match_sum": match_sum}
+        for ord_id, match_sum in zip(
+            store.ids[best_indices].tolist(), match_sums[best_indices].tolist()
+        )
+    ]
+
+
+def iter_matches_within(
+    store: HashStore,
+    ord_id: str | None,
+    file_hash: str | None,
+    min_match_sum: int,
+    after_id: int | None = None,
+) -> Iterator[Match]:
+    """Yields all the matches with match_sum at least min_match_sum,
+    in ascending ord_id order, starting after the after_id ordinal.
+
+    The store is scanned chunk by chunk, so the memory usage does not
+    depend on the number of matches, and after_id (the last ord_id
+    received) continues an interrupted scan.
+    """
+    if ord_id:
+        query = store.get_words(ord_id)
+        if query is None:
+            return
+    else:
+        assert file_hash is not None
+        query = str_hash_to_words(file_hash)
+
+    first = 0
+    if after_id is not None:
+        first = int(np.searchsorted(store.ids, after_id, side="right"))
+    for start in range(first, len(store), CHUNK_SIZE):
+        end = start + CHUNK_SIZE
+        match_sums = get_match_sums(store.hashes[start:end], query)
+        found = np.flatnonzero(match_sums >= min_match_sum)
+        for match_id, match_sum in zip(
+            store.ids[start + found].tolist(), match_sums[found].tolist()
+        ):
+            yield {"ord_id": str(match_id), "match_sum": match_sum}
+
+
+def get_matches_from_unique(
+    unique: UniqueHashes,
+    ord_id: str | None,
+    file_hash: str | None,
+    top_n: int = 20,
+    max_per_hash: int | None = None,
+) -> list[DuplicateMatch]:
+    """Searches only the distinct hashes, then expands them into ordinals.
+
+    Every hash contributes at most max_per_hash of its ordinals, so large
+    groups of copies do not take all the top_n slots. Each match carries
+    the size of its whole group. The requested ordinal itself is always
+    listed first in its group.
+    """
+    store = unique.store
+    query_row = None
+    if ord_id:
+        query_row = store.index_of(ord_id)
+        if query_row is None:
+            return []
+        query = store.hashes[query_row]
+    else:
+        assert file_hash is not None
+        query = str_hash_to_words(file_hash)
+
+    match_sums = get_match_sums(unique.hashes, query)
+    # Every group gives at least one match, so top_n groups are enough
+    best_groups = top_n_indices(match_sums, top_n)
+
+    matches: list[DuplicateMatch] = []
+    for group, match_sum in zip(best_groups.tolist(), match_sums[best_groups].tolist()):
+        rows = unique.group_rows(group)
+        if query_row is not None and unique.groups[query_row] == group:
+            rows = np.concatenate(([query_row], rows[rows != query_row]))
+        duplicates = int(unique.counts[group])
+        for group_ord_id in store.ids[rows[:max_per_hash]].tolist():
+            matches.append(
+                {
+                    "ord_id": str(group_ord_id),
+                    "match_sum": match_sum,
+                    "duplicates": duplicates,
+                }
+            )
+        if len(matches) >= top_n:
+            break
+    return matches[:top_n]
+
+
+def collapse_duplicates(
+    unique: UniqueHashes,
+    matches: list[Match],
+    max_per_hash: int,
+    ord_id: str | None = None,
+) -> list[DuplicateMatch]:
+    """Applies the same limits as get_matches_from_unique to the matches of
+    any other search (e.g. the Rust server), keeping their order.
+
+    Every hash keeps at most max_per_hash of its ordinals (the requested
+    one always staying), and each match gets the size of its whole group.
+    Ordinals missing from the store are kept, as their own group.
+    """
+    store = unique.store
+    query_row = store.index_of(ord_id) if ord_id else None
+    kept_per_group: dict[int, int] = {}
+    if query_row is not None:
+        kept_per_group[int(unique.groups[query_row])] = 1
+    collapsed: list[DuplicateMatch] = []
+    for match in matches:
+        row = store.index_of(match["ord_id"])
+        if row is None:
+            collapsed.append(
+                {
+                    "ord_id": match["ord_id"],
+                    "match_sum": match["match_sum"],
+                    "duplicates": 1,
+                }
+            )
+            continue
+        group = int(unique.groups[row])
+        if row != query_row:
+            if kept_per_group.get(group, 0) >= max_per_hash:
+                continue
+            kept_per_group[group] = kept_per_group.get(group, 0) + 1
+        collapsed.append(
+            {
+                "ord_id": match["ord_id"],
+                "match_sum": match["match_sum"],
+                "duplicates": int(unique.counts[group]),
+            }
+        )
+    return collapsed
+
+
+def main(
+    store_file: Path = typer.Option(
+        Config.HASH_STORE, "-s", "--store-file", exists=True, help="Hash store file"
+    ),
+    custom_file: Optional[Path] = typer.Option(
+        None, "-c", "--custom-file", exists=True, help="Custom file"
+    ),
+    ord_id: Optional[str] = typer.Option(None, "-o", "--ord-id", help="Ordinal ID"),
+    file_hash: Optional[str] = typer.Option(
+        None, "-f", "--file-hash", help="Hash of the file"
+    ),
+    top_n: int = typer.Option(20, "-n", "--top-n", help="Number of matches to return"),
+) -> None:
+    if custom_file is not None:
+        file_hash = path_to_hash(custom_file)
+    store = load_hash_store(store_file)
+    matches = get_matches_from_store(store, ord_id, file_hash, top_n)
+    for match in matches:
+        print(match)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -2,28 +2,202 @@ from __future__ import annotations
 
 import ctypes
 import json
-from ctypes import c_char_p, c_int
+import threading
+from contextlib import contextmanager
+from ctypes import POINTER, c_char_p, c_int, c_int64, c_size_t, c_uint64, c_void_p
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
+import numpy as np  # type: ignore
 import typer
 
 from common import Match, path_to_hash
 from config import Config
+from hash_store import HASH_WORDS, ID_DTYPE, WORD_DTYPE, str_hash_to_words
 
 # Load the shared Rust library
 rust_lib = ctypes.cdll.LoadLibrary(str(Config.RUST_LIB_PATH))
 
+# A library built before the handle-based API would fail on the first call
+_missing = [
+    name
+    for name in (
+        "get_matches_c",
+        "free_matches_c",
+        "hash_db_open",
+        "hash_db_free",
+        "hash_db_len",
+        "hash_db_get_hash",
+        "hash_db_top_n",
+    )
+    if not hasattr(rust_lib, name)
+]
+if _missing:
+    raise ImportError(
+        f"{Config.RUST_LIB_PATH} does not export {', '.join(_missing)} - "
+        "rebuild it by `cargo build --release` in similar_pictures"
+    )
+
 # Define the return type and argument types for the Rust function
+# (the returned string is owned by Rust, it has to be given back to be freed)
 rust_lib.get_matches_c.argtypes = [c_char_p, c_char_p, c_char_p, c_int]
-rust_lib.get_matches_c.restype = c_char_p
+rust_lib.get_matches_c.restype = c_void_p
+rust_lib.free_matches_c.argtypes = [c_void_p]
+rust_lib.free_matches_c.restype = None
+
+# Handle-based API - the hash store is loaded once and searched many times
+rust_lib.hash_db_open.argtypes = [c_char_p]
+rust_lib.hash_db_open.restype = c_void_p
+rust_lib.hash_db_free.argtypes = [c_void_p]
+rust_lib.hash_db_free.restype = None
+rust_lib.hash_db_len.argtypes = [c_void_p]
+rust_lib.hash_db_len.restype = c_size_t
+rust_lib.hash_db_get_hash.argtypes = [c_void_p, c_int64, POINTER(c_uint64)]
+rust_lib.hash_db_get_hash.restype = c_int
+rust_lib.hash_db_top_n.argtypes = [
+    c_void_p,
+    POINTER(c_uint64),
+    c_size_t,
+    c_size_t,
+    POINTER(c_int64),
+    POINTER(c_int64),
+]
+rust_lib.hash_db_top_n.restype = c_size_t
 
 
 # Call the Rust function
 def get_matches_rust(json_file: str, ord_id: str, file_hash: str, top_n: int) -> str:
-    return rust_lib.get_matches_c(
+    pointer = rust_lib.get_matches_c(
         json_file.encode(), ord_id.encode(), file_hash.encode(), top_n
-    ).decode()
+    )
+    try:
+        return ctypes.string_at(pointer).decode()
+    finally:
+        rust_lib.free_matches_c(pointer)
+
+
+class RustHashDb:
+    """Binary hash store loaded by the Rust library once, for many searches.
+
+    Queries are (Q, HASH_WORDS) uint64 arrays (or any buffer of 32-byte hashes),
+    passed to Rust without copying. Results are written into (Q, top_n) int64
+    arrays, which the caller may provide to reuse them between calls.
+    The library releases the GIL while searching, so threads search in parallel.
+    close() waits for the searches still running, the ones started
+    after it fail with ValueError.
+    """
+
+    def __init__(self, store_file: str | Path = Config.HASH_STORE) -> None:
+        # Number of calls using the handle, close() waits for them to finish
+        self._users = 0
+        self._released = threading.Condition()
+        self._handle = rust_lib.hash_db_open(str(store_file).encode())
+        if not self._handle:
+            raise ValueError(f"Could not load hash store: {store_file}")
+
+    def __len__(self) -> int:
+        with self._open_handle() as handle:
+            return rust_lib.hash_db_len(handle)
+
+    def __enter__(self) -> "RustHashDb":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Frees the loaded data, the object cannot be used afterwards."""
+        if not hasattr(self, "_released"):
+            # __init__ did not get that far
+            return
+        with self._released:
+            handle, self._handle = self._handle, None
+            self._released.wait_for(lambda: self._users == 0)
+        if handle:
+            rust_lib.hash_db_free(handle)
+
+    def get_words(self, ord_id: int | str) -> np.ndarray | None:
+        words = np.empty(HASH_WORDS, dtype=WORD_DTYPE)
+        with self._open_handle() as handle:
+            found = rust_lib.hash_db_get_hash(
+                handle, int(ord_id), words.ctypes.data_as(POINTER(c_uint64))
+            )
+        return words if found else None
+
+    def get_top_n_batch(
+        self,
+        queries: np.ndarray | bytes | memoryview,
+        top_n: int = 20,
+        out_ids: np.ndarray | None = None,
+        out_match_sums: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Ord_ids and match_sums (both (Q, top_n), best first) of the best
+        matches for each of the query hashes.
+
+        Results are the same as from get_matches_numpy.get_matches_from_store.
+        When the store has fewer than top_n hashes, only its size is returned.
+        """
+        if not isinstance(queries, np.ndarray):
+            queries = np.frombuffer(queries, dtype=WORD_DTYPE)
+        # No copy for the contiguous little-endian arrays, e.g. HashStore.hashes
+        queries = np.ascontiguousarray(queries, dtype=WORD_DTYPE)
+        queries = queries.reshape(-1, HASH_WORDS)
+        shape = (len(queries), top_n)
+        out_ids = _check_output(out_ids, shape)
+        out_match_sums = _check_output(out_match_sums, shape)
+        with self._open_handle() as handle:
+            written = rust_lib.hash_db_top_n(
+                handle,
+                queries.ctypes.data_as(POINTER(c_uint64)),
+                len(queries),
+                top_n,
+                out_ids.ctypes.data_as(POINTER(c_int64)),
+                out_match_sums.ctypes.data_as(POINTER(c_int64)),
+            )
+        return out_ids[:, :written], out_match_sums[:, :written]
+
+    def get_matches(
+        self, ord_id: str | None, file_hash: str | None, top_n: int = 20
+    ) -> list[Match]:
+        if ord_id:
+            query = self.get_words(ord_id)
+            if query is None:
+                return []
+        else:
+            assert file_hash is not None
+            query = str_hash_to_words(file_hash)
+        ord_ids, match_sums = self.get_top_n_batch(query, top_n)
+        return [
+            {"ord_id": str(ord_id), "match_sum": match_sum}
+            for ord_id, match_sum in zip(ord_ids[0].tolist(), match_sums[0].tolist())
+        ]
+
+    @contextmanager
+    def _open_handle(self) -> Iterator[int]:
+        """The handle, not freed by close() until the block is left."""
+        with self._released:
+            if not self._handle:
+                raise ValueError("Hash store is already closed")
+            self._users += 1
+            handle = self._handle
+        try:
+            yield handle
+        finally:
+            with self._released:
+                self._users -= 1
+                self._released.notify_all()
+
+
+def _check_output(out: np.ndarray | None, shape: tuple[int, int]) -> np.ndarray:
+    if out is None:
+        return np.empty(shape, dtype=ID_DTYPE)
+    contiguous = out.flags.c_contiguous and out.flags.writeable
+    if out.shape != shape or out.dtype != ID_DTYPE or not contiguous:
+        raise ValueError(f"Output must be a writeable C-contiguous int64 {shape} array")
+    return out
 
 
 def get_matches(
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import fcntl
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np  # type: ignore
+import typer
+
+from config import Config
+from hash_store import (
+    HASH_WORDS,
+    ID_DTYPE,
+    WORD_DTYPE,
+    HashStore,
+    load_hash_store,
+    str_hashes_to_words,
+    write_json_db,
+)
+
+# One appended hash - ord_id and its packed average hash
+RECORD_DTYPE = np.dtype([("id", ID_DTYPE), ("hash", WORD_DTYPE, (HASH_WORDS,))])
+
+# Starting a new segment after this many bytes
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+# Compacting (rewriting the whole snapshot) only once the pending hashes
+# make reading noticeably slower - this many of them, or this many segments
+COMPACT_MIN_PENDING = 100_000
+COMPACT_MIN_SEGMENTS = 4
+
+
+class HashLog:
+    """Append-only log of new average hashes on top of the hash store snapshot.
+
+    New hashes are appended into segment files, so saving them costs only
+    their own size. Readers merge the snapshot with all the pending segments,
+    and compaction periodically folds the segments into a new snapshot.
+
+    All the operations hold a lock file, so that readers never see
+    a snapshot and segments from different points in time.
+    """
+
+    def __init__(
+        self,
+        log_dir: str | Path = Config.HASH_LOG_DIR,
+        snapshot_file: str | Path = Config.HASH_STORE,
+        json_file: str | Path | None = Config.AVERAGE_HASH_DB,
+    ) -> None:
+        self.log_dir = Path(log_dir)
+        self.snapshot_file = Path(snapshot_file)
+        self.json_file = Path(json_file) if json_file is not None else None
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+
+    def append(self, new_hashes: dict[str, str]) -> None:
+        if not new_hashes:
+            return
+        records = np.zeros(len(new_hashes), dtype=RECORD_DTYPE)
+        records["id"] = [int(ord_id) for ord_id in new_hashes]
+        records["hash"] = str_hashes_to_words(list(new_hashes.values()))
+        with self._locked(fcntl.LOCK_EX):
+            segments = self._segments()
+            segment = segments[-1] if segments else self._segment_path(0)
+            if segment.exists() and segment.stat().st_size >= MAX_SEGMENT_SIZE:
+                segment = self._next_segment_path(segments)
+            with open(segment, "ab") as f:
+                f.write(records.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self) -> HashStore:
+        """Snapshot merged with all the pending hashes (newer ones winning)."""
+        with self._locked(fcntl.LOCK_SH):
+            snapshot = self._load_snapshot()
+            records = self._read_segments(self._segments())
+        if not len(records):
+            return snapshot
+        return _merge(snapshot, records)
+
+    def pending_count(self) -> int:
+        with self._locked(fcntl.LOCK_SH):
+            return len(self._read_segments(self._segments()))
+
+    def needs_compaction(
+        self,
+        min_pending: int = COMPACT_MIN_PENDING,
+        min_segments: int = COMPACT_MIN_SEGMENTS,
+    ) -> bool:
+        with self._locked(fcntl.LOCK_SH):
+            segments = [s for s in self._segments() if s.stat().st_size]
+            pending = sum(s.stat().st_size for s in segments) // RECORD_DTYPE.itemsize
+        return pending > 0 and (pending >= min_pending or len(segments) >= min_segments)
+
+    def compact(self) -> HashStore:
+        """Folds all the pending segments into a new snapshot.
+
+        New appends go into a fresh segment in the meantime, so they
+        do not have to wait for the (slow) snapshot writing.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            sealed = self._segments()
+            snapshot = self._load_snapshot()
+            # Nothing to fold in, not rewriting the whole snapshot
+            if not any(segment.stat().st_size for segment in sealed):
+                return snapshot
+            self._next_segment_path(sealed).touch()
+        store = _merge(snapshot, self._read_segments(sealed))
+        store.write(Path(f"{self.snapshot_file}.new"))
+        if self.json_file is not None:
+            write_json_db(store, self.json_file)
+        with self._locked(fcntl.LOCK_EX):
+            os.replace(f"{self.snapshot_file}.new", self.snapshot_file)
+            for segment in sealed:
+                segment.unlink()
+        return store
+
+    def replace_snapshot(self, store: HashStore) -> None:
+        """Saves a completely new snapshot, dropping all the pending hashes."""
+        store.write(Path(f"{self.snapshot_file}.new"))
+        if self.json_file is not None:
+            write_json_db(store, self.json_file)
+        with self._locked(fcntl.LOCK_EX):
+            os.replace(f"{self.snapshot_file}.new", self.snapshot_file)
+            for segment in self._segments():
+                segment.unlink()
+
+    def _load_snapshot(self) -> HashStore:
+        if not self.snapshot_file.exists():
+            return HashStore(
+                np.zeros(0, dtype=ID_DTYPE), np.zeros((0, HASH_WORDS), dtype=WORD_DTYPE)
+            )
+        return load_hash_store(self.snapshot_file)
+
+    def _segments(self) -> list[Path]:
+        return sorted(self.log_dir.glob("segment_*.bin"))
+
+    def _segment_path(self, number: int) -> Path:
+        return self.log_dir / f"segment_{number:06d}.bin"
+
+    def _next_segment_path(self, segments: list[Path]) -> Path:
+        last_number = int(segments[-1].stem.split("_")[1]) if segments else -1
+        return self._segment_path(last_number + 1)
+
+    def _read_segments(self, segments: list[Path]) -> np.ndarray:
+        parts = []
+        for segment in segments:
+            data = segment.read_bytes()
+            # Ignoring a partially written last record, e.g. after a crash
+            complete = len(data) - len(data) % RECORD_DTYPE.itemsize
+            parts.append(np.frombuffer(data[:complete], dtype=RECORD_DTYPE))
+        if not parts:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.concatenate(parts)
+
+    @contextmanager
+    def _locked(self, operation: int) -> Iterator[None]:
+        with open(self.log_dir / "lock", "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _merge(snapshot: HashStore, records: np.ndarray) -> HashStore:
+    ids = np.concatenate((snapshot.ids, records["id"]))
+    hashes = np.concatenate((snapshot.hashes, records["hash"]))
+    # Stable sort keeps the appending order, so the last entry of every id wins
+    order = np.argsort(ids, kind="stable")
+    ids = ids[order]
+    hashes = hashes[order]
+    is_last = np.append(ids[1:] != ids[:-1], True)
+    return HashStore(ids[is_last], hashes[is_last])
+
+
+def main(
+    force: bool = typer.Option(
+        False, "-f", "--force", help="Compact all the pending hashes right away"
+    ),
+    min_pending: int = typer.Option(
+        COMPACT_MIN_PENDING,
+        "-m",
+        "--min-pending",
+        help="Compact with this many pending",
+    ),
+    min_segments: int = typer.Option(
+        COMPACT_MIN_SEGMENTS, "--min-segments", help="Compact with this many segments"
+    ),
+) -> None:
+    hash_log = HashLog()
+    pending = hash_log.pending_count()
+    if not force and not hash_log.needs_compaction(min_pending, min_segments):
+        print(f"Only {pending:_} pending hashes, not compacting")
+        return
+    store = hash_log.compact()
+    print(f"Compacted {pending:_} pending hashes, snapshot has {len(store):_}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
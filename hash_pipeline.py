@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, TextIO, Tuple
+
+from common import bytes_to_hash, get_logger
+from db_files import get_data_batch
+from db_ord_data import InscriptionModel
+from process_pool import (
+    IN_FLIGHT_PER_WORKER,
+    log_speed,
+    map_bounded,
+    read_progress_lines,
+)
+
+HERE = Path(__file__).parent
+
+log_file_path = HERE / "hash_pipeline.log"
+logger = get_logger(__file__, log_file_path)
+
+# How many pictures are read from DB and sent to a worker at once
+BATCH_SIZE = 200
+
+# ord_id, average hash (None when failed), error message
+HashResult = Tuple[int, Optional[str], str]
+
+
+def read_progress(progress_file: Path) -> dict[str, str]:
+    """Reads the "ord_id avg_hash" lines saved by the previous runs."""
+    done: dict[str, str] = {}
+    for line in read_progress_lines(progress_file):
+        ord_id, avg_hash = line.split()
+        done[ord_id] = avg_hash
+    return done
+
+
+def hash_inscriptions(
+    inscriptions: Iterable[InscriptionModel],
+    progress_file: Path,
+    workers: int | None = None,
+    batch_size: int = BATCH_SIZE,
+) -> dict[str, str]:
+    """Computes average hashes of all the inscriptions on multiple cores.
+
+    Every result is appended to progress_file as soon as its batch is done,
+    so an interrupted run continues where it stopped. Returns all the hashes
+    from progress_file, including the ones from the previous runs.
+    """
+    avg_hashes = read_progress(progress_file)
+    logger.info(f"Already have {len(avg_hashes):_} hashes in {progress_file}")
+    to_do = (
+        (inscr.id, inscr.tx_id)
+        for inscr in inscriptions
+        if str(inscr.id) not in avg_hashes
+    )
+
+    started = time.perf_counter()
+    hashed_count = 0
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * IN_FLIGHT_PER_WORKER
+    # Read from DB lazily, only when the workers can take another batch
+    tasks = ((_read_batch(batch),) for batch in _batched(to_do, batch_size))
+    with ProcessPoolExecutor(workers) as pool, open(progress_file, "a") as f:
+        for results in map_bounded(pool, _hash_batch, tasks, max_in_flight):
+            hashed_count += _save_results(results, avg_hashes, f)
+            log_speed(logger, "pictures", hashed_count, started)
+
+    return avg_hashes
+
+
+def _read_batch(batch: list[tuple[int, str]]) -> list[tuple[int, bytes]]:
+    contents = get_data_batch([tx_id for _, tx_id in batch])
+    return [(ord_id, contents[tx_id]) for ord_id, tx_id in batch if tx_id in contents]
+
+
+def _hash_batch(items: list[tuple[int, bytes]]) -> list[HashResult]:
+    results: list[HashResult] = []
+    for ord_id, data in items:
+        try:
+            results.append((ord_id, bytes_to_hash(data), ""))
+        except Exception as e:
+            results.append((ord_id, None, str(e)))
+    return results
+
+
+def _save_results(
+    results: list[HashResult], avg_hashes: dict[str, str], f: TextIO
+) -> int:
+    for ord_id, avg_hash, error in results:
+        if avg_hash is None:
+            logger.error(
+                f"ERROR: could not get average hash of picture {ord_id} - {error}"
+            )
+            continue
+        avg_hashes[str(ord_id)] = avg_hash
+        f.write(f"{ord_id} {avg_hash}\n")
+    f.flush()
+    return len(results)
+
+
+def _batched(iterable: Iterator[tuple[int, str]], size: int) -> Iterator[list]:
+    while batch := list(islice(iterable, size)):
+        yield batch
@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from functools import cached_property
+from pathlib import Path
+from typing import BinaryIO
+
+import numpy as np  # type: ignore
+import orjson
+import typer
+
+from config import Config
+
+# File layout (all little-endian):
+#   magic (8 bytes) | count (uint64) | words per hash (uint64)
+#   | max ord_id (int64) | version (32 bytes, hex md5 of ord_ids and hashes)
+#   ord_ids (int64 * count), sorted ascending
+#   hashes (uint64 * words * count), word 0 holding the first 64 bits of the hash
+# The first version of the format had no max ord_id and version in the header.
+#
+# Optional sections may follow the hashes, holding the search structures
+# that would otherwise be built by every process (see HashStore.unique and
+# HashStore.coarse), so they are memory-mapped and shared too.
+# Older readers ignore them:
+#   magic (8 bytes) | section count (uint64)
+#   (name (8 bytes) | start in the file (uint64) | item count (uint64)) * count
+#   items of the sections (8 bytes each, types by SECTION_DTYPES)
+MAGIC = b"ORDHASH2"
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("count", "<u8"),
+        ("words", "<u8"),
+        ("max_id", "<i8"),
+        ("version", "S32"),
+    ]
+)
+MAGIC_V1 = b"ORDHASH1"
+HEADER_V1_DTYPE = np.dtype([("magic", "S8"), ("count", "<u8"), ("words", "<u8")])
+ID_DTYPE = np.dtype("<i8")
+WORD_DTYPE = np.dtype("<u8")
+SECTIONS_MAGIC = b"ORDSECT1"
+SECTION_DTYPE = np.dtype([("name", "S8"), ("start", "<u8"), ("count", "<u8")])
+# UniqueHashes - hashes, counts, groups, rows and offsets - and coarse hashes
+INDEX_DTYPE = np.dtype("<i8")
+SECTION_DTYPES = {
+    b"uhashes": WORD_DTYPE,
+    b"ucounts": INDEX_DTYPE,
+    b"ugroups": INDEX_DTYPE,
+    b"urows": INDEX_DTYPE,
+    b"uoffsets": INDEX_DTYPE,
+    b"coarse": WORD_DTYPE,
+}
+UNIQUE_SECTIONS = (b"uhashes", b"ucounts", b"ugroups", b"urows", b"uoffsets")
+
+HASH_WORDS = Config.HASH_SIZE**2 // 64
+
+# Side of the coarse hash - 8x8 bits fit into one uint64 word
+COARSE_SIZE = 8
+# How many hashes are converted into coarse ones at once
+COARSE_CHUNK_SIZE = 1 << 16
+
+
+def str_hashes_to_words(hashes: list[str]) -> np.ndarray:
+    """Converts "0/1" hash strings into a (N, words) uint64 matrix."""
+    if not hashes:
+        return np.zeros((0, HASH_WORDS), dtype=WORD_DTYPE)
+    chars = np.frombuffer("".join(hashes).encode(), dtype=np.uint8)
+    return bits_to_words((chars == ord("1")).reshape(len(hashes), -1))
+
+
+def bits_to_words(bits: np.ndarray) -> np.ndarray:
+    """Packs the (..., bits) boolean array into (..., words) uint64 words."""
+    packed = np.packbits(bits, axis=-1)  # big-endian bit order, like int(v, 2)
+    return packed.view(">u8").astype(WORD_DTYPE)
+
+
+def str_hash_to_words(hash: str) -> np.ndarray:
+    return str_hashes_to_words([hash])[0]
+
+
+def words_to_str_hash(words: np.ndarray) -> str:
+    bits = np.unpackbits(np.asarray(words, dtype=">u8").view(np.uint8))
+    return "".join(map(str, bits))
+
+
+def words_to_str_hashes(hashes: np.ndarray) -> list[str]:
+    """Converts the (N, words) uint64 matrix back into "0/1" hash strings."""
+    as_bytes = np.ascontiguousarray(hashes, dtype=">u8").view(np.uint8)
+    chars = np.unpackbits(as_bytes, axis=1) + ord("0")
+    return [row.tobytes().decode() for row in chars]
+
+
+def coarse_hashes(hashes: np.ndarray) -> np.ndarray:
+    """Converts the (N, words) hashes into (N,) uint64 8x8 summaries.
+
+    Every coarse bit belongs to a square block of the hash bits (2x2 for
+    the 16x16 hashes) and is set when at least half of them are set -
+    roughly the average hash of the picture resized to 8x8.
+    """
+    size = int(round((hashes.shape[1] * 64) ** 0.5))
+    block = size // COARSE_SIZE
+    coarse = np.empty(len(hashes), dtype=WORD_DTYPE)
+    for start in range(0, len(hashes), COARSE_CHUNK_SIZE):
+        end = start + COARSE_CHUNK_SIZE
+        as_bytes = np.ascontiguousarray(hashes[start:end], dtype=">u8").view(np.uint8)
+        # Bits of the hash are the pixels row by row
+        bits = np.unpackbits(as_bytes, axis=1).reshape(
+            -1, COARSE_SIZE, block, COARSE_SIZE, block
+        )
+        set_counts = bits.sum(axis=(2, 4), dtype=np.uint8)
+        coarse_bits = set_counts.reshape(-1, COARSE_SIZE**2) * 2 >= block * block
+        coarse[start:end] = bits_to_words(coarse_bits)[:, 0]
+    return coarse
+
+
+class HashStore:
+    """Sorted ord_ids with their average hashes packed into uint64 words.
+
+    When loaded from a file, both arrays are read-only memory maps,
+    so all the processes reading the same file share the page cache,
+    and the version comes precomputed from the header.
+    """
+
+    def __init__(
+        self, ids: np.ndarray, hashes: np.ndarray, version: str | None = None
+    ) -> None:
+        assert len(ids) == len(hashes)
+        self.ids = ids
+        self.hashes = hashes
+        if version is not None:
+            self.version = version
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, ord_id: int | str) -> bool:
+        return self.index_of(ord_id) is not None
+
+    @classmethod
+    def from_str_data(cls, data: dict[str, str]) -> "HashStore":
+        ids = np.fromiter(
+            (int(k) for k in data.keys()), dtype=ID_DTYPE, count=len(data)
+        )
+        hashes = str_hashes_to_words(list(data.values()))
+        order = np.argsort(ids, kind="stable")
+        return cls(ids[order], hashes[order])
+
+    @classmethod
+    def load(cls, path: str | Path) -> "HashStore":
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        magic = buffer[: len(MAGIC)].tobytes()
+        if magic == MAGIC:
+            header = buffer[: HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+            version = header["version"].decode()
+        elif magic == MAGIC_V1:
+            header = buffer[: HEADER_V1_DTYPE.itemsize].view(HEADER_V1_DTYPE)[0]
+            version = None
+        else:
+            raise ValueError(f"Not a hash store file: {path}")
+        count = int(header["count"])
+        words = int(header["words"])
+        ids_start = header.dtype.itemsize
+        hashes_start = ids_start + count * ID_DTYPE.itemsize
+        hashes_end = hashes_start + count * words * WORD_DTYPE.itemsize
+        ids = buffer[ids_start:hashes_start].view(ID_DTYPE)
+        hashes = buffer[hashes_start:hashes_end].view(WORD_DTYPE).reshape(count, words)
+        store = cls(ids, hashes, version)
+        sections = _read_sections(buffer, hashes_end)
+        if all(name in sections for name in UNIQUE_SECTIONS):
+            store.unique = UniqueHashes(
+                store,
+                sections[b"uhashes"].reshape(-1, words),
+                sections[b"ucounts"],
+                sections[b"ugroups"],
+                sections[b"urows"],
+                sections[b"uoffsets"],
+            )
+        if b"coarse" in sections:
+            store.coarse = sections[b"coarse"]
+        return store
+
+    def write(self, path: str | Path) -> None:
+        # Writing into a temporary file and renaming it, so that readers
+        # having the old file mapped are not affected
+        tmp_path = Path(f"{path}.tmp")
+        header = np.array(
+            [
+                (
+                    MAGIC,
+                    len(self),
+                    self.hashes.shape[1],
+                    self.max_id(),
+                    self.version.encode(),
+                )
+            ],
+            dtype=HEADER_DTYPE,
+        )
+        unique = self.unique
+        sections = {
+            b"uhashes": unique.hashes,
+            b"ucounts": unique.counts,
+            b"ugroups": unique.groups,
+            b"urows": unique.rows,
+            b"uoffsets": unique.offsets,
+            b"coarse": self.coarse,
+        }
+        with open(tmp_path, "wb") as f:
+            f.write(header.tobytes())
+            f.write(np.ascontiguousarray(self.ids, dtype=ID_DTYPE).tobytes())
+            f.write(np.ascontiguousarray(self.hashes, dtype=WORD_DTYPE).tobytes())
+            _write_sections(f, sections)
+        os.replace(tmp_path, path)
+
+    def index_of(self, ord_id: int | str) -> int | None:
+        ord_id = int(ord_id)
+        index = int(np.searchsorted(self.ids, ord_id))
+        if index < len(self.ids) and self.ids[index] == ord_id:
+            return index
+        return None
+
+    def get_words(self, ord_id: int | str) -> np.ndarray | None:
+        index = self.index_of(ord_id)
+        if index is None:
+            return None
+        return self.hashes[index]
+
+    @cached_property
+    def version(self) -> str:
+        """Identifies the data - changes whenever any entry is added or changed."""
+        checksum = hashlib.md5(np.ascontiguousarray(self.ids, ID_DTYPE).data)
+        checksum.update(np.ascontiguousarray(self.hashes, WORD_DTYPE).data)
+        return checksum.hexdigest()
+
+    @cached_property
+    def unique(self) -> "UniqueHashes":
+        """Distinct hashes with their ord_ids - memory-mapped from the file
+        written by write, otherwise built on the first use."""
+        return UniqueHashes.build(self)
+
+    @property
+    def unique_ready(self) -> bool:
+        """Whether unique is available without building it."""
+        return "unique" in self.__dict__
+
+    @cached_property
+    def coarse(self) -> np.ndarray:
+        """8x8 summaries of the hashes (see coarse_hashes) - memory-mapped
+        from the file written by write, otherwise built on the first use."""
+        return coarse_hashes(self.hashes)
+
+    def max_id(self) -> int:
+        return int(self.ids[-1]) if len(self) else 0
+
+    def to_str_data(self) -> dict[str, str]:
+        return dict(zip(map(str, self.ids.tolist()), words_to_str_hashes(self.hashes)))
+
+
+class UniqueHashes:
+    """Every distinct hash of the store once, with the posting list of its ord_ids.
+
+    Large groups of identical pictures then cost one comparison each.
+    Groups are ordered by their lowest ord_id, and the posting lists
+    are rows of the store in ascending ord_id order.
+    """
+
+    def __init__(
+        self,
+        store: HashStore,
+        hashes: np.ndarray,
+        counts: np.ndarray,
+        groups: np.ndarray,
+        rows: np.ndarray,
+        offsets: np.ndarray,
+    ) -> None:
+        self.store = store
+        self.hashes = hashes
+        self.counts = counts
+        # Group of every row of the store, and the rows grouped together
+        self.groups = groups
+        self.rows = rows
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, store: HashStore) -> "UniqueHashes":
+        hashes = np.ascontiguousarray(store.hashes, dtype=WORD_DTYPE)
+        row_dtype = np.dtype((np.void, hashes.shape[1] * WORD_DTYPE.itemsize))
+        _, first_rows, inverse, counts = np.unique(
+            hashes.view(row_dtype).ravel(),
+            return_index=True,
+            return_inverse=True,
+            return_counts=True,
+        )
+        # store.ids are sorted, so the first row has the lowest ord_id
+        by_first_row = np.argsort(first_rows)
+        group_numbers = np.empty_like(by_first_row)
+        group_numbers[by_first_row] = np.arange(len(by_first_row))
+        counts = counts[by_first_row].astype(INDEX_DTYPE)
+        groups = group_numbers[inverse.ravel()].astype(INDEX_DTYPE)
+        offsets = np.zeros(len(counts) + 1, dtype=INDEX_DTYPE)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(
+            store,
+            hashes[first_rows[by_first_row]],
+            counts,
+            groups,
+            np.argsort(groups, kind="stable").astype(INDEX_DTYPE),
+            offsets,
+        )
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def group_rows(self, group: int) -> np.ndarray:
+        start, end = self.offsets[group], self.offsets[group + 1]
+        return self.rows[start:end]
+
+
+def _write_sections(f: BinaryIO, sections: dict[bytes, np.ndarray]) -> None:
+    table = np.zeros(len(sections), dtype=SECTION_DTYPE)
+    start = f.tell() + len(SECTIONS_MAGIC) + 8 + table.nbytes
+    for i, (name, data) in enumerate(sections.items()):
+        table[i] = (name, start, data.size)
+        start += data.size * 8
+    f.write(SECTIONS_MAGIC)
+    f.write(np.array(len(sections), dtype="<u8").tobytes())
+    f.write(table.tobytes())
+    for name, data in sections.items():
+        f.write(np.ascontiguousarray(data, dtype=SECTION_DTYPES[name]).tobytes())
+
+
+def _read_sections(buffer: np.ndarray, start: int) -> dict[bytes, np.ndarray]:
+    """Sections following the hashes, by their names - none in older files."""
+    table_start = start + len(SECTIONS_MAGIC) + 8
+    if buffer[start:table_start][:8].tobytes() != SECTIONS_MAGIC:
+        return {}
+    count = int(buffer[start:table_start][8:].view("<u8")[0])
+    table_end = table_start + count * SECTION_DTYPE.itemsize
+    sections = {}
+    for name, data_start, item_count in (
+        buffer[table_start:table_end].view(SECTION_DTYPE).tolist()
+    ):
+        if name in SECTION_DTYPES:
+            data_end = data_start + item_count * 8
+            sections[name] = buffer[data_start:data_end].view(SECTION_DTYPES[name])
+    return sections
+
+
+def write_hash_store(
+    data: dict[str, str], path: str | Path = Config.HASH_STORE
+) -> None:
+    HashStore.from_str_data(data).write(path)
+
+
+def write_json_db(store: HashStore, path: str | Path = Config.AVERAGE_HASH_DB) -> None:
+    """Writes the store also in the JSON format, for the Rust consumers."""
+    tmp_path = Path(f"{path}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps({"data": store.to_str_data()}))
+    os.replace(tmp_path, path)
+
+
+def load_hash_store(path: str | Path = Config.HASH_STORE) -> HashStore:
+    return HashStore.load(path)
+
+
+def convert_json(json_file: str | Path, store_file: str | Path) -> HashStore:
+    with open(json_file, "rb") as f:
+        data = orjson.loads(f.read())["data"]
+    store = HashStore.from_str_data(data)
+    store.write(store_file)
+    return store
+
+
+def main(
+    json_file: Path = typer.Option(
+        Config.AVERAGE_HASH_DB, "-j", "--json-file", exists=True, help="JSON DB file"
+    ),
+    store_file: Path = typer.Option(
+        Config.HASH_STORE, "-s", "--store-file", help="Binary hash store to create"
+    ),
+) -> None:
+    store = convert_json(json_file, store_file)
+    print(f"Saved {len(store):_} hashes into {store_file}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Tuple
+
+from config import Config
+from hash_store import HashStore, load_hash_store
+
+# Identifies one version of the file - replacing it changes the inode
+FileId = Tuple[int, int, int, int]
+
+
+class HashStoreReloader:
+    """Holds the current hash store and swaps in a new one when its file changes.
+
+    The new store is mapped and its version (from the header) compared
+    with the current one. Only a changed store is warmed up aside (whatever
+    warm_up builds on top of it), then it replaces
+    the current one in a single assignment. Requests
+    that already took the old store keep using it until they finish -
+    the files are replaced atomically, so the old mapping stays valid.
+
+    The shared memory file is preferred, unless the file on disk is newer -
+    e.g. it was compacted or rebuilt without being published again.
+    """
+
+    def __init__(
+        self,
+        on_swap: Callable[[HashStore], None] | None = None,
+        warm_up: Callable[[HashStore], None] | None = None,
+        shared_file: str | Path = Config.SHARED_HASH_STORE,
+        store_file: str | Path = Config.HASH_STORE,
+    ) -> None:
+        self.on_swap = on_swap
+        self.warm_up = warm_up
+        self.shared_file = Path(shared_file)
+        self.store_file = Path(store_file)
+        self.reload_count = 0
+        self._reload_lock = threading.Lock()
+        # Starting quickly - the warm-up of the first store is left
+        # for warm_up_current, to be run in the background
+        self._file_id, self._store = self._load()
+
+    @property
+    def store(self) -> HashStore:
+        return self._store
+
+    def reload_if_changed(self) -> bool:
+        """Reloads the store when the file was replaced, returns whether it did."""
+        if self._current_file_id() == self._file_id:
+            return False
+        return self.reload()
+
+    def reload(self) -> bool:
+        """Loads the store again and swaps it in, unless it is already reloading."""
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            file_id, store = self._load()
+            if store.version == self._store.version:
+                # Same data published again, nothing to warm up
+                self._file_id = file_id
+                return False
+            if self.warm_up is not None:
+                self.warm_up(store)
+            self._file_id, self._store = file_id, store
+            self.reload_count += 1
+            if self.on_swap is not None:
+                self.on_swap(store)
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def warm_up_current(self) -> None:
+        if self.warm_up is not None:
+            self.warm_up(self._store)
+
+    def stats(self) -> dict:
+        return {
+            "file": str(self._source_file()),
+            "entries": len(self._store),
+            "max_id": self._store.max_id(),
+            "version": self._store.version,
+            "reload_count": self.reload_count,
+        }
+
+    def _load(self) -> tuple[FileId | None, HashStore]:
+        path = self._source_file()
+        # Opening the file first, so the id belongs to the data we map
+        with open(path, "rb") as f:
+            file_id = _file_id(os.fstat(f.fileno()))
+            store = load_hash_store(path)
+        # Files in the old format have no version in the header,
+        # computing it reads the whole file
+        store.version
+        return file_id, store
+
+    def _source_file(self) -> Path:
+        try:
+            shared_mtime = self.shared_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return self.store_file
+        try:
+            if self.store_file.stat().st_mtime_ns > shared_mtime:
+                return self.store_file
+        except FileNotFoundError:
+            pass
+        return self.shared_file
+
+    def _current_file_id(self) -> FileId | None:
+        try:
+            return _file_id(os.stat(self._source_file()))
+        except FileNotFoundError:
+            return None
+
+
+def _file_id(stat: os.stat_result) -> FileId:
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
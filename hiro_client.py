@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Tuple
+
+import requests  # type: ignore
+from requests.adapters import HTTPAdapter  # type: ignore
+
+HIRO_API = "https://api.hiro.so/ordinals/v1/inscriptions"
+
+# Responses worth retrying - rate limited or server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Inscription metadata from Hiro, with its content (None when not downloaded)
+EntryWithContent = Tuple[dict, Optional[bytes]]
+
+
+class RateLimiter:
+    """Spaces out the requests from all the threads evenly."""
+
+    def __init__(self, requests_per_second: float) -> None:
+        self.interval = 1 / requests_per_second if requests_per_second else 0.0
+        self._next_allowed = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            allowed = max(now, self._next_allowed)
+            self._next_allowed = allowed + self.interval
+        if allowed > now:
+            time.sleep(allowed - now)
+
+
+class HiroClient:
+    """Client for the Hiro ordinals API with pooled keep-alive connections.
+
+    All the requests share one rate limit, and failed ones (connection
+    errors, 429 and 5xx responses) are retried with exponential backoff
+    and full jitter.
+
+    base_url can point to any server with the same endpoints, e.g. a local
+    stand-in for testing.
+    """
+
+    def __init__(
+        self,
+        base_url: str = HIRO_API,
+        max_workers: int = 8,
+        requests_per_second: float = 10,
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        timeout: float = 30.0,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def content_url(self, ord_id: int | str) -> str:
+        return f"{self.base_url}/{ord_id}/content"
+
+    def get_inscriptions(
+        self, from_number: int, to_number: int | None = None, limit: int = 60
+    ) -> dict:
+        params: dict = {"limit": limit, "from_number": from_number}
+        if to_number is not None:
+            params["to_number"] = to_number
+        r = self._get(self.base_url, params)
+        r.raise_for_status()
+        return r.json()
+
+    def get_by_ord_id(self, ord_id: int | str) -> dict:
+        data = self.get_inscriptions(int(ord_id), int(ord_id), limit=1)
+        return data["results"][0]
+
+    def get_by_tx_id(self, tx_id: str) -> dict | None:
+        r = self._get(f"{self.base_url}/{tx_id}i0")
+        if r.status_code == 200:
+            return r.json()
+        return None
+
+    def get_content(self, ord_id: int | str) -> bytes | None:
+        r = self._get(self.content_url(ord_id))
+        if r.status_code == 200:
+            return r.content
+        return None
+
+    def iter_pages_with_content(
+        self,
+        from_number: int,
+        to_number: int,
+        page_size: int = 60,
+        prefetch_pages: int = 2,
+        want_content: Callable[[dict], bool] = lambda entry: True,
+    ) -> Iterator[list[EntryWithContent]]:
+        """Yields all the inscriptions in the range page by page, with contents.
+
+        Metadata of the following pages and contents of up to prefetch_pages
+        next pages are downloaded in parallel while the caller processes
+        the current page.
+        """
+        page_starts = iter(range(from_number, to_number + 1, page_size))
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+
+            def start_page() -> Future[dict] | None:
+                start = next(page_starts, None)
+                if start is None:
+                    return None
+                end = min(start + page_size - 1, to_number)
+                return pool.submit(self.get_inscriptions, start, end, page_size)
+
+            metadata_pages: deque[Future[dict]] = deque()
+            for _ in range(prefetch_pages + 1):
+                page = start_page()
+                if page is not None:
+                    metadata_pages.append(page)
+
+            content_pages: deque[list[tuple[dict, Future | None]]] = deque()
+            while metadata_pages or content_pages:
+                while metadata_pages and len(content_pages) <= prefetch_pages:
+                    # Not holding back the pages we have for a later one,
+                    # e.g. when it failed the caller still gets all before it
+                    next_page = metadata_pages[0]
+                    if content_pages and not _succeeded(next_page):
+                        break
+                    entries = metadata_pages.popleft().result()["results"]
+                    content_pages.append(
+                        [
+                            (
+                                entry,
+                                (
+                                    pool.submit(self.get_content, entry["number"])
+                                    if want_content(entry)
+                                    else None
+                                ),
+                            )
+                            for entry in entries
+                        ]
+                    )
+                    page = start_page()
+                    if page is not None:
+                        metadata_pages.append(page)
+
+                yield [
+                    (entry, content.result() if content is not None else None)
+                    for entry, content in content_pages.popleft()
+                ]
+
+    def _get(self, url: str, params: dict | None = None) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            if r.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return r
+            time.sleep(self._backoff(attempt, r.headers.get("Retry-After")))
+        raise AssertionError("unreachable")
+
+    def _backoff(self, attempt: int, retry_after: str | None = None) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+
+def _succeeded(future: Future) -> bool:
+    return future.done() and future.exception() is None
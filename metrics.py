@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+# Seconds - from cache hits up to slow Hiro downloads
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Stages of the current request, as (name, seconds), for its Server-Timing header
+_request_timings: ContextVar[Optional[list]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+class Counter:
+    """Prometheus counter, optionally split by labels."""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _label_values(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Histogram:
+    """Prometheus histogram with fixed buckets, optionally split by labels."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label values - counts of every bucket (plus +Inf), and the sum
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_values(self.label_names, labels)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bucket] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, counts in sorted(self._counts.items()):
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if upper_bound == float("inf") else str(upper_bound)
+                    labels = _format_labels(self.label_names + ("le",), key + (le,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {self._sums[key]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Prometheus gauge, optionally split by labels."""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = _label_values(self.label_names, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+REGISTRY: list[Counter | Gauge | Histogram] = []
+
+REQUEST_DURATION = Histogram(
+    "ordsim_request_duration_seconds",
+    "Duration of the whole API request",
+    ("endpoint", "status"),
+)
+STAGE_DURATION = Histogram(
+    "ordsim_stage_duration_seconds",
+    "Duration of one stage of the API request",
+    ("stage", "backend"),
+)
+STARTUP_DURATION = Gauge(
+    "ordsim_startup_seconds",
+    "Seconds from the process start until the given startup phase",
+    ("phase",),
+)
+EVENTS = Counter(
+    "ordsim_events_total",
+    "Notable events, e.g. falling back from the Rust server",
+    ("event",),
+)
+
+
+@contextmanager
+def timed(stage: str, backend: str = "") -> Iterator[None]:
+    """Records the duration of the block, also into the current request's timings."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, backend)
+
+
+def record_stage(stage: str, seconds: float, backend: str = "") -> None:
+    STAGE_DURATION.observe(seconds, stage=stage, backend=backend)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((f"{stage}_{backend}" if backend else stage, seconds))
+
+
+def start_request_timings() -> list:
+    """Starts collecting the stages of the current request.
+
+    The list is shared, so stages recorded in worker threads
+    (which get a copy of the context) end up in it as well.
+    """
+    timings: list = []
+    _request_timings.set(timings)
+    return timings
+
+
+def server_timing_header(timings: list, total: float) -> str:
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+def process_uptime() -> float | None:
+    """Seconds since the start of this process, None when unknown (not Linux)."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the fields after the command name, starttime being the 22nd field
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+def record_startup_phase(phase: str) -> float | None:
+    seconds = process_uptime()
+    if seconds is not None:
+        STARTUP_DURATION.set(seconds, phase=phase)
+    return seconds
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _label_values(label_names: tuple[str, ...], labels: dict) -> tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in label_names)
+
+
+def _format_labels(label_names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not label_names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(label_names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Optional
+
+import numpy as np  # type: ignore
+import typer
+
+from common import Match, path_to_hash
+from config import Config
+from get_matches_numpy import HASH_LENGTH, get_match_sums, top_n_indices
+from hash_store import HashStore, load_hash_store, str_hash_to_words
+
+# Each hash is split into 16-bit substrings, each having its own table
+SUBSTRING_BITS = 16
+SUBSTRING_DTYPE = np.dtype("<u2")
+SUBSTRING_VALUES = 1 << SUBSTRING_BITS
+
+# All the 16-bit masks, grouped by the number of their set bits
+_ALL_MASKS = np.arange(SUBSTRING_VALUES, dtype=np.int64)
+_MASK_BITS = np.array([bin(mask).count("1") for mask in range(SUBSTRING_VALUES)])
+MASKS_BY_DISTANCE = [_ALL_MASKS[_MASK_BITS == r] for r in range(SUBSTRING_BITS + 1)]
+
+
+class MultiIndexHash:
+    """Exact Hamming search over the hash store using multi-index hashing.
+
+    When two hashes differ in fewer than m * (r + 1) bits, at least one
+    of their m substrings differs in at most r bits. So probing all the
+    substring tables with increasing radius r finds all the closest hashes
+    first, and the search can stop as soon as the best ones are certain.
+
+    Inverse matches (e.g. 11111111 and 00000000) are found by probing
+    also with the complemented query.
+
+    Docs about the approach:
+    https://www.cs.toronto.edu/~norouzi/research/papers/multi_index_hashing.pdf
+    """
+
+    def __init__(self, store: HashStore) -> None:
+        self.store = store
+        substrings = _to_substrings(store.hashes)
+        self.substring_count = substrings.shape[1]
+        # For every table, indices of hashes sorted by their substring value,
+        # and the offsets where each substring value starts in them
+        self.orders: list[np.ndarray] = []
+        self.offsets: list[np.ndarray] = []
+        for column in substrings.T:
+            order = np.argsort(column, kind="stable").astype(np.uint32)
+            counts = np.bincount(column, minlength=SUBSTRING_VALUES)
+            offsets = np.zeros(SUBSTRING_VALUES + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            self.orders.append(order)
+            self.offsets.append(offsets)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def get_matches(
+        self, ord_id: str | None, file_hash: str | None, top_n: int = 20
+    ) -> list[Match]:
+        query = self._get_query(ord_id, file_hash)
+        if query is None:
+            return []
+        top_n = min(top_n, len(self))
+
+        seen = np.zeros(len(self), dtype=bool)
+        indices = np.zeros(0, dtype=np.int64)
+        match_sums = np.zeros(0, dtype=np.int64)
+        for radius in range(SUBSTRING_BITS // 2 + 1):
+            new_indices = self._probe(query, radius, seen)
+            indices = np.concatenate((indices, new_indices))
+            match_sums = np.concatenate(
+                (match_sums, get_match_sums(self.store.hashes[new_indices], query))
+            )
+            # Everything not seen yet has match_sum below this bound
+            unseen_bound = HASH_LENGTH - self.substring_count * (radius + 1) + 1
+            if np.count_nonzero(match_sums >= unseen_bound) >= top_n:
+                break
+
+        # Sorting by index first, so the ties are resolved as in a linear scan
+        by_index = np.argsort(indices)
+        indices = indices[by_index]
+        match_sums = match_sums[by_index]
+        best = top_n_indices(match_sums, top_n)
+        return self._to_matches(indices[best], match_sums[best])
+
+    def get_matches_within(
+        self, ord_id: str | None, file_hash: str | None, min_match_sum: int
+    ) -> list[Match]:
+        """Gets all the matches with match_sum at least min_match_sum, best first."""
+        query = self._get_query(ord_id, file_hash)
+        if query is None:
+            return []
+
+        max_distance = HASH_LENGTH - min_match_sum
+        max_radius = min(max_distance // self.substring_count, SUBSTRING_BITS // 2)
+        seen = np.zeros(len(self), dtype=bool)
+        indices = np.concatenate(
+            [self._probe(query, radius, seen) for radius in range(max_radius + 1)]
+        )
+        indices.sort()
+        match_sums = get_match_sums(self.store.hashes[indices], query)
+        within = match_sums >= min_match_sum
+        indices = indices[within]
+        match_sums = match_sums[within]
+        best = top_n_indices(match_sums, len(match_sums))
+        return self._to_matches(indices[best], match_sums[best])
+
+    def _get_query(
+        self, ord_id: str | None, file_hash: str | None
+    ) -> np.ndarray | None:
+        if ord_id:
+            return self.store.get_words(ord_id)
+        assert file_hash is not None
+        return str_hash_to_words(file_hash)
+
+    def _probe(self, query: np.ndarray, radius: int, seen: np.ndarray) -> np.ndarray:
+        """Indices of not yet seen hashes having some substring exactly radius bits
+        away from the query or its complement. Marks them as seen."""
+        masks = MASKS_BY_DISTANCE[radius]
+        found = []
+        for query_variant in (query, ~query):
+            query_substrings = _to_substrings(query_variant[None, :])[0]
+            for table, value in enumerate(query_substrings.tolist()):
+                found.append(self._lookup(table, value ^ masks))
+        candidates = np.unique(np.concatenate(found))
+        candidates = candidates[~seen[candidates]]
+        seen[candidates] = True
+        return candidates
+
+    def _lookup(self, table: int, values: np.ndarray) -> np.ndarray:
+        """Indices of all hashes having one of the values in the given table."""
+        offsets = self.offsets[table]
+        starts = offsets[values]
+        lengths = offsets[values + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Concatenating all the [start, start + length) ranges at once
+        range_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(total) + np.repeat(starts - range_starts, lengths)
+        return self.orders[table][positions].astype(np.int64)
+
+    def _to_matches(self, indices: np.ndarray, match_sums: np.ndarray) -> list[Match]:
+        return [
+            {"ord_id": str(ord_id), "match_sum": match_sum}
+            for ord_id, match_sum in zip(
+                self.store.ids[indices].tolist(), match_sums.tolist()
+            )
+        ]
+
+
+def _to_substrings(hashes: np.ndarray) -> np.ndarray:
+    """Splits the (N, words) uint64 hashes into (N, substrings) 16-bit values."""
+    words = np.ascontiguousarray(hashes, dtype=np.dtype("<u8"))
+    return words.view(SUBSTRING_DTYPE).reshape(len(words), -1)
+
+
+def main(
+    store_file: Path = typer.Option(
+        Config.HASH_STORE, "-s", "--store-file", exists=True, help="Hash store file"
+    ),
+    custom_file: Optional[Path] = typer.Option(
+        None, "-c", "--custom-file", exists=True, help="Custom file"
+    ),
+    ord_id: Optional[str] = typer.Option(None, "-o", "--ord-id", help="Ordinal ID"),
+    file_hash: Optional[str] = typer.Option(
+        None, "-f", "--file-hash", help="Hash of the file"
+    ),
+    top_n: int = typer.Option(20, "-n", "--top-n", help="Number of matches to return"),
+    min_match_sum: Optional[int] = typer.Option(
+        None, "-m", "--min-match-sum", help="Return all matches at least this similar"
+    ),
+) -> None:
+    if custom_file is not None:
+        file_hash = path_to_hash(custom_file)
+    index = MultiIndexHash(load_hash_store(store_file))
+    if min_match_sum is not None:
+        matches = index.get_matches_within(ord_id, file_hash, min_match_sum)
+    else:
+        matches = index.get_matches(ord_id, file_hash, top_n)
+    for match in matches:
+        print(match)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import json
+import os
+import random
+import sqlite3
+from pathlib import Path
+
+import numpy as np  # type: ignore
+import typer
+
+from common import Match
+from config import Config
+from get_matches_numpy import get_matches_from_store
+from hash_store import HashStore, load_hash_store
+
+# File layout (all little-endian):
+#   magic (8 bytes) | first ord_id (int64) | rows (uint64) | neighbors per row (uint64)
+#   neighbor ord_ids (int32 * rows * K), row i belonging to first ord_id + i
+#   match_sums (uint16 * rows * K), best first, 0 marking an empty slot
+MAGIC = b"ORDNBR01"
+HEADER_DTYPE = np.dtype(
+    [("magic", "S8"), ("first_id", "<i8"), ("rows", "<u8"), ("k", "<u8")]
+)
+NEIGHBOR_ID_DTYPE = np.dtype("<i4")
+SCORE_DTYPE = np.dtype("<u2")
+
+DEFAULT_K = 20
+# How many rows are read from the SQLite DB at once when converting
+CONVERT_BATCH_SIZE = 100_000
+
+
+class NeighborTable:
+    """Precomputed top K matches of every ordinal, in fixed-width rows.
+
+    Rows are addressed directly by the ord_id offset, so a lookup is
+    just an array slice. When loaded from a file, both arrays are
+    read-only memory maps.
+    """
+
+    def __init__(self, first_id: int, neighbor_ids: np.ndarray, scores: np.ndarray):
+        assert neighbor_ids.shape == scores.shape
+        self.first_id = first_id
+        self.neighbor_ids = neighbor_ids
+        self.scores = scores
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    @property
+    def k(self) -> int:
+        return self.scores.shape[1]
+
+    def __contains__(self, ord_id: int) -> bool:
+        row = self._row(ord_id)
+        return row is not None and bool(self.scores[row, 0])
+
+    def get(self, ord_id: int, top_n: int = DEFAULT_K) -> list[Match] | None:
+        """Top matches of the ordinal, or None when it is not in the table."""
+        row = self._row(ord_id)
+        if row is None or not self.scores[row, 0]:
+            return None
+        scores = self.scores[row, :top_n]
+        filled = int(np.count_nonzero(scores))
+        return [
+            {"ord_id": str(neighbor_id), "match_sum": match_sum}
+            for neighbor_id, match_sum in zip(
+                self.neighbor_ids[row, :filled].tolist(), scores[:filled].tolist()
+            )
+        ]
+
+    @classmethod
+    def load(cls, path: str | Path) -> "NeighborTable":
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        header = buffer[: HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header["magic"] != MAGIC:
+            raise ValueError(f"Not a neighbor table file: {path}")
+        rows = int(header["rows"])
+        k = int(header["k"])
+        ids_start = HEADER_DTYPE.itemsize
+        scores_start = ids_start + rows * k * NEIGHBOR_ID_DTYPE.itemsize
+        scores_end = scores_start + rows * k * SCORE_DTYPE.itemsize
+        neighbor_ids = buffer[ids_start:scores_start].view(NEIGHBOR_ID_DTYPE)
+        scores = buffer[scores_start:scores_end].view(SCORE_DTYPE)
+        return cls(
+            int(header["first_id"]),
+            neighbor_ids.reshape(rows, k),
+            scores.reshape(rows, k),
+        )
+
+    def _row(self, ord_id: int) -> int | None:
+        row = int(ord_id) - self.first_id
+        if 0 <= row < len(self):
+            return row
+        return None
+
+
+def load_neighbor_table(path: str | Path = Config.NEIGHBOR_TABLE) -> NeighborTable:
+    return NeighborTable.load(path)
+
+
+def convert_similarity_db(
+    db_file: str | Path = Config.SIMILARITY_INDEX_DB,
+    table_file: str | Path = Config.NEIGHBOR_TABLE,
+    k: int = DEFAULT_K,
+) -> NeighborTable:
+    """Writes all the rows of the similarity index DB into a neighbor table file.
+
+    The file is filled through a writable memory map, row batch by row batch,
+    so the whole table never needs to be in memory.
+    """
+    db = sqlite3.connect(db_file)
+    first_id, last_id = db.execute(
+        "SELECT MIN(id), MAX(id) FROM similarity_index"
+    ).fetchone()
+    if first_id is None:
+        first_id, last_id = 0, -1
+    rows = last_id - first_id + 1
+
+    header = np.array([(MAGIC, first_id, rows, k)], dtype=HEADER_DTYPE)
+    ids_start = HEADER_DTYPE.itemsize
+    scores_start = ids_start + rows * k * NEIGHBOR_ID_DTYPE.itemsize
+    size = scores_start + rows * k * SCORE_DTYPE.itemsize
+
+    # Writing into a temporary file and renaming it, so that readers
+    # having the old file mapped are not affected
+    tmp_path = Path(f"{table_file}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(header.tobytes())
+        f.truncate(size)  # sparse, all zeros - empty slots
+    if rows:
+        buffer = np.memmap(tmp_path, dtype=np.uint8, mode="r+")
+        neighbor_ids = buffer[ids_start:scores_start].view(NEIGHBOR_ID_DTYPE)
+        neighbor_ids = neighbor_ids.reshape(rows, k)
+        scores = buffer[scores_start:size].view(SCORE_DTYPE).reshape(rows, k)
+        cursor = db.execute("SELECT id, list_of_lists FROM similarity_index")
+        while batch := cursor.fetchmany(CONVERT_BATCH_SIZE):
+            for ord_id, list_of_lists in batch:
+                matches = json.loads(list_of_lists)[:k]
+                if matches:
+                    row = ord_id - first_id
+                    row_ids, row_scores = zip(*matches)
+                    neighbor_ids[row, : len(matches)] = row_ids
+                    scores[row, : len(matches)] = row_scores
+        buffer.flush()
+        del buffer, neighbor_ids, scores
+    db.close()
+    os.replace(tmp_path, table_file)
+    return load_neighbor_table(table_file)
+
+
+def check_against_store(
+    table: NeighborTable, store: HashStore, samples: int = 100
+) -> list[int]:
+    """Compares random rows of the table with the live search, returns the
+    ord_ids whose match_sums differ.
+
+    Only the match_sums are compared - ordinals with the same match_sum
+    may be ordered differently.
+    """
+    candidates = random.sample(store.ids.tolist(), min(samples, len(store)))
+    mismatches = []
+    for ord_id in candidates:
+        matches = table.get(ord_id, table.k)
+        if matches is None:
+            continue
+        live = get_matches_from_store(store, str(ord_id), None, table.k)
+        if [m["match_sum"] for m in matches] != [m["match_sum"] for m in live]:
+            mismatches.append(ord_id)
+    return mismatches
+
+
+def main(
+    db_file: Path = typer.Option(
+        Config.SIMILARITY_INDEX_DB, "-d", "--db-file", help="Similarity index DB"
+    ),
+    table_file: Path = typer.Option(
+        Config.NEIGHBOR_TABLE, "-t", "--table-file", help="Neighbor table to create"
+    ),
+    convert: bool = typer.Option(
+        True, "--convert/--no-convert", help="Create the table from the DB"
+    ),
+    check_samples: int = typer.Option(
+        100, "-c", "--check-samples", help="Ordinals to compare with live search"
+    ),
+) -> None:
+    if convert:
+        table = convert_similarity_db(db_file, table_file)
+        print(f"Saved {len(table):_} rows into {table_file}")
+    else:
+        table = load_neighbor_table(table_file)
+    if check_samples:
+        mismatches = check_against_store(table, load_hash_store(), check_samples)
+        print(f"{len(mismatches)} of {check_samples} checked rows differ: {mismatches}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+
+# How many tasks may be waiting for the workers, per worker
+IN_FLIGHT_PER_WORKER = 2
+
+T = TypeVar("T")
+
+
+def map_bounded(
+    pool: Executor,
+    fn: Callable[..., T],
+    tasks: Iterable[tuple],
+    max_in_flight: int,
+) -> Iterator[T]:
+    """Results of fn(*args) for all the tasks, in the order they finish.
+
+    Unlike pool.map, new tasks are taken from the (lazy) tasks iterable
+    only when fewer than max_in_flight are waiting, so their inputs are
+    not all read into memory before the workers can handle them.
+    """
+    in_flight: set[Future[T]] = set()
+    for args in tasks:
+        in_flight.add(pool.submit(fn, *args))
+        if len(in_flight) >= max_in_flight:
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()
+    while in_flight:
+        finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+            yield future.result()
+
+
+def read_progress_lines(progress_file: Path) -> list[str]:
+    """Lines saved into progress_file by the previous runs, if any."""
+    if not progress_file.exists():
+        return []
+    with open(progress_file) as f:
+        # the last line may be incomplete, when the run was interrupted
+        return f.read().split("\n")[:-1]
+
+
+def log_speed(
+    logger: logging.Logger,
+    what: str,
+    done_count: int,
+    started: float,
+    total: int | None = None,
+) -> None:
+    elapsed = time.perf_counter() - started
+    speed = done_count / elapsed if elapsed else 0.0
+    out_of = f" / {total:_}" if total is not None else ""
+    logger.info(f"Processed {done_count:_}{out_of} {what}, {speed:.1f} {what}/second")
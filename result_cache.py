@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+import orjson
+
+
+class ResultCache:
+    """Thread-safe LRU cache of finished API results, with TTL.
+
+    Every entry belongs to a dataset version (see HashStore.version),
+    and changing the version drops all the entries of the old one.
+    Optionally, entries are also persisted in a local SQLite file,
+    so they survive API restarts.
+    """
+
+    def __init__(
+        self,
+        version: str,
+        max_size: int = 10_000,
+        ttl_seconds: float = 60 * 60,
+        db_path: str | Path | None = None,
+    ) -> None:
+        self.version = version
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache "
+                "(key TEXT PRIMARY KEY, version TEXT, created REAL, value BLOB)"
+            )
+            self._delete_other_versions()
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        return ":".join(str(part) for part in parts)
+
+    def get(self, key: str, version: str | None = None) -> Any | None:
+        """Cached value, if any - when version is given, only from that version."""
+        with self._lock:
+            if version is not None and version != self.version:
+                self.misses += 1
+                return None
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                entry = self._get_from_db(key)
+                if entry is not None:
+                    self._remember(key, entry)
+            if entry is None or self._is_expired(entry[0]):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: Any, version: str | None = None) -> None:
+        """Caches the value - when version is given, only if it is still the current one.
+
+        Requests that started before the data changed must not store
+        their (old) results under the new version.
+        """
+        created = time.time()
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._remember(key, (created, value))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?)",
+                    (key, self.version, created, orjson.dumps(value)),
+                )
+                self._db.commit()
+
+    def set_version(self, version: str) -> None:
+        """Invalidates all the entries, when the underlying data has changed."""
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            self._entries.clear()
+            if self._db is not None:
+                self._delete_other_versions()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "version": self.version,
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+    def _remember(self, key: str, entry: tuple[float, Any]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _is_expired(self, created: float) -> bool:
+        return time.time() - created > self.ttl_seconds
+
+    def _get_from_db(self, key: str) -> tuple[float, Any] | None:
+        assert self._db is not None
+        row = self._db.execute(
+            "SELECT created, value FROM result_cache WHERE key = ? AND version = ?",
+            (key, self.version),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], orjson.loads(row[1])
+
+    def _delete_other_versions(self) -> None:
+        assert self._db is not None
+        self._db.execute("DELETE FROM result_cache WHERE version != ?", (self.version,))
+        self._db.commit()
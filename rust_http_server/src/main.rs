@@ -46,31 +46,41 @@ struct MatchItem {
     match_sum: usize,
 }
 
+#[derive(Debug, Deserialize)]
+struct SearchParams {
+    #[serde(default = "default_top_n")]
+    top_n: usize,
+}
+
+fn default_top_n() -> usize {
+    20
+}
+
 #[derive(Debug, Serialize, Deserialize)]
 struct Db {
     data: HashMap<String, BigUintWrapper>,
 }
 
-async fn ord_id_handler(ord_id: web::Path<String>, db: web::Data<Db>) -> impl Responder {
+async fn ord_id_handler(ord_id: web::Path<String>, params: web::Query<SearchParams>, db: web::Data<Db>) -> impl Responder {
     let file_hash_int: BigUint = if let Some(value) = db.data.get(ord_id.as_str()) {
         value.0.clone()
     } else {
         // If the ord_id is not found, return an empty array
         return HttpResponse::Ok().body("[]".to_string());
     };
-    let top_matches = get_top_matches(file_hash_int, &db.data);
+    let top_matches = get_top_matches(file_hash_int, &db.data, params.top_n);
     let ret_value = serde_json::to_string(&top_matches).expect("Failed to serialize to JSON");
     HttpResponse::Ok().body(ret_value)
 }
 
-async fn file_hash_handler(file_hash: web::Path<String>, db: web::Data<Db>) -> impl Responder {
+async fn file_hash_handler(file_hash: web::Path<String>, params: web::Query<SearchParams>, db: web::Data<Db>) -> impl Responder {
     let file_hash_int = binary_string_to_big_uint(file_hash.as_str());
-    let top_matches = get_top_matches(file_hash_int, &db.data);
+    let top_matches = get_top_matches(file_hash_int, &db.data, params.top_n);
     let ret_value = serde_json::to_string(&top_matches).expect("Failed to serialize to JSON");
     HttpResponse::Ok().body(ret_value)
 }
 
-fn get_top_matches(file_hash: BigUint, data: &HashMap<String, BigUintWrapper>) -> Vec<MatchItem> {
+fn get_top_matches(file_hash: BigUint, data: &HashMap<String, BigUintWrapper>, top_n: usize) -> Vec<MatchItem> {
     let mut matches: Vec<MatchItem> = Vec::new();
     for (ord_id, wrapped_hash) in data {
         let distance = hamming_distance(&file_hash, &wrapped_hash.0);
@@ -78,7 +88,7 @@ fn get_top_matches(file_hash: BigUint, data: &HashMap<String, BigUintWrapper>) -
         matches.push(MatchItem { ord_id: ord_id.to_string(), match_sum });
     }
     matches.sort_by(|a, b| b.match_sum.cmp(&a.match_sum));
-    let top_matches = &matches[..20];
+    let top_matches = &matches[..top_n.min(matches.len())];
     top_matches.to_vec()
 }
 
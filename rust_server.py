@@ -1,21 +1,153 @@
 from __future__ import annotations
 
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import requests  # type: ignore
+from requests.adapters import HTTPAdapter  # type: ignore
 
 from common import Match
 from config import Config
+from metrics import EVENTS
+
+# It runs on the same machine - when it does not connect quickly, it is down
+CONNECT_TIMEOUT = 0.25
+READ_TIMEOUT = 2
+# Consecutive failures after which the server is not asked for a while
+FAILURE_THRESHOLD = 3
+OPEN_SECONDS = 10
+# Sending the same request again when the first one is unusually slow
+HEDGE_AFTER_SECONDS = 0.15
+# Connections kept alive - roughly the number of API threads searching at once
+POOL_SIZE = 32
+
+
+class RustServerUnavailable(Exception):
+    """The circuit is open - the server failed recently, so it is not asked."""
+
+
+class RustServerClient:
+    """Keep-alive client of the Rust server, with a circuit breaker.
+
+    After FAILURE_THRESHOLD consecutive failures the circuit opens and
+    all the calls fail immediately with RustServerUnavailable, so the
+    caller falls back to the local search without waiting for timeouts.
+    After open_seconds, one call is let through as a health check -
+    its success closes the circuit, its failure opens it again.
+
+    When the server does not answer within hedge_after seconds, the same
+    request is sent once more and the quicker response is taken.
+    """
+
+    def __init__(
+        self,
+        base_url: str = Config.RUST_API_URL,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        open_seconds: float = OPEN_SECONDS,
+        hedge_after: float | None = HEDGE_AFTER_SECONDS,
+        pool_size: int = POOL_SIZE,
+    ) -> None:
+        self.base_url = base_url
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.hedge_after = hedge_after
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # Both the requests of a hedged call are sent from here
+        self._executor = ThreadPoolExecutor(pool_size, thread_name_prefix="rust")
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    def get_matches(
+        self, ord_id: int | None, file_hash: str | None, top_n: int
+    ) -> list[Match]:
+        if ord_id is not None:
+            endpoint = f"/ord_id/{ord_id}"
+        elif file_hash is not None:
+            endpoint = f"/file_hash/{file_hash}"
+        else:
+            raise ValueError("ord_id and file_hash are both None")
+
+        is_probe = self._before_call()
+        try:
+            matches = self._get_hedged(endpoint, {"top_n": top_n}, hedge=not is_probe)
+        except Exception:
+            self._on_failure(is_probe)
+            raise
+        self._on_success(is_probe)
+        return matches[:top_n]
+
+    def _before_call(self) -> bool:
+        """Raises when the circuit is open, returns whether this call is the probe."""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if self._probing or time.monotonic() - self._opened_at < self.open_seconds:
+                raise RustServerUnavailable(f"Rust server failed {self._failures}x")
+            self._probing = True
+            return True
+
+    def _on_success(self, is_probe: bool) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                EVENTS.inc(event="rust_circuit_closed")
+            self._failures = 0
+            self._opened_at = None
+            if is_probe:
+                self._probing = False
+
+    def _on_failure(self, is_probe: bool) -> None:
+        with self._lock:
+            self._failures += 1
+            if is_probe or (
+                self._opened_at is None and self._failures >= self.failure_threshold
+            ):
+                if self._opened_at is None:
+                    EVENTS.inc(event="rust_circuit_opened")
+                self._opened_at = time.monotonic()
+            # Calls started before the circuit opened may still be finishing,
+            # only the probe itself lets another probe through
+            if is_probe:
+                self._probing = False
+
+    def _get_hedged(self, endpoint: str, params: dict, hedge: bool) -> list[Match]:
+        pending = {self._executor.submit(self._get, endpoint, params)}
+        if hedge and self.hedge_after is not None:
+            finished, _ = wait(pending, timeout=self.hedge_after)
+            if not finished:
+                EVENTS.inc(event="rust_hedge")
+                pending.add(self._executor.submit(self._get, endpoint, params))
+        # The first successful response wins, errors count only when both fail
+        error: Exception | None = None
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        assert error is not None
+        raise error
+
+    def _get(self, endpoint: str, params: dict) -> list[Match]:
+        response = self._session.get(
+            self.base_url + endpoint,
+            params=params,
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+rust_server_client = RustServerClient()
 
 
 def get_matches_from_rust_server(
-    ord_id: int | None, file_hash: str | None
+    ord_id: int | None, file_hash: str | None, top_n: int = 20
 ) -> list[Match]:
-    if ord_id is not None:
-        endpoint = f"/ord_id/{ord_id}"
-    elif file_hash is not None:
-        endpoint = f"/file_hash/{file_hash}"
-    else:
-        raise ValueError("ord_id and file_hash are both None")
-
-    response = requests.get(Config.RUST_API_URL + endpoint, timeout=2)
-    response.raise_for_status()
-    return response.json()
+    return rust_server_client.get_matches(ord_id, file_hash, top_n)
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import typer
+
+from config import Config
+from hash_log import HashLog
+from hash_store import HashStore, write_json_db
+
+
+def publish_hash_store(
+    hash_log: HashLog | None = None,
+    shared_file: str | Path = Config.SHARED_HASH_STORE,
+) -> HashStore:
+    """Writes the hash store into shared memory (tmpfs), for all API workers to map.
+
+    It is the snapshot merged with all the pending hashes of the log,
+    so new hashes are searchable right after ingestion, not only once
+    enough of them are compacted. For the same reason the JSON DB
+    for the Rust consumers is rewritten when there are pending hashes.
+
+    Replacing the file atomically, so that workers having the old one
+    mapped can still use it until they attach to the new one.
+    """
+    hash_log = hash_log or HashLog()
+    store = hash_log.read()
+    store.write(shared_file)
+    if hash_log.json_file is not None and hash_log.pending_count():
+        write_json_db(store, hash_log.json_file)
+    return store
+
+
+def main(
+    shared_file: Path = typer.Option(
+        Config.SHARED_HASH_STORE, "--shared-file", help="Shared memory file"
+    ),
+) -> None:
+    store = publish_hash_store(shared_file=shared_file)
+    print(f"Published {len(store):_} hashes into {shared_file}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
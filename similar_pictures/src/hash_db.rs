@@ -0,0 +1,106 @@
+use std::cmp::Reverse;
+use std::collections::BinaryHeap;
+use std::fs;
+
+// Layout of the hash store file, see hash_store.py
+const MAGIC: &[u8; 8] = b"ORDHASH2";
+const MAGIC_V1: &[u8; 8] = b"ORDHASH1";
+const HEADER_SIZE: usize = 64;
+const HEADER_V1_SIZE: usize = 24;
+
+pub const HASH_WORDS: usize = 4;
+const HASH_LENGTH: u32 = 64 * HASH_WORDS as u32;
+
+type Hash = [u64; HASH_WORDS];
+
+/// Hash store loaded into memory once, to be searched many times
+pub struct HashDb {
+    ids: Vec<i64>,
+    hashes: Vec<Hash>,
+}
+
+impl HashDb {
+    pub fn load(file_path: &str) -> Result<HashDb, String> {
+        let data = fs::read(file_path).map_err(|e| format!("Unable to read {}: {}", file_path, e))?;
+        let header_size = match data.get(..8) {
+            Some(magic) if magic == MAGIC => HEADER_SIZE,
+            Some(magic) if magic == MAGIC_V1 => HEADER_V1_SIZE,
+            _ => return Err(format!("Not a hash store file: {}", file_path)),
+        };
+        if data.len() < header_size {
+            return Err(format!("Truncated hash store file: {}", file_path));
+        }
+        let count = read_u64(&data, 8) as usize;
+        let words = read_u64(&data, 16) as usize;
+        if words != HASH_WORDS {
+            return Err(format!("Expected {} words per hash, got {}", HASH_WORDS, words));
+        }
+        let hashes_start = header_size + count * 8;
+        if data.len() < hashes_start + count * HASH_WORDS * 8 {
+            return Err(format!("Truncated hash store file: {}", file_path));
+        }
+
+        let ids = (0..count)
+            .map(|i| read_u64(&data, header_size + i * 8) as i64)
+            .collect();
+        let hashes = (0..count)
+            .map(|i| {
+                let start = hashes_start + i * HASH_WORDS * 8;
+                let mut hash = [0; HASH_WORDS];
+                for (w, word) in hash.iter_mut().enumerate() {
+                    *word = read_u64(&data, start + w * 8);
+                }
+                hash
+            })
+            .collect();
+        Ok(HashDb { ids, hashes })
+    }
+
+    pub fn len(&self) -> usize {
+        self.ids.len()
+    }
+
+    pub fn get_hash(&self, ord_id: i64) -> Option<&Hash> {
+        self.ids.binary_search(&ord_id).ok().map(|index| &self.hashes[index])
+    }
+
+    /// Writes ord_ids and match_sums of the top_n best matches, best first,
+    /// returns how many were written.
+    ///
+    /// Same results as get_matches_numpy.get_matches_from_store - the match_sum
+    /// accounts for inverse matches, ties are won by the lower ord_id.
+    pub fn top_n(&self, query: &Hash, out_ids: &mut [i64], out_match_sums: &mut [i64]) -> usize {
+        let count = self.len() as u64;
+        let top_n = out_ids.len().min(out_match_sums.len()).min(self.len());
+        if top_n == 0 {
+            return 0;
+        }
+        // Unique keys - the higher match_sum, then the lower index wins.
+        // The heap holds the best keys so far, the worst of them on top.
+        let mut best: BinaryHeap<Reverse<u64>> = BinaryHeap::with_capacity(top_n + 1);
+        for (index, hash) in self.hashes.iter().enumerate() {
+            let different: u32 = hash.iter().zip(query).map(|(a, b)| (a ^ b).count_ones()).sum();
+            let match_sum = different.max(HASH_LENGTH - different) as u64;
+            let key = match_sum * count + (count - 1 - index as u64);
+            if best.len() < top_n {
+                best.push(Reverse(key));
+            } else if let Some(mut worst) = best.peek_mut() {
+                if key > worst.0 {
+                    *worst = Reverse(key);
+                }
+            }
+        }
+        // Ascending order of Reverse is descending order of the keys
+        for (i, Reverse(key)) in best.into_sorted_vec().into_iter().enumerate() {
+            out_ids[i] = self.ids[(count - 1 - key % count) as usize];
+            out_match_sums[i] = (key / count) as i64;
+        }
+        top_n
+    }
+}
+
+fn read_u64(data: &[u8], start: usize) -> u64 {
+    let mut bytes = [0; 8];
+    bytes.copy_from_slice(&data[start..start + 8]);
+    u64::from_le_bytes(bytes)
+}
@@ -1,9 +1,14 @@
 use std::ffi::{CStr, CString};
 use std::os::raw::{c_char, c_int};
+use std::ptr;
+use std::slice;
 
 mod get_matches;
 use get_matches::get_matches;
 
+mod hash_db;
+use hash_db::{HashDb, HASH_WORDS};
+
 #[no_mangle]
 /// # Safety
 /// 
@@ -21,3 +26,99 @@ pub unsafe extern "C" fn get_matches_c(json_file: *const c_char, ord_id: *const
     let c_string = CString::new(json_output).unwrap();
     c_string.into_raw()
 }
+
+#[no_mangle]
+/// Frees the string returned by get_matches_c
+///
+/// # Safety
+///
+/// The pointer must come from get_matches_c and must not be used afterwards.
+pub unsafe extern "C" fn free_matches_c(matches: *mut c_char) {
+    if !matches.is_null() {
+        drop(unsafe { CString::from_raw(matches) });
+    }
+}
+
+#[no_mangle]
+/// Loads the binary hash store file, returns null when it cannot be loaded
+///
+/// # Safety
+///
+/// This function is unsafe because it dereferences raw pointers.
+pub unsafe extern "C" fn hash_db_open(file_path: *const c_char) -> *mut HashDb {
+    let file_path = match unsafe { CStr::from_ptr(file_path).to_str() } {
+        Ok(file_path) => file_path,
+        Err(_) => return ptr::null_mut(),
+    };
+    match HashDb::load(file_path) {
+        Ok(db) => Box::into_raw(Box::new(db)),
+        Err(e) => {
+            eprintln!("{}", e);
+            ptr::null_mut()
+        }
+    }
+}
+
+#[no_mangle]
+/// # Safety
+///
+/// The handle must come from hash_db_open and must not be used afterwards.
+pub unsafe extern "C" fn hash_db_free(db: *mut HashDb) {
+    if !db.is_null() {
+        drop(unsafe { Box::from_raw(db) });
+    }
+}
+
+#[no_mangle]
+/// # Safety
+///
+/// The handle must come from hash_db_open.
+pub unsafe extern "C" fn hash_db_len(db: *const HashDb) -> usize {
+    unsafe { &*db }.len()
+}
+
+#[no_mangle]
+/// Copies the hash of the ord_id into out_hash (HASH_WORDS words),
+/// returns 0 when there is no such ord_id
+///
+/// # Safety
+///
+/// The handle must come from hash_db_open, out_hash must have room for the hash.
+pub unsafe extern "C" fn hash_db_get_hash(db: *const HashDb, ord_id: i64, out_hash: *mut u64) -> c_int {
+    match unsafe { &*db }.get_hash(ord_id) {
+        Some(hash) => {
+            unsafe { slice::from_raw_parts_mut(out_hash, HASH_WORDS) }.copy_from_slice(hash);
+            1
+        }
+        None => 0,
+    }
+}
+
+#[no_mangle]
+/// Searches the top_n matches of each of query_count hashes (HASH_WORDS words each),
+/// writing them into the (query_count, top_n) arrays, best first.
+/// Returns how many matches each query got - less than top_n for small stores.
+///
+/// # Safety
+///
+/// The handle must come from hash_db_open, the arrays must have the given sizes.
+pub unsafe extern "C" fn hash_db_top_n(
+    db: *const HashDb,
+    queries: *const u64,
+    query_count: usize,
+    top_n: usize,
+    out_ids: *mut i64,
+    out_match_sums: *mut i64,
+) -> usize {
+    let db = unsafe { &*db };
+    let queries = unsafe { slice::from_raw_parts(queries, query_count * HASH_WORDS) };
+    let out_ids = unsafe { slice::from_raw_parts_mut(out_ids, query_count * top_n) };
+    let out_match_sums = unsafe { slice::from_raw_parts_mut(out_match_sums, query_count * top_n) };
+    let mut written = top_n.min(db.len());
+    for (i, query) in queries.chunks_exact(HASH_WORDS).enumerate() {
+        let query = query.try_into().expect("Query of HASH_WORDS words");
+        let row = i * top_n..(i + 1) * top_n;
+        written = db.top_n(query, &mut out_ids[row.clone()], &mut out_match_sums[row]);
+    }
+    written
+}
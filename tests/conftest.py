@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import tempfile
+from pathlib import Path
+
+import numpy as np  # type: ignore
+import pytest
+
+from config import Config
+
+# Data files created by importing the tested modules go out of the repo
+# (before the modules are imported, so their default arguments use them)
+data_dir = Path(tempfile.mkdtemp(prefix="ordsim_tests_"))
+for name in (
+    "FILE_DB",
+    "ORD_DB",
+    "SIMILARITY_INDEX_DB",
+    "NEIGHBOR_TABLE",
+    "RESULT_CACHE_DB",
+    "AVERAGE_HASH_DB",
+    "HASH_STORE",
+    "HASH_LOG_DIR",
+    "SHARED_HASH_STORE",
+):
+    setattr(Config, name, data_dir / getattr(Config, name).name)
+
+from hash_store import HASH_WORDS, ID_DTYPE, WORD_DTYPE, HashStore  # noqa: E402
+
+
+def make_store(count: int = 2000, seed: int = 0, flipped_bits: int = 4) -> HashStore:
+    """Random store with many ties and groups of exactly the same hashes.
+
+    All the hashes differ from one base hash in about flipped_bits bits,
+    so with the few by default there are just a few distinct match_sums.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.sort(rng.choice(10 * count, count, replace=False)).astype(ID_DTYPE)
+    bits = np.tile(rng.random(HASH_WORDS * 64) < 0.5, (count, 1))
+    flips = rng.random(bits.shape) < flipped_bits / bits.shape[1]
+    bits ^= flips
+    # copies of a few pictures
+    bits[rng.choice(count, count // 10)] = bits[rng.choice(5, count // 10)]
+    hashes = np.packbits(bits, axis=1).view(">u8").astype(WORD_DTYPE)
+    return HashStore(ids, hashes)
+
+
+@pytest.fixture
+def store() -> HashStore:
+    return make_store()
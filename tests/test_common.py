@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import io
+
+import numpy as np  # type: ignore
+import pytest
+from PIL import Image  # type: ignore
+
+from common import ANTIALIAS, average_hash, bytes_to_hash
+from config import Config
+
+
+def average_hash_before(img: Image.Image, hash_size: int) -> str:
+    """average_hash as it was before building the string from the bit array."""
+    img = img.convert("L").resize((hash_size, hash_size), ANTIALIAS)
+    pixels = np.asarray(img)
+    avg = np.mean(pixels)
+    bool_array = pixels > avg
+    int_array = bool_array.flatten().astype(int)
+    return "".join(map(str, int_array))
+
+
+def generated_images() -> list[Image.Image]:
+    rng = np.random.default_rng(0)
+    images = []
+    for width, height in ((16, 16), (300, 200), (1000, 1500), (7, 3)):
+        noise = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        images.append(Image.fromarray(noise, "RGB"))
+        gradient = np.add.outer(np.arange(height), np.arange(width)) % 256
+        images.append(Image.fromarray(gradient.astype(np.uint8), "L"))
+    # the modes inscriptions come in, besides RGB and L
+    images.append(images[0].convert("RGBA"))
+    images.append(images[2].convert("P"))
+    images.append(images[2].convert("1"))
+    # a flat picture - no pixel above the average
+    images.append(Image.new("RGB", (50, 50), (120, 10, 200)))
+    return images
+
+
+def to_bytes(img: Image.Image, format: str) -> bytes:
+    buffer = io.BytesIO()
+    if format == "JPEG":
+        img = img.convert("RGB")
+    img.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("img", generated_images())
+def test_average_hash_same_as_before(img: Image.Image) -> None:
+    assert average_hash(img, Config.HASH_SIZE) == average_hash_before(
+        img, Config.HASH_SIZE
+    )
+
+
+@pytest.mark.parametrize("format", ["PNG", "JPEG", "GIF"])
+@pytest.mark.parametrize("img", generated_images())
+def test_bytes_to_hash_same_as_before(img: Image.Image, format: str) -> None:
+    data = to_bytes(img, format)
+    expected = average_hash_before(Image.open(io.BytesIO(data)), Config.HASH_SIZE)
+    assert bytes_to_hash(data) == expected
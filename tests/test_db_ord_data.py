@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import sqlite3
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+import db_ord_data
+from config import Config
+
+
+@pytest.fixture
+def db_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    db_file = tmp_path / "ord_data.db"
+    monkeypatch.setattr(Config, "ORD_DB", db_file)
+    db_ord_data.get_engine.cache_clear()
+    yield db_file
+    db_ord_data.get_engine.cache_clear()
+
+
+def index_names(db_file: Path) -> set[str]:
+    db = sqlite3.connect(db_file)
+    rows = db.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+    db.close()
+    return {name for name, in rows}
+
+
+def test_engine_creates_missing_indexes(db_file: Path) -> None:
+    db = sqlite3.connect(db_file)
+    # the table as created before the content_hash index was added
+    db.execute(
+        "CREATE TABLE inscriptions (id INTEGER PRIMARY KEY, tx_id TEXT, content_hash TEXT)"
+    )
+    db.execute("CREATE UNIQUE INDEX ix_inscriptions_id ON inscriptions (id)")
+    db.execute("INSERT INTO inscriptions VALUES (1, 'tx1', 'abc')")
+    db.commit()
+    db.close()
+
+    db_ord_data.get_engine()
+    assert "ix_inscriptions_content_hash" in index_names(db_file)
+    # already there - nothing to do the next time
+    db_ord_data.get_engine.cache_clear()
+    db_ord_data.get_engine()
+    assert db_ord_data.InscriptionModel.ids_by_content_hash("abc") == [1]
+
+
+def test_engine_without_table(db_file: Path) -> None:
+    db_ord_data.get_engine()
+    assert index_names(db_file) == set()
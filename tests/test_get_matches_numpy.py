@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from conftest import make_store
+
+from get_matches_numpy import get_matches_batch, get_matches_from_store
+from hash_store import HashStore
+
+
+def test_get_matches_batch_same_as_single_queries(store: HashStore) -> None:
+    rows = [0, 1, 7, 500, len(store) - 1]
+    matches = get_matches_batch(
+        store, store.hashes[rows], top_n=30, query_block_size=2, hash_block_size=300
+    )
+    for row, row_matches in zip(rows, matches):
+        assert row_matches == get_matches_from_store(
+            store, str(store.ids[row]), None, 30
+        )
+
+
+def test_get_matches_batch_top_n_over_store_size() -> None:
+    store = make_store(count=10)
+    matches = get_matches_batch(store, store.hashes[:2], top_n=20)
+    assert [len(row_matches) for row_matches in matches] == [10, 10]
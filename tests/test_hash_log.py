@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np  # type: ignore
+import pytest
+from conftest import make_store
+
+from hash_log import HashLog
+from hash_store import HashStore, load_hash_store, words_to_str_hash
+
+ZEROS = "0" * 256
+ONES = "1" * 256
+
+
+@pytest.fixture
+def hash_log(tmp_path: Path) -> HashLog:
+    make_store(count=100).write(tmp_path / "snapshot.bin")
+    return HashLog(
+        tmp_path / "log", tmp_path / "snapshot.bin", tmp_path / "hashes.json"
+    )
+
+
+def str_data(store: HashStore) -> dict[str, str]:
+    return {
+        str(ord_id): words_to_str_hash(words)
+        for ord_id, words in zip(store.ids, store.hashes)
+    }
+
+
+def test_read_merges_with_newest_winning(hash_log: HashLog) -> None:
+    snapshot = make_store(count=100)
+    existing = str(snapshot.ids[5])
+    hash_log.append({existing: ZEROS, "1000000": ZEROS})
+    hash_log.append({"1000000": ONES})
+
+    expected = str_data(snapshot)
+    expected.update({existing: ZEROS, "1000000": ONES})
+    store = hash_log.read()
+    assert str_data(store) == expected
+    assert np.all(np.diff(store.ids) > 0)
+
+
+def test_compaction_keeps_the_data(hash_log: HashLog) -> None:
+    hash_log.append({"1000000": ONES, "1000001": ZEROS})
+    before = str_data(hash_log.read())
+
+    hash_log.compact()
+
+    assert hash_log.pending_count() == 0
+    assert str_data(hash_log.read()) == before
+    assert str_data(load_hash_store(hash_log.snapshot_file)) == before
+
+
+def test_appends_during_compaction_are_kept(
+    hash_log: HashLog, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    hash_log.append({"1000000": ZEROS})
+    write = HashStore.write
+
+    def write_while_appending(store: HashStore, path: str | Path) -> None:
+        hash_log.append({"1000000": ONES, "1000001": ONES})
+        write(store, path)
+
+    monkeypatch.setattr(HashStore, "write", write_while_appending)
+    hash_log.compact()
+    monkeypatch.undo()
+
+    assert hash_log.pending_count() == 2
+    data = str_data(hash_log.read())
+    assert data["1000000"] == ONES
+    assert data["1000001"] == ONES
+
+
+def test_compaction_without_pending_does_not_rewrite(hash_log: HashLog) -> None:
+    assert not hash_log.needs_compaction(min_pending=1)
+    modified = hash_log.snapshot_file.stat().st_mtime_ns
+
+    hash_log.compact()
+
+    assert hash_log.snapshot_file.stat().st_mtime_ns == modified
+    hash_log.append({"1000000": ONES})
+    assert hash_log.needs_compaction(min_pending=1)
+    assert not hash_log.needs_compaction(min_pending=2)
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np  # type: ignore
+from conftest import make_store
+
+from hash_store import HEADER_DTYPE, HashStore, UniqueHashes, coarse_hashes
+
+
+def test_round_trip_with_sections(tmp_path: Path) -> None:
+    store = make_store()
+    store.write(tmp_path / "store.bin")
+
+    loaded = HashStore.load(tmp_path / "store.bin")
+
+    assert np.array_equal(loaded.ids, store.ids)
+    assert np.array_equal(loaded.hashes, store.hashes)
+    assert loaded.version == store.version
+    # the search structures come from the file, not built again
+    assert loaded.unique_ready
+    assert "coarse" in loaded.__dict__
+    built = UniqueHashes.build(store)
+    for name in ("hashes", "counts", "groups", "rows", "offsets"):
+        assert np.array_equal(getattr(loaded.unique, name), getattr(built, name))
+    assert np.array_equal(loaded.coarse, coarse_hashes(store.hashes))
+
+
+def test_without_sections(tmp_path: Path) -> None:
+    store = make_store()
+    store.write(tmp_path / "store.bin")
+    # files written before the sections existed end with the hashes
+    hashes_end = HEADER_DTYPE.itemsize + store.ids.nbytes + store.hashes.nbytes
+    data = (tmp_path / "store.bin").read_bytes()[:hashes_end]
+    (tmp_path / "old.bin").write_bytes(data)
+
+    loaded = HashStore.load(tmp_path / "old.bin")
+
+    assert not loaded.unique_ready
+    assert np.array_equal(loaded.hashes, store.hashes)
+    assert np.array_equal(loaded.coarse, coarse_hashes(store.hashes))
@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+from conftest import make_store
+
+from hash_store import HashStore
+from hash_store_reloader import HashStoreReloader
+
+
+def test_reload_warms_up_only_changed_data(tmp_path: Path) -> None:
+    shared_file = tmp_path / "shared.bin"
+    make_store().write(shared_file)
+    warmed_up: list[HashStore] = []
+    reloader = HashStoreReloader(
+        warm_up=warmed_up.append,
+        shared_file=shared_file,
+        store_file=tmp_path / "missing.bin",
+    )
+
+    # the same data published again
+    make_store().write(shared_file)
+    assert not reloader.reload_if_changed()
+    assert warmed_up == []
+
+    make_store(seed=1).write(shared_file)
+    assert reloader.reload_if_changed()
+    assert warmed_up == [reloader.store]
+    assert reloader.store.version == make_store(seed=1).version
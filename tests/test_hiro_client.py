@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import update_data
+from hiro_client import HiroClient
+
+PAGE_SIZE = 3
+
+
+class StandInHiro(ThreadingHTTPServer):
+    """Serves inscriptions 1 to count like the Hiro API, with injected errors.
+
+    Every URL in flaky is first answered by 429 (with Retry-After),
+    then by 503, and only then properly. Pages from fail_from_number
+    on are always answered by 503.
+    """
+
+    def __init__(self, count: int) -> None:
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.count = count
+        self.retry_after = "0"
+        self.flaky: set[str] = set()
+        self.fail_from_number: int | None = None
+        self.delay = 0.0
+        self.attempts: dict[str, int] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/inscriptions"
+
+    def entries(self, from_number: int, to_number: int) -> list[dict]:
+        return [
+            {"number": number, "content_type": "image/png", "tx_id": f"tx{number}"}
+            for number in range(from_number, min(to_number, self.count) + 1)
+        ]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    server: StandInHiro
+
+    def do_GET(self) -> None:
+        with self.server.lock:
+            attempt = self.server.attempts.get(self.path, 0)
+            self.server.attempts[self.path] = attempt + 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+        try:
+            time.sleep(self.server.delay)
+            self._respond(attempt)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def _respond(self, attempt: int) -> None:
+        url = urlparse(self.path)
+        if self.path in self.server.flaky and attempt == 0:
+            return self._send(429, b"", {"Retry-After": self.server.retry_after})
+        if self.path in self.server.flaky and attempt == 1:
+            return self._send(503, b"")
+        if url.path.endswith("/content"):
+            number = url.path.split("/")[-2]
+            return self._send(200, f"content {number}".encode())
+        params = {key: int(values[0]) for key, values in parse_qs(url.query).items()}
+        from_number = params["from_number"]
+        fail_from_number = self.server.fail_from_number
+        if fail_from_number is not None and from_number >= fail_from_number:
+            return self._send(503, b"")
+        to_number = params.get("to_number", from_number + params["limit"] - 1)
+        data = {
+            "total": max(self.server.count - from_number + 1, 0),
+            "results": self.server.entries(from_number, to_number),
+        }
+        self._send(200, json.dumps(data).encode())
+
+    def _send(self, status: int, body: bytes, headers: dict | None = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def hiro() -> Iterator[StandInHiro]:
+    server = StandInHiro(count=5 * PAGE_SIZE)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(hiro: StandInHiro, **kwargs) -> HiroClient:
+    options = dict(requests_per_second=0, backoff_base=0.001, timeout=5)
+    options.update(kwargs)
+    return HiroClient(hiro.base_url, **options)  # type: ignore
+
+
+def test_retries_429_and_503_honouring_retry_after(hiro: StandInHiro) -> None:
+    client = make_client(hiro, backoff_max=0.2)
+    hiro.retry_after = "1"
+    hiro.flaky = {"/inscriptions/7/content"}
+
+    started = time.perf_counter()
+    assert client.get_content(7) == b"content 7"
+    elapsed = time.perf_counter() - started
+
+    assert hiro.attempts["/inscriptions/7/content"] == 3
+    # Retry-After of 1 second, capped by backoff_max - not the tiny backoff
+    assert 0.2 <= elapsed < 1
+
+
+def test_gives_up_after_max_retries(hiro: StandInHiro) -> None:
+    client = make_client(hiro, max_retries=1)
+    hiro.flaky = {"/inscriptions/7/content"}
+
+    assert client.get_content(7) is None
+    assert hiro.attempts["/inscriptions/7/content"] == 2
+
+
+def test_pages_are_pipelined(hiro: StandInHiro) -> None:
+    client = make_client(hiro, max_workers=8)
+    hiro.delay = 0.05
+    hiro.flaky = {"/inscriptions/4/content"}
+
+    pages = list(client.iter_pages_with_content(1, hiro.count, page_size=PAGE_SIZE))
+
+    numbers = [entry["number"] for page in pages for entry, _ in page]
+    assert numbers == list(range(1, hiro.count + 1))
+    assert all(
+        content == f"content {entry['number']}".encode()
+        for page in pages
+        for entry, content in page
+    )
+    # Metadata and contents of the next pages were downloaded at once
+    assert hiro.max_in_flight > 1
+
+
+def test_permanent_failure_stops_after_saving_progress(
+    hiro: StandInHiro, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    processed: list[int] = []
+    last_checked_file = tmp_path / "last_checked_id.dat"
+    monkeypatch.setattr(update_data, "hiro_client", make_client(hiro, max_retries=1))
+    monkeypatch.setattr(update_data, "last_checked_id", 0)
+    monkeypatch.setattr(update_data, "last_checked_file", last_checked_file)
+    monkeypatch.setattr(update_data, "BATCH_SIZE", PAGE_SIZE)
+    monkeypatch.setattr(
+        update_data,
+        "process_batch",
+        lambda entries: processed.extend(entry["number"] for entry, _ in entries),
+    )
+    # The third page never succeeds
+    hiro.fail_from_number = 2 * PAGE_SIZE + 1
+
+    update_data.main()
+
+    assert processed == list(range(1, 2 * PAGE_SIZE + 1))
+    assert last_checked_file.read_text() == str(2 * PAGE_SIZE)
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import pytest
+from conftest import make_store
+
+from get_matches_numpy import get_match_sums, get_matches_from_store, top_n_indices
+from hash_store import HashStore, words_to_str_hash
+from multi_index_hash import MultiIndexHash
+
+
+def query_hashes(store: HashStore) -> list[str]:
+    rows = [0, 3, 250, len(store) - 1]
+    hashes = [words_to_str_hash(store.hashes[row]) for row in rows]
+    # inverse pictures match as well
+    inverse = ~store.hashes[10]
+    return hashes + [words_to_str_hash(inverse)]
+
+
+@pytest.mark.parametrize("flipped_bits", [4, 60])
+@pytest.mark.parametrize("top_n", [1, 20, 300])
+def test_get_matches_same_as_linear_scan(flipped_bits: int, top_n: int) -> None:
+    # also with distant hashes, found only by probing with larger radii
+    store = make_store(flipped_bits=flipped_bits)
+    index = MultiIndexHash(store)
+    for file_hash in query_hashes(store):
+        assert index.get_matches(None, file_hash, top_n) == get_matches_from_store(
+            store, None, file_hash, top_n
+        )
+
+
+@pytest.mark.parametrize("min_match_sum", [256, 250, 240])
+def test_get_matches_within_same_as_linear_scan(
+    store: HashStore, min_match_sum: int
+) -> None:
+    index = MultiIndexHash(store)
+    ord_id = str(store.ids[3])
+    words = store.get_words(ord_id)
+    assert words is not None
+    match_sums = get_match_sums(store.hashes, words)
+    best = top_n_indices(match_sums, len(store))
+    best = best[match_sums[best] >= min_match_sum]
+    expected = [
+        {"ord_id": str(ord_id), "match_sum": match_sum}
+        for ord_id, match_sum in zip(
+            store.ids[best].tolist(), match_sums[best].tolist()
+        )
+    ]
+    assert index.get_matches_within(ord_id, None, min_match_sum) == expected
+    assert len(expected) > 1
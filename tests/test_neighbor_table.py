@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from pathlib import Path
+
+from conftest import make_store
+
+from get_matches_numpy import get_matches_from_store
+from neighbor_table import check_against_store, convert_similarity_db
+
+
+def make_similarity_db(path: Path, rows: dict[int, list[list[int]]]) -> None:
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE similarity_index (id INTEGER PRIMARY KEY, list_of_lists TEXT)"
+    )
+    db.executemany(
+        "INSERT INTO similarity_index VALUES (?, ?)",
+        [(ord_id, json.dumps(matches)) for ord_id, matches in rows.items()],
+    )
+    db.commit()
+    db.close()
+
+
+def test_round_trip(tmp_path: Path) -> None:
+    rows = {
+        10: [[5, 256], [7, 250], [3, 250]],
+        11: [],
+        14: [[10, 200]],
+    }
+    make_similarity_db(tmp_path / "index.db", rows)
+
+    table = convert_similarity_db(tmp_path / "index.db", tmp_path / "table.bin", k=2)
+
+    assert table.get(10) == [
+        {"ord_id": "5", "match_sum": 256},
+        {"ord_id": "7", "match_sum": 250},
+    ]
+    assert table.get(10, top_n=1) == [{"ord_id": "5", "match_sum": 256}]
+    assert table.get(14) == [{"ord_id": "10", "match_sum": 200}]
+    # empty rows, gaps and ordinals outside the table
+    for ord_id in (9, 11, 12, 15):
+        assert ord_id not in table
+        assert table.get(ord_id) is None
+
+
+def test_table_agrees_with_live_search(tmp_path: Path) -> None:
+    store = make_store(count=200)
+    rows = {
+        int(ord_id): [
+            [int(match["ord_id"]), match["match_sum"]]
+            for match in get_matches_from_store(store, str(ord_id), None, 20)
+        ]
+        for ord_id in store.ids
+    }
+    make_similarity_db(tmp_path / "index.db", rows)
+
+    table = convert_similarity_db(tmp_path / "index.db", tmp_path / "table.bin")
+
+    assert len(table) == store.ids[-1] - store.ids[0] + 1
+    assert check_against_store(table, store, samples=len(store)) == []
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from result_cache import ResultCache
+
+
+@pytest.fixture(params=[False, True], ids=["memory", "sqlite"])
+def cache(request: pytest.FixtureRequest, tmp_path: Path) -> ResultCache:
+    db_path = tmp_path / "result_cache.db" if request.param else None
+    return ResultCache("v1", db_path=db_path)
+
+
+def test_read_from_stale_version_misses(cache: ResultCache) -> None:
+    cache.set("key", [1, 2])
+    assert cache.get("key", version="v1") == [1, 2]
+    assert cache.get("key", version="v0") is None
+
+
+def test_write_from_stale_version_is_dropped(cache: ResultCache) -> None:
+    # a request started with v1, but the data changed before it finished
+    cache.set_version("v2")
+    cache.set("key", "old result", version="v1")
+    assert cache.get("key") is None
+
+    cache.set("key", "new result", version="v2")
+    assert cache.get("key") == "new result"
+
+
+def test_new_version_drops_old_entries(tmp_path: Path) -> None:
+    db_path = tmp_path / "result_cache.db"
+    cache = ResultCache("v1", db_path=db_path)
+    cache.set("key", "old result")
+    cache.set_version("v2")
+    assert cache.get("key") is None
+    # also those persisted for the next API start
+    assert ResultCache("v2", db_path=db_path).get("key") is None
+    assert ResultCache("v1", db_path=db_path).get("key") is None
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from rust_server import RustServerClient, RustServerUnavailable
+
+OPEN_SECONDS = 0.05
+
+
+class StubServer:
+    """Stands in for RustServerClient._get_hedged, failing the ord_ids in failing.
+
+    Calls of the ord_ids in gates wait until their event is set.
+    """
+
+    def __init__(self) -> None:
+        self.failing: set[int] = set()
+        self.gates: dict[int, threading.Event] = {}
+        self.calls: list[int] = []
+
+    def get_hedged(self, endpoint: str, params: dict, hedge: bool) -> list:
+        ord_id = int(endpoint.split("/")[-1])
+        self.calls.append(ord_id)
+        if ord_id in self.gates:
+            self.gates[ord_id].wait(5)
+        if ord_id in self.failing:
+            raise ConnectionError(f"ord_id {ord_id} failed")
+        return [{"ord_id": str(ord_id), "match_sum": 256}]
+
+
+@pytest.fixture
+def server() -> StubServer:
+    return StubServer()
+
+
+@pytest.fixture
+def client(server: StubServer, monkeypatch: pytest.MonkeyPatch) -> RustServerClient:
+    client = RustServerClient(failure_threshold=2, open_seconds=OPEN_SECONDS)
+    monkeypatch.setattr(client, "_get_hedged", server.get_hedged)
+    return client
+
+
+def open_circuit(client: RustServerClient, server: StubServer) -> None:
+    server.failing.add(0)
+    for _ in range(client.failure_threshold):
+        with pytest.raises(ConnectionError):
+            client.get_matches(0, None, 20)
+
+
+def start_call(client: RustServerClient, ord_id: int) -> threading.Thread:
+    thread = threading.Thread(target=_call_ignoring_errors, args=(client, ord_id))
+    thread.start()
+    return thread
+
+
+def _call_ignoring_errors(client: RustServerClient, ord_id: int) -> None:
+    try:
+        client.get_matches(ord_id, None, 20)
+    except Exception:
+        pass
+
+
+def wait_for_call(server: StubServer, ord_id: int) -> None:
+    deadline = time.monotonic() + 5
+    while ord_id not in server.calls:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_opens_after_consecutive_failures(
+    client: RustServerClient, server: StubServer
+) -> None:
+    open_circuit(client, server)
+
+    with pytest.raises(RustServerUnavailable):
+        client.get_matches(1, None, 20)
+    assert 1 not in server.calls
+
+
+def test_success_resets_the_failures(
+    client: RustServerClient, server: StubServer
+) -> None:
+    server.failing.add(0)
+    with pytest.raises(ConnectionError):
+        client.get_matches(0, None, 20)
+    client.get_matches(1, None, 20)
+    with pytest.raises(ConnectionError):
+        client.get_matches(0, None, 20)
+
+    assert client.get_matches(1, None, 20)
+
+
+def test_successful_probe_closes(client: RustServerClient, server: StubServer) -> None:
+    open_circuit(client, server)
+    time.sleep(OPEN_SECONDS)
+
+    assert client.get_matches(1, None, 20)
+    assert client.get_matches(2, None, 20)
+
+
+def test_failed_probe_opens_again(client: RustServerClient, server: StubServer) -> None:
+    open_circuit(client, server)
+    time.sleep(OPEN_SECONDS)
+
+    with pytest.raises(ConnectionError):
+        client.get_matches(0, None, 20)
+    with pytest.raises(RustServerUnavailable):
+        client.get_matches(1, None, 20)
+
+
+def test_only_one_probe_at_a_time(client: RustServerClient, server: StubServer) -> None:
+    server.gates = {1: threading.Event(), 2: threading.Event()}
+    server.failing.add(1)
+    # a call started before the circuit opened
+    late = start_call(client, 1)
+    wait_for_call(server, 1)
+    open_circuit(client, server)
+    time.sleep(OPEN_SECONDS)
+    probe = start_call(client, 2)
+    wait_for_call(server, 2)
+
+    # the late call failing must not let another probe through
+    server.gates[1].set()
+    late.join()
+    with pytest.raises(RustServerUnavailable):
+        client.get_matches(3, None, 20)
+
+    server.gates[2].set()
+    probe.join()
+    assert client.get_matches(3, None, 20)
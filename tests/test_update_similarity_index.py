@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import numpy as np  # type: ignore
+
+from update_similarity_index import merge_top_matches
+
+TOP_N = 5
+
+
+def test_merge_is_idempotent() -> None:
+    rng = np.random.default_rng(0)
+    old_lists = [
+        [
+            [int(ord_id), 250 - i]
+            for i, ord_id in enumerate(rng.choice(100, TOP_N, replace=False))
+        ]
+        for _ in range(20)
+    ]
+    old_lists[0] = []
+    # new matches overlapping the stored ones, with the same match_sums
+    new_ids = np.array([rng.choice(100, 3, replace=False) for _ in range(20)])
+    new_sums = np.full((20, 3), 248)
+
+    merged = merge_top_matches(old_lists, new_ids, new_sums, TOP_N)
+    assert merged[0] is not None
+    lists = [new or old for old, new in zip(old_lists, merged)]
+
+    assert merge_top_matches(lists, new_ids, new_sums, TOP_N) == [None] * 20
+    for top_matches in lists:
+        ord_ids = [ord_id for ord_id, _ in top_matches]
+        assert len(set(ord_ids)) == len(ord_ids)
+
+
+def test_stored_matches_win_ties() -> None:
+    old_lists = [[[1, 250], [2, 240]]]
+    merged = merge_top_matches(old_lists, np.array([[3, 4]]), np.array([[240, 245]]), 3)
+    assert merged == [[[1, 250], [4, 245], [2, 240]]]
+
+    old_lists = [[[1, 250], [2, 240], [3, 230]]]
+    assert merge_top_matches(old_lists, np.array([[4]]), np.array([[230]]), 3) == [None]
@@ -24,19 +24,33 @@ python3.8 update_data.py
 
 ./status.sh
 
-echo "restart backup API"
-./restart_backup_api.sh
+echo "compacting new hashes into the hash store"
+# Only rewrites the snapshot once enough hashes are pending,
+# see hash_log.needs_compaction
+python3.8 hash_log.py
 
 ./status.sh
 
-echo "sleeping 10 seconds"
-sleep 10
+echo "indexing the top matches of new hashes"
+# Also regenerates the neighbor table, so the APIs load the fresh one
+# together with the new hash store (see api.on_hash_store_swap)
+python3.8 update_similarity_index.py
 
-echo "restarting main API"
-./restart_api.sh
+./status.sh
 
-sleep 1
+# Snapshot together with the pending hashes, so the new ones are
+# searchable right away, whether compacted or not
+echo "publishing hash store into shared memory"
+python3.8 shared_hash_store.py
+
+# Both the APIs reload the hash store by themselves, once the file
+# changes (see hash_store_reloader.py) - no need to restart them.
+# Only the Rust server keeps its own copy of the data.
+if [ -x ./restart_rust_server.sh ]; then
+    echo "restarting Rust server"
+    ./restart_rust_server.sh
+fi
 
 ./status.sh
 
-echo "finished restarting"
+echo "finished updating"
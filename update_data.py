@@ -1,27 +1,21 @@
 from __future__ import annotations
 
-import json
-import time
 from datetime import datetime
 from pathlib import Path
 
-import requests  # type: ignore
-from requests.exceptions import HTTPError  # type: ignore
-
 from common import bytes_to_hash, content_md5_hash, get_logger
-from config import Config
 from db_files import ByteData
 from db_files import get_session as get_files_session
 from db_ord_data import InscriptionModel
 from db_ord_data import get_session as get_data_session
+from hash_log import HashLog
+from hiro_client import HIRO_API, EntryWithContent, HiroClient
 
 HERE = Path(__file__).parent
 
 log_file_path = HERE / "update_data.log"
 logger = get_logger(__file__, log_file_path)
 
-new_hashes_file = HERE / "new_average_hashes.txt"
-
 last_checked_file = HERE / "last_checked_id.dat"
 
 try:
@@ -30,53 +24,35 @@ except Exception as e:
     logger.exception(f"Could not read last_checked_id from file - {e}")
     last_checked_id = None
 
-HIRO_API = "https://api.hiro.so/ordinals/v1/inscriptions"
-HIRO_CONTENT_API_TEMPLATE = "https://api.hiro.so/ordinals/v1/inscriptions/{}/content"
-
 QUICK_PICTURE_UPDATE = True
 
-new_average_hashes: dict[str, str] = {}
-
+# How many inscriptions are processed at once
+BATCH_SIZE = 60
 
-def get_current_data() -> dict[str, str]:
-    with open(Config.AVERAGE_HASH_DB) as f:
-        return json.load(f)["data"]
+# Ingestion can wait for Hiro, while API requests should rather fail fast
+hiro_client = HiroClient(HIRO_API, max_workers=8, requests_per_second=10)
+quick_hiro_client = HiroClient(
+    HIRO_API, requests_per_second=0, max_retries=1, backoff_max=1, timeout=10
+)
 
+# New hashes are only appended to the log, compacting is done separately
+hash_log = HashLog()
 
-def save_new_data(new_data: dict[str, str]) -> None:
-    with open(Config.AVERAGE_HASH_DB, "w") as f:
-        results = {"data": new_data}
-        json.dump(results, f, indent=1)
-
-
-def get_our_last_id(data: dict[str, str]) -> int:
-    return max(int(k) for k in data.keys())
+new_average_hashes: dict[str, str] = {}
 
 
 def get_missing_amount(our_last_id: int) -> int:
-    params = {"limit": 1, "from_number": our_last_id + 1}
-    r = requests.get(HIRO_API, params=params)
-    r.raise_for_status()
-    data = r.json()
-
+    data = hiro_client.get_inscriptions(our_last_id + 1, limit=1)
     total_missing = data["total"]
     return total_missing
 
 
-def save_new_avg_hash(ord_id: str, avg_hash: str) -> None:
-    with open(new_hashes_file, "a") as f:
-        f.write(f"{ord_id} {avg_hash}\n")
-
-
 def get_content_from_hiro_by_ord_id(ord_id: int) -> bytes | None:
-    r = requests.get(HIRO_CONTENT_API_TEMPLATE.format(ord_id))
-    if r.status_code == 200:
-        return r.content
-    return None
+    return quick_hiro_client.get_content(ord_id)
 
 
 def get_hiro_content_link_from_ord_id(ord_id: int) -> str:
-    return HIRO_CONTENT_API_TEMPLATE.format(ord_id)
+    return hiro_client.content_url(ord_id)
 
 
 def get_hiro_content_link_from_tx_id(tx_id: str) -> str | None:
@@ -88,40 +64,37 @@ def get_hiro_content_link_from_tx_id(tx_id: str) -> str | None:
 
 
 def get_from_hiro_by_ord_id(ord_id: int | str) -> dict:
-    params = {"limit": 1, "from_number": ord_id, "to_number": ord_id}
-    r = requests.get(HIRO_API, params=params)
-    r.raise_for_status()
-    data = r.json()
-    return data["results"][0]
+    return quick_hiro_client.get_by_ord_id(ord_id)
 
 
 def get_from_hiro_by_tx_id(tx_id: str) -> dict | None:
-    url = f"{HIRO_API}/{tx_id}i0"
-    r = requests.get(url)
-    if r.status_code == 200:
-        return r.json()
-    return None
+    return quick_hiro_client.get_by_tx_id(tx_id)
+
 
+def should_download_content(entry: dict) -> bool:
+    if QUICK_PICTURE_UPDATE:
+        return entry["content_type"].startswith("image/")
+    return True
 
-def process_batch(limit: int, from_number: int, to_number: int) -> None:
-    logger.info(f"Processing batch {from_number} - {to_number}")
-    params = {"limit": limit, "from_number": from_number, "to_number": to_number}
-    r = requests.get(HIRO_API, params=params)
-    r.raise_for_status()
-    data = r.json()
+
+def process_batch(entries: list[EntryWithContent]) -> None:
+    if not entries:
+        return
+    logger.info(
+        f"Processing batch {entries[0][0]['number']} - {entries[-1][0]['number']}"
+    )
 
     if not QUICK_PICTURE_UPDATE:
         files_db_session = get_files_session()
     ord_data_session = get_data_session()
+    batch_average_hashes: dict[str, str] = {}
 
-    for entry in data["results"]:
-        if QUICK_PICTURE_UPDATE:
-            if not entry["content_type"].startswith("image/"):
-                continue
+    for entry, content_data in entries:
+        if not should_download_content(entry):
+            continue
 
-        # Get content from another endpoint
+        # Content was downloaded from another endpoint
         ord_id: int = entry["number"]
-        content_data = get_content_from_hiro_by_ord_id(ord_id)
         if not content_data:
             logger.error(f"Cant get content for {ord_id}")
             continue
@@ -131,8 +104,7 @@ def process_batch(limit: int, from_number: int, to_number: int) -> None:
         if content_type.startswith("image/"):
             try:
                 average_hash = bytes_to_hash(content_data)
-                new_average_hashes[str(ord_id)] = average_hash
-                save_new_avg_hash(str(ord_id), average_hash)
+                batch_average_hashes[str(ord_id)] = average_hash
             except Exception as e:
                 logger.error(
                     f"ERROR: could not get average hash of picture {ord_id} - {e}"
@@ -157,6 +129,8 @@ def process_batch(limit: int, from_number: int, to_number: int) -> None:
     if not QUICK_PICTURE_UPDATE:
         files_db_session.commit()
     ord_data_session.commit()
+    hash_log.append(batch_average_hashes)
+    new_average_hashes.update(batch_average_hashes)
 
 
 def create_inscription_model_from_api_data(
@@ -183,38 +157,38 @@ def create_inscription_model_from_api_data(
 
 
 def main() -> None:
-    average_hash_data = get_current_data()
+    average_hash_store = hash_log.read()
     if last_checked_id is not None:
         last_id = last_checked_id
     else:
-        last_id = get_our_last_id(average_hash_data)
+        last_id = average_hash_store.max_id()
     logger.info(f"Last id: {last_id}")
-    logger.info(f"Initial average hashes count: {len(average_hash_data)}")
+    logger.info(f"Initial average hashes count: {len(average_hash_store)}")
     total_missing = get_missing_amount(last_id)
     logger.info(f"Total missing: {total_missing}")
 
+    # Downloading the next batches while processing the current one
     processed = 0
-    while processed < total_missing:
-        try:
-            limit = 60
-            from_number = last_id + 1 + processed
-            to_number = from_number + limit - 1
-            process_batch(limit, from_number, to_number)
-            processed += limit
-        except HTTPError:
-            logger.error("HTTPError, retrying")
-            time.sleep(5)
-            continue
-        except Exception as e:
-            logger.exception(f"ERROR: {e}")
-            continue
+    try:
+        for entries in hiro_client.iter_pages_with_content(
+            last_id + 1,
+            last_id + total_missing,
+            page_size=BATCH_SIZE,
+            want_content=should_download_content,
+        ):
+            try:
+                process_batch(entries)
+            except Exception as e:
+                logger.exception(f"ERROR: {e}")
+            processed += BATCH_SIZE
+    except Exception as e:
+        # Hiro did not respond even after retries - saving what we have
+        logger.exception(f"ERROR: stopping the update - {e}")
 
-    new_last_id = last_id + total_missing
+    new_last_id = last_id + min(processed, total_missing)
     last_checked_file.write_text(str(new_last_id))
 
-    # merge average_hash_data with new_average_hashes and save it
-    average_hash_data.update(new_average_hashes)
-    save_new_data(average_hash_data)
+    # new hashes are already in the log - see hash_log.py for compacting
     logger.info(f"New average hashes count: {len(new_average_hashes)}")
     logger.info("Done!")
 
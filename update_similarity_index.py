@@ -1,90 +1,167 @@
+from __future__ import annotations
+
 import json
 from pathlib import Path
 
+import numpy as np  # type: ignore
+
 from common import get_logger
 from config import Config
 from db_similarity_index import SimilarityIndex, get_highest_id, get_session
-from get_matches import get_matches_from_data
-from rust_server import get_matches_from_rust_server
+from get_matches_numpy import get_top_n_batch
+from hash_log import HashLog
+from hash_store import HashStore
+from neighbor_table import convert_similarity_db
 
 HERE = Path(__file__).parent
 
 log_file_path = HERE / "update_similarity_index.log"
 logger = get_logger(__file__, log_file_path)
 
-is_rust_server_running = True
-try:
-    get_matches_from_rust_server(ord_id=1, file_hash=None)
-    logger.info("Rust server is running")
-except Exception as e:
-    is_rust_server_running = False
-    logger.error(f"Rust server is not running {e}")
+TOP_N = 20
+# How many new ordinals are searched for at once
+BATCH_SIZE = 1000
+# How many already indexed rows are read, merged and written at once
+OLD_BATCH_SIZE = 10_000
 
 
 def main():
     highest_indexed_id = get_highest_id()
     logger.info(f"highest_indexed_id {highest_indexed_id}")
 
-    with open(Config.AVERAGE_HASH_DB, "r") as f:
-        data = json.load(f)["data"]
+    store = HashLog().read()
+    first_new = int(np.searchsorted(store.ids, highest_indexed_id, side="right"))
+    new_store = HashStore(store.ids[first_new:], store.hashes[first_new:])
+    logger.info(f"{len(new_store):_} new ordinals to index")
+    if not len(new_store):
+        return
+
+    # Old rows are updated first - the highest indexed id moves only
+    # with the new rows, so an interrupted update is simply repeated
+    update_old_rows(store, new_store, highest_indexed_id)
+    add_new_rows(store, new_store)
 
-    already_indexed_data: dict[str, str] = {
-        k: v for k, v in data.items() if int(k) <= highest_indexed_id
-    }
-    not_indexed_data: dict[str, str] = {
-        k: v for k, v in data.items() if int(k) > highest_indexed_id
-    }
+    # The API memory-maps the table instead of the DB, when it exists
+    # it must be regenerated, otherwise it misses all the new matches
+    if Config.NEIGHBOR_TABLE.exists():
+        table = convert_similarity_db()
+        logger.info(f"Saved {len(table):_} rows into {Config.NEIGHBOR_TABLE}")
 
+
+def update_old_rows(
+    store: HashStore, new_store: HashStore, highest_indexed_id: int
+) -> None:
+    """Merges the new ordinals into the top matches of all the indexed ones."""
     session = get_session()
+    last_id = -1
+    updated = 0
+    while True:
+        rows = (
+            session.query(SimilarityIndex.id, SimilarityIndex.list_of_lists)  # type: ignore
+            .filter(SimilarityIndex.id > last_id)  # type: ignore
+            .filter(SimilarityIndex.id <= highest_indexed_id)  # type: ignore
+            .order_by(SimilarityIndex.id)  # type: ignore
+            .limit(OLD_BATCH_SIZE)
+            .all()
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
 
-    # calculate the index for all the ord_ids higher than highest_indexed_id
-    for progress, (ord_id, average_hash) in enumerate(not_indexed_data.items()):
-        if progress % 100 == 0:
-            logger.info(f"New update progress {progress} / {len(not_indexed_data)}")
-        if session.query(SimilarityIndex).get(int(ord_id)) is not None:
-            continue
-        if is_rust_server_running:
-            matches = get_matches_from_rust_server(ord_id=None, file_hash=average_hash)
-        else:
-            matches = get_matches_from_data(
-                data, ord_id=None, file_hash=average_hash, top_n=20
-            )
-        list_of_lists = [
-            [int(match["ord_id"]), match["match_sum"]] for match in matches
-        ]
-        obj = SimilarityIndex(
-            id=int(ord_id),
-            list_of_lists=json.dumps(list_of_lists),
+        # Rows of ordinals we do not have the hash of cannot change
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        positions = np.searchsorted(store.ids, ids).clip(max=len(store) - 1)
+        have_hash = store.ids[positions] == ids
+        old_lists = [json.loads(row[1]) for row, has in zip(rows, have_hash) if has]
+
+        new_indices, new_sums = get_top_n_batch(
+            new_store.hashes, store.hashes[positions[have_hash]], TOP_N
         )
-        session.add(obj)
-        if progress % 100 == 0:
-            session.commit()
-
-    # calculate the similarities for older ones - but just with new ones
-    for progress, (old_ord_id, old_average_hash) in enumerate(
-        already_indexed_data.items()
-    ):
-        if progress % 100 == 0:
-            logger.info(f"Old update progress {progress} / {len(already_indexed_data)}")
-        new_matches = get_matches_from_data(
-            not_indexed_data, ord_id=None, file_hash=old_average_hash, top_n=20
+        changed = merge_top_matches(
+            old_lists, new_store.ids[new_indices], new_sums, TOP_N
         )
-        old_matches = SimilarityIndex.list_by_id(int(old_ord_id))
+        session.bulk_update_mappings(
+            SimilarityIndex,  # type: ignore
+            [
+                {"id": int(ord_id), "list_of_lists": json.dumps(top_matches)}
+                for ord_id, top_matches in zip(ids[have_hash].tolist(), changed)
+                if top_matches is not None
+            ],
+        )
+        session.commit()
+        updated += sum(top_matches is not None for top_matches in changed)
+        logger.info(f"Old update up to {last_id:_}, {updated:_} rows changed")
+
 
-        new_matches_old_format = [
-            [int(match["ord_id"]), match["match_sum"]] for match in new_matches
+def merge_top_matches(
+    old_lists: list[list[list[int]]],
+    new_ids: np.ndarray,
+    new_sums: np.ndarray,
+    top_n: int,
+) -> list[list[list[int]] | None]:
+    """Merges the (rows, k) new matches into the stored [ord_id, match_sum] lists.
+
+    Returns the new top_n list for every row, or None when it did not change.
+    Stored matches win the ties, and new ordinals already in the stored list
+    are skipped, so merging the same matches twice changes nothing.
+    """
+    rows = len(old_lists)
+    width = max([len(old) for old in old_lists] + [top_n])
+    old_ids = np.full((rows, width), -1, dtype=np.int64)
+    old_sums = np.full((rows, width), -1, dtype=np.int64)
+    for row, old in enumerate(old_lists):
+        if old:
+            old_ids[row, : len(old)], old_sums[row, : len(old)] = zip(*old)
+
+    new_sums = np.where(
+        (new_ids[:, :, None] == old_ids[:, None, :]).any(axis=2), -1, new_sums
+    )
+    all_ids = np.concatenate((old_ids, new_ids), axis=1)
+    all_sums = np.concatenate((old_sums, new_sums), axis=1)
+    order = np.argsort(-all_sums, axis=1, kind="stable")[:, :top_n]
+    top_ids = np.take_along_axis(all_ids, order, axis=1)
+    top_sums = np.take_along_axis(all_sums, order, axis=1)
+
+    changed = (top_ids != old_ids[:, :top_n]).any(axis=1)
+    changed |= np.array([len(old) > top_n for old in old_lists], dtype=bool)
+    result: list[list[list[int]] | None] = [None] * rows
+    for row in np.flatnonzero(changed).tolist():
+        valid = top_sums[row] >= 0
+        result[row] = [
+            [ord_id, match_sum]
+            for ord_id, match_sum in zip(
+                top_ids[row][valid].tolist(), top_sums[row][valid].tolist()
+            )
         ]
-        all_matches_together = old_matches + new_matches_old_format
-        all_matches_together.sort(key=lambda x: x[1], reverse=True)
-        new_top_matches = all_matches_together[:20]
-        if old_matches == new_top_matches:
-            continue
-        obj = session.query(SimilarityIndex).get(int(old_ord_id))
-        if obj is None:
-            continue
-        obj.list_of_lists = json.dumps(new_top_matches)
-        if progress % 100 == 0:
-            session.commit()
+    return result
+
+
+def add_new_rows(store: HashStore, new_store: HashStore) -> None:
+    """Calculates the top matches among all the ordinals for the new ones."""
+    session = get_session()
+    for progress in range(0, len(new_store), BATCH_SIZE):
+        logger.info(f"New update progress {progress} / {len(new_store)}")
+        batch_end = progress + BATCH_SIZE
+        indices, match_sums = get_top_n_batch(
+            store.hashes, new_store.hashes[progress:batch_end], TOP_N
+        )
+        session.bulk_insert_mappings(
+            SimilarityIndex,  # type: ignore
+            [
+                {
+                    "id": ord_id,
+                    "list_of_lists": json.dumps(
+                        [list(match) for match in zip(match_ids, row_sums)]
+                    ),
+                }
+                for ord_id, match_ids, row_sums in zip(
+                    new_store.ids[progress:batch_end].tolist(),
+                    store.ids[indices].tolist(),
+                    match_sums.tolist(),
+                )
+            ],
+        )
+        session.commit()
 
 
 if __name__ == "__main__":